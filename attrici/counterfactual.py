@@ -0,0 +1,260 @@
+import numpy as np
+import pandas as pd
+from scipy import stats
+import attrici.const as c
+
+# The quantile mappings of the models and the counterfactual from MAP weights,
+# without pymc3 and Theano, so that regenerate_cfact.py runs without them.
+# d holds the factual parameters and, with suffix _ref, the counterfactual ones.
+
+
+def get_cell_seed(seed, lat, lon):
+
+    """ The seed of the random draws for a cell, from the seed of the run
+    and the coordinates, so that the draws do not depend on which worker
+    estimates the cell or on the cells it estimated before. """
+
+    return [seed, int(round((lat + 90) * 1000)), int(round((lon + 360) * 1000))]
+
+
+def draw_uniform(seeds, n):
+
+    """ n uniform random numbers for cells whose time series follow each
+    other, each part from the seed of its cell, see get_cell_seed. Without
+    seeds or for a seed of None, from the NumPy random state. """
+
+    if seeds is None:
+        return np.random.rand(n)
+    n_cell = n // len(seeds)
+    rngs = [np.random if seed is None else np.random.RandomState(seed) for seed in seeds]
+    return np.concatenate([rng.rand(n_cell) for rng in rngs])
+
+
+def normal(d, y_scaled):
+
+    """
+    specific for normally distributed variables.
+    """
+    quantile = stats.norm.cdf(y_scaled, loc=d["mu"], scale=d["sigma"])
+    x_mapped = stats.norm.ppf(quantile, loc=d["mu_ref"], scale=d["sigma_ref"])
+
+    return x_mapped
+
+
+def normal_in_unit_interval(d, y_scaled):
+
+    """
+    nan values are not quantile-mapped. 100% humidity happens mainly at the poles.
+    """
+
+    x_mapped = normal(d, y_scaled)
+    x_mapped[x_mapped >= 1] = np.nan
+    x_mapped[x_mapped <= 0] = np.nan
+
+    return x_mapped
+
+
+def normal_positive(d, y_scaled):
+
+    """
+    nan values are not quantile-mapped. 0 rsds happens mainly in the polar night.
+    """
+
+    x_mapped = normal(d, y_scaled)
+    x_mapped[x_mapped <= 0] = np.nan
+
+    return x_mapped
+
+
+def bernoulli_gamma(d, y_scaled, seeds=None):
+
+    """ Needs a thorough description of QM for BernoulliGamma
+    The dry days made wet are drawn with seeds, see draw_uniform. """
+
+    def bgamma_cdf(d, y_scaled):
+
+        quantile = d["pbern"] + (1 - d["pbern"]) * stats.gamma.cdf(
+            y_scaled,
+            d["mu"] ** 2.0 / d["sigma"] ** 2.0,
+            scale=d["sigma"] ** 2.0 / d["mu"],
+        )
+        return quantile
+
+    def bgamma_ppf(d, quantile):
+
+        x_mapped = stats.gamma.ppf(
+            (quantile - d["pbern_ref"]) / (1 - d["pbern_ref"]),
+            d["mu_ref"] ** 2.0 / d["sigma_ref"] ** 2.0,
+            scale=d["sigma_ref"] ** 2.0 / d["mu_ref"],
+        )
+
+        return x_mapped
+
+    # make it a numpy array, so we can compine smoothly with d data frame.
+    y_scaled = y_scaled.values.copy()
+    dry_day = np.isnan(y_scaled)
+    # FIXME: have this zero precip at dry day fix earlier (in const.py for example)
+    y_scaled[dry_day] = 0
+    quantile = bgamma_cdf(d, y_scaled)
+
+    # case of p smaller p'
+    # the probability of a dry day is higher in the counterfactual day
+    # than in the historical day. We need to create dry days.
+    drier_cf = d["pbern_ref"] > d["pbern"]
+    wet_to_wet = quantile > d["pbern_ref"]  # False on dry day (NA in y_scaled)
+    # if the quantile of the observed rain is high enough, keep day wet
+    # and use normal quantile mapping
+    do_normal_qm_0 = np.logical_and(drier_cf, wet_to_wet)
+    print("normal qm for higher cfact dry probability:", do_normal_qm_0.sum())
+    cfact = np.zeros(len(y_scaled))
+    cfact[do_normal_qm_0] = bgamma_ppf(d, quantile)[do_normal_qm_0]
+    # else: make it a dry day with zero precip (from np.zeros)
+
+    # case of p' smaller p
+    # the probability of a dry day is lower in the counterfactual day
+    # than in the historical day. We need to create wet days.
+    wetter_cf = ~drier_cf
+    wet_day = ~dry_day
+    # wet days stay wet, and are normally quantile mapped
+    do_normal_qm_1 = np.logical_and(wetter_cf, wet_day)
+    print("normal qm for higher cfact wet probability:", do_normal_qm_1.sum())
+    cfact[do_normal_qm_1] = bgamma_ppf(d, quantile)[do_normal_qm_1]
+    # some dry days need to be made wet. take a random quantile from
+    # the quantile range that was dry days before
+    random_dry_day_q = draw_uniform(seeds, len(d)) * d["pbern"]
+    map_to_wet = random_dry_day_q > d["pbern_ref"]
+    # map these dry days to wet, which are not dry in obs and
+    # wet in counterfactual
+    randomly_map_to_wet = np.logical_and(~do_normal_qm_1, map_to_wet)
+    cfact[randomly_map_to_wet] = bgamma_ppf(d, quantile)[randomly_map_to_wet]
+    # else: leave zero (from np.zeros)
+    print("Days originally dry:", dry_day.sum())
+    print("Days made wet:", randomly_map_to_wet.sum())
+    print("Days in cfact dry:", (cfact == 0).sum())
+    print(
+        "Total days:",
+        (cfact == 0).sum()
+        + randomly_map_to_wet.sum()
+        + do_normal_qm_0.sum()
+        + do_normal_qm_1.sum(),
+    )
+
+    return cfact
+
+
+def gamma(d, y_scaled):
+
+    quantile = stats.gamma.cdf(
+        y_scaled,
+        d["mu"] ** 2.0 / d["sigma"] ** 2.0,
+        scale=d["sigma"] ** 2.0 / d["mu"],
+    )
+    x_mapped = stats.gamma.ppf(
+        quantile,
+        d["mu_ref"] ** 2.0 / d["sigma_ref"] ** 2.0,
+        scale=d["sigma_ref"] ** 2.0 / d["mu_ref"],
+    )
+
+    return x_mapped
+
+
+def beta(d, y_scaled):
+
+    quantile = stats.beta.cdf(y_scaled, d["alpha"], d["beta"])
+    x_mapped = stats.beta.ppf(quantile, d["alpha_ref"], d["beta_ref"])
+
+    return x_mapped
+
+
+def rice(d, y_scaled):
+
+    quantile = stats.rice.cdf(y_scaled, b=d["nu"] / d["sigma"], scale=d["sigma"])
+    x_mapped = stats.rice.ppf(quantile, b=d["nu_ref"] / d["sigma_ref"], scale=d["sigma_ref"])
+
+    return x_mapped
+
+
+def weibull(d, y_scaled):
+
+    quantile = stats.weibull_min.cdf(y_scaled, d["alpha"], scale=d["beta"])
+    x_mapped = stats.weibull_min.ppf(quantile, d["alpha_ref"], scale=d["beta_ref"])
+
+    return x_mapped
+
+
+quantile_mapping_for_var = {
+    "tas": normal,
+    "tasrange": gamma,
+    "tasskew": normal_in_unit_interval,
+    "pr": bernoulli_gamma,
+    "hurs": beta,
+    "wind": weibull,
+    "sfcwind": weibull,
+    "ps": normal,
+    "rsds": normal_positive,
+    "rlds": normal,
+}
+
+
+def estimate_timeseries_batch(
+    variable, logposterior, dfs, theta, datamin, scale, report_variables, seeds=None
+):
+
+    """ The counterfactual of many cells from their MAP weights, without any
+    model. The dataframes need to share the time axis, as from dh.RunContext.
+    theta holds the weights of the cells with shape (ncells, size) for the
+    posterior.Posterior logposterior. Parameters and quantile mapping are
+    computed for all cells together. For pr, the random draws of each cell
+    come from its seed in seeds, see get_cell_seed, as for a single cell in
+    estimator.estimate_timeseries. Returns the dataframes with the
+    counterfactual. """
+
+    y_scaled = np.column_stack([df["y_scaled"].values for df in dfs])
+    y = np.column_stack([df["y"].values for df in dfs])
+    trace_obs, trace_cfact = logposterior.resample_batch(theta, dfs[0])
+
+    # the quantile mappings work elementwise, so all cells go in one flat
+    # frame, one time series after the other
+    df_params = pd.DataFrame()
+    for p in [p for p in trace_obs if p != "logp"]:
+        df_params[p] = trace_obs[p].ravel(order="F")
+        df_params[f"{p}_ref"] = trace_cfact[p].ravel(order="F")
+    y_flat = pd.Series(y_scaled.ravel(order="F"))
+    if variable == "pr":
+        cfact_scaled = bernoulli_gamma(df_params, y_flat, seeds)
+    else:
+        cfact_scaled = quantile_mapping_for_var[variable](df_params, y_flat)
+    cfact_scaled = np.asarray(cfact_scaled).reshape(y.shape, order="F")
+    print("Done with quantile mapping.")
+
+    f_rescale = c.mask_and_scale[variable][1]
+    cfact = np.asarray(
+        f_rescale(cfact_scaled, np.asarray(datamin), np.asarray(scale)), dtype=float
+    )
+    if variable == "pr":
+        cfact[cfact_scaled == 0] = 0
+    else:
+        invalid = np.isnan(y_scaled)
+        cfact[invalid] = y[invalid]
+
+    yna = np.isnan(cfact)
+    yinf = np.isposinf(cfact)
+    yminf = np.isneginf(cfact)
+    print(f"There are {yna.sum()} NaN values from quantile mapping. Replace.")
+    print(f"There are {yinf.sum()} Inf values from quantile mapping. Replace.")
+    print(f"There are {yminf.sum()} -Inf values from quantile mapping. Replace.")
+    replace = yna | yinf | yminf
+    cfact[replace] = y[replace]
+
+    results = []
+    for k, df in enumerate(dfs):
+        df.loc[:, "cfact_scaled"] = cfact_scaled[:, k]
+        df.loc[:, "cfact"] = cfact[:, k]
+        for v in df_params.columns:
+            df.loc[:, v] = df_params[v].values.reshape(y.shape, order="F")[:, k]
+        df.loc[:, "logp"] = trace_obs["logp"][k]
+        if report_variables != "all":
+            df = df.loc[:, report_variables]
+        results.append(df)
+
+    return results
@@ -1,8 +1,13 @@
+import os
+import json
+import shutil
 import numpy as np
 import pandas as pd
 import pathlib
 import sys
+import types
 import netCDF4 as nc
+from datetime import datetime
 import attrici.const as c
 import attrici.fourier as fourier
 
@@ -15,6 +20,24 @@ def create_output_dirs(output_dir):
         (output_dir / d).mkdir(parents=True, exist_ok=True)
 
 
+def settings_for_variable(settings, variable):
+
+    """ A copy of the settings for another variable of a joint run. Input
+    and output file names and report_to_netcdf are those of variable. """
+
+    cfg = types.SimpleNamespace(
+        **{key: value for key, value in vars(settings).items() if not key.startswith("__")}
+    )
+    cfg.variable = variable
+    cfg.source_file = settings.source_file.replace(settings.variable, variable, 1)
+    cfg.cfact_file = settings.cfact_file.replace(settings.variable, variable, 1)
+    cfg.report_to_netcdf = [
+        variable + name[len(settings.variable):] if name.startswith(settings.variable) else name
+        for name in settings.report_to_netcdf
+    ]
+    return cfg
+
+
 def make_cell_output_dir(output_dir, sub_dir, lat, lon, variable):
 
     """ params: output_dir: a pathlib object """
@@ -29,6 +52,23 @@ def make_cell_output_dir(output_dir, sub_dir, lat, lon, variable):
         return lat_sub_dir
 
 
+def get_cell_specs(lats, lons, ls_mask):
+
+    """ Return a dataframe with lat, lon and their indices for all land cells.
+    The row number of a cell is its run number. """
+
+    longrid, latgrid = np.meshgrid(lons, lats)
+    jgrid, igrid = np.meshgrid(np.arange(len(lons)), np.arange(len(lats)))
+
+    df_specs = pd.DataFrame()
+    df_specs["lat"] = latgrid[ls_mask == 1]
+    df_specs["lon"] = longrid[ls_mask == 1]
+    df_specs["index_lat"] = igrid[ls_mask == 1]
+    df_specs["index_lon"] = jgrid[ls_mask == 1]
+
+    return df_specs
+
+
 def get_subset(df, subset, seed, startdate):
     orig_len = len(df)
     if subset > 1:
@@ -46,10 +86,10 @@ def get_subset(df, subset, seed, startdate):
     return df
 
 
-def create_dataframe(nct_array, units, data_to_detrend, gmt, variable):
+def get_time_and_gmt(nct_array, units, gmt):
 
-    # proper dates plus additional time axis that is
-    # from 0 to 1 for better sampling performance
+    """ Return the dates, the time scaled to [0, 1], and GMT
+    interpolated to the data calendar, unscaled and scaled. """
 
     ds = pd.to_datetime(
         nct_array, unit="D", origin=pd.Timestamp(units.lstrip("days since"))
@@ -61,6 +101,11 @@ def create_dataframe(nct_array, units, data_to_detrend, gmt, variable):
     f_scale = c.mask_and_scale["gmt"][0]
     gmt_scaled, _, _ = f_scale(gmt_on_data_cal, "gmt")
 
+    return ds, t_scaled, gmt_on_data_cal, gmt_scaled
+
+
+def scale_data(data_to_detrend, variable):
+
     c.check_bounds(data_to_detrend, variable)
     try:
         f_scale = c.mask_and_scale[variable][0]
@@ -72,7 +117,16 @@ def create_dataframe(nct_array, units, data_to_detrend, gmt, variable):
         )
         raise error
 
-    y_scaled, datamin, scale = f_scale(pd.Series(data_to_detrend), variable)
+    return f_scale(pd.Series(data_to_detrend), variable)
+
+
+def create_dataframe(nct_array, units, data_to_detrend, gmt, variable):
+
+    # proper dates plus additional time axis that is
+    # from 0 to 1 for better sampling performance
+
+    ds, t_scaled, gmt_on_data_cal, gmt_scaled = get_time_and_gmt(nct_array, units, gmt)
+    y_scaled, datamin, scale = scale_data(data_to_detrend, variable)
 
     tdf = pd.DataFrame(
         {
@@ -90,7 +144,280 @@ def create_dataframe(nct_array, units, data_to_detrend, gmt, variable):
     return tdf, datamin, scale
 
 
-def create_ref_df(df, trace_obs, trace_cfact, params):
+class RunContext(object):
+    """ The columns of the per-cell dataframes that are the same for all
+    cells: dates, scaled time, GMT and the Fourier series, including their
+    pos variants scaled to [0, 1]. Computed once per run, so that a cell
+    only adds its own data. """
+
+    def __init__(self, nct_array, units, gmt, modes):
+
+        ds, t_scaled, gmt_on_data_cal, gmt_scaled = get_time_and_gmt(nct_array, units, gmt)
+        frame = pd.DataFrame(
+            {"ds": ds, "t": t_scaled, "gmt": gmt_on_data_cal, "gmt_scaled": gmt_scaled}
+        )
+
+        x_fourier = fourier.get_fourier_valid(frame, modes)
+        columns = list(x_fourier.columns)
+        columns = columns + ["pos" + col for col in columns]
+        # all Fourier series in one contiguous block
+        self.fourier = np.ascontiguousarray(
+            np.concatenate([x_fourier.values, (x_fourier.values + 1) / 2], axis=1)
+        )
+
+        self.ds = ds
+        self.t = frame["t"].values
+        self.gmt = gmt_on_data_cal
+        self.gmt_scaled = gmt_scaled
+        self.frame = pd.concat(
+            [frame, pd.DataFrame(self.fourier, columns=columns, copy=False)], axis=1
+        )
+
+    def create_dataframe(self, data_to_detrend, variable):
+
+        """ Like create_dataframe, but the result already holds the Fourier
+        series. The shared columns are not copied, but point to the data of the
+        context. Only columns that are added are new for each cell. """
+
+        y_scaled, datamin, scale = scale_data(data_to_detrend, variable)
+
+        tdf = self.frame.copy(deep=False)
+        tdf.insert(2, "y", data_to_detrend)
+        tdf.insert(3, "y_scaled", y_scaled)
+        if variable == "pr":
+            tdf["is_dry_day"] = np.isnan(y_scaled)
+
+        return tdf, datamin, scale
+
+
+def read_cells(ncvar, index_lat, index_lon, max_block_bytes=2 ** 30):
+
+    """ Read the full time series of many cells from a (time, lat, lon)
+    netCDF variable in a few large reads instead of one read per cell.
+    Reads blocks of whole time chunks over lat bands that contain the cells,
+    and keeps only the cells. A block is at most max_block_bytes large.
+    Returns an array of shape (ncells, ntime) with NaN for masked values. """
+
+    index_lat = np.asarray(index_lat)
+    index_lon = np.asarray(index_lon)
+    ntime = ncvar.shape[0]
+    chunking = ncvar.chunking()
+    tchunk = chunking[0] if isinstance(chunking, list) else min(ntime, 1000)
+    lon_span = index_lon.max() - index_lon.min() + 1
+    lat_span = index_lat.max() - index_lat.min() + 1
+
+    rows_per_band = int(min(lat_span, max(1, max_block_bytes // (4 * tchunk * lon_span))))
+    tblock = tchunk * max(1, max_block_bytes // (4 * tchunk * rows_per_band * lon_span))
+
+    # split the rows with cells into bands of at most rows_per_band rows
+    bands = []
+    for row in np.unique(index_lat):
+        if len(bands) == 0 or row >= bands[-1][0] + rows_per_band:
+            bands.append([row, row + 1])
+        else:
+            bands[-1][1] = row + 1
+
+    data = np.empty((len(index_lat), ntime), dtype=np.float32)
+    TIME0 = datetime.now()
+    for t0 in range(0, ntime, tblock):
+        t1 = min(t0 + tblock, ntime)
+        for lat0, lat1 in bands:
+            in_band = (index_lat >= lat0) & (index_lat < lat1)
+            lon0 = index_lon[in_band].min()
+            lon1 = index_lon[in_band].max() + 1
+            block = np.ma.filled(
+                ncvar[t0:t1, lat0:lat1, lon0:lon1].astype(np.float32), np.nan
+            )
+            data[in_band, t0:t1] = block[
+                :, index_lat[in_band] - lat0, index_lon[in_band] - lon0
+            ].T
+
+    print(
+        "Read {0} cells in {1} bands and {2} time blocks in {3:.1f} seconds.".format(
+            len(index_lat),
+            len(bands),
+            int(np.ceil(ntime / tblock)),
+            (datetime.now() - TIME0).total_seconds(),
+        )
+    )
+    return data
+
+
+def get_cellstore_path(input_file):
+
+    """ The cell store of an input file lives next to it. """
+
+    return pathlib.Path(input_file).with_suffix(".cells")
+
+
+def get_output_store_path(settings):
+
+    """ The cell store that takes the output with storage_format ".cells". """
+
+    return get_cellstore_path(settings.output_dir / "cfact" / settings.variable / settings.cfact_file)
+
+
+def netcdf_column(name, variable):
+
+    """ The column of the per-cell dataframe that is reported as name
+    in report_to_netcdf. """
+
+    return {variable: "cfact", variable + "_orig": "y"}.get(name, name)
+
+
+class CellStore(object):
+    """ Time series of land cells, stored cell-major as (ncells, ntime) float32
+    arrays in a directory, one .npy file per variable. The full time series
+    of a cell is one contiguous slice of a memory map, so reading it touches
+    only its own bytes. Masked values are NaN.
+    Holds the input when created by preprocessing/create_cellstore.py, and the
+    output of the estimation with storage_format ".cells". Then, many processes
+    write their cells into the preallocated arrays at the same time, each only
+    to the bytes of its own cells. A flag per cell records which cells are written.
+    """
+
+    def __init__(self, store_dir, mode="r"):
+
+        self.store_dir = pathlib.Path(store_dir)
+        with open(self.store_dir / "meta.json") as f:
+            meta = json.load(f)
+        self.variable = meta["variable"]
+        self.variables = meta["variables"]
+        self.time_units = meta["time_units"]
+        self.time = np.load(self.store_dir / "time.npy")
+        self.lats = np.load(self.store_dir / "lat.npy")
+        self.lons = np.load(self.store_dir / "lon.npy")
+        self.cells = pd.read_csv(self.store_dir / "cells.csv")
+        self.rows = {
+            (i, j): k
+            for k, (i, j) in enumerate(zip(self.cells["index_lat"], self.cells["index_lon"]))
+        }
+        self.arrays = {
+            name: np.load(self.store_dir / (name + ".npy"), mmap_mode=mode)
+            for name in self.variables + ["written"]
+        }
+        # file descriptors for positioned writes, opened on first write
+        self.fds = {}
+
+    @property
+    def data(self):
+        return self.arrays[self.variable]
+
+    @property
+    def written(self):
+        return self.arrays["written"]
+
+    def get(self, index_lat, index_lon, name=None):
+
+        """ Return the time series of a cell as a view on the memory map. """
+
+        name = self.variable if name is None else name
+        return self.arrays[name][self.rows[(index_lat, index_lon)]]
+
+    def is_written(self, index_lat, index_lon):
+
+        return bool(self.written[self.rows[(index_lat, index_lon)]])
+
+    def write(self, index_lat, index_lon, values):
+
+        """ Write the time series of one cell, values maps variable names to
+        arrays. Uses positioned writes to the rows of the cell only, so that
+        other processes can write other cells at the same time. The cell is
+        flagged as written last. """
+
+        row = self.rows[(index_lat, index_lon)]
+        for name, ts in values.items():
+            array = self.arrays[name]
+            ts = np.ascontiguousarray(ts, dtype=np.float32)
+            self.pwrite(name, ts.tobytes(), array.offset + row * ts.nbytes)
+        self.pwrite("written", b"\x01", self.written.offset + row)
+
+    def pwrite(self, name, data, offset):
+
+        if name not in self.fds:
+            self.fds[name] = os.open(self.store_dir / (name + ".npy"), os.O_WRONLY)
+        os.pwrite(self.fds[name], data, offset)
+
+    def close(self):
+
+        for fd in self.fds.values():
+            os.close(fd)
+        self.fds = {}
+
+    @staticmethod
+    def create(store_dir, variable, cells, time, time_units, lats, lons, variables=None):
+
+        """ Create an empty store for the cells in the cells dataframe,
+        which needs the columns of get_cell_specs. variables defaults to
+        variable only. The arrays are allocated, but not filled.
+        The store is created under a temporary name and renamed, so that
+        processes that create it at the same time get the same store. """
+
+        variables = [variable] if variables is None else list(variables)
+        store_dir = pathlib.Path(store_dir)
+        tmp_dir = store_dir.with_name(store_dir.name + ".tmp" + str(os.getpid()))
+        tmp_dir.mkdir(parents=True)
+        np.save(tmp_dir / "time.npy", np.asarray(time))
+        np.save(tmp_dir / "lat.npy", np.asarray(lats))
+        np.save(tmp_dir / "lon.npy", np.asarray(lons))
+        cells.to_csv(tmp_dir / "cells.csv", index=False)
+        with open(tmp_dir / "meta.json", "w") as f:
+            json.dump(
+                {"variable": variable, "variables": variables, "time_units": time_units}, f
+            )
+        for name in variables:
+            np.lib.format.open_memmap(
+                tmp_dir / (name + ".npy"),
+                mode="w+",
+                dtype=np.float32,
+                shape=(len(cells), len(time)),
+            )
+        np.lib.format.open_memmap(
+            tmp_dir / "written.npy", mode="w+", dtype=np.uint8, shape=(len(cells),)
+        )
+        try:
+            os.rename(tmp_dir, store_dir)
+        except OSError:
+            # created by another process meanwhile
+            shutil.rmtree(tmp_dir)
+        return CellStore(store_dir, mode="r+")
+
+
+def open_output_store(settings, cells, time, time_units, lats, lons):
+
+    """ Open the output store of a run, create it if it does not exist. """
+
+    store_dir = get_output_store_path(settings)
+    if not store_dir.exists():
+        store_dir.parent.mkdir(parents=True, exist_ok=True)
+        CellStore.create(
+            store_dir,
+            settings.variable,
+            cells,
+            time,
+            time_units,
+            lats,
+            lons,
+            variables=settings.report_to_netcdf,
+        )
+        print("Created output store", store_dir)
+    return CellStore(store_dir)
+
+
+def save_to_store(store, df_with_cfact, index_lat, index_lon, names):
+
+    store.write(
+        index_lat,
+        index_lon,
+        {name: df_with_cfact[netcdf_column(name, store.variable)].values for name in names},
+    )
+
+
+def create_ref_df(df, trace_obs, trace_cfact, params, band=None):
+
+    """ Posterior means of the parameters, factual and counterfactual (_ref).
+    With band as (lower, upper) quantiles, for example (0.05, 0.95), their
+    quantiles over the samples are added as columns like mu_q05, mu_ref_q95. """
 
     df_params = pd.DataFrame(index=df.index)
     df_params.index = df["ds"]
@@ -98,6 +425,12 @@ def create_ref_df(df, trace_obs, trace_cfact, params):
     for p in params:
         df_params.loc[:, p] = trace_obs[p].mean(axis=0)
         df_params.loc[:, f'{p}_ref'] = trace_cfact[p].mean(axis=0)
+    if band is not None:
+        for p in params:
+            for q in band:
+                suffix = "_q{0:02.0f}".format(100 * q)
+                df_params.loc[:, p + suffix] = np.quantile(trace_obs[p], q, axis=0)
+                df_params.loc[:, p + "_ref" + suffix] = np.quantile(trace_cfact[p], q, axis=0)
 
     return df_params
 
@@ -136,9 +469,84 @@ def test_if_data_valid_exists(fname):
         pd.read_hdf(fname)
     elif ".csv" in str(fname):
         pd.read_csv(fname)
+    elif ".npz" in str(fname):
+        read_npz(fname)
     else:
         raise ValueError
 
+
+def get_time_axis_path(fname):
+
+    """ The time axis shared by the .npz cell files of a variable, in
+    output_dir/timeseries/<variable>. """
+
+    return pathlib.Path(fname).parent.parent / "ds.npy"
+
+
+def save_npz(df_with_cfact, fname):
+
+    """ Save a cell as compressed .npz with one float32 array per column.
+    Other columns keep their type. A ds column is stored once per variable
+    in the shared time axis, which is taken from the first cell that has the
+    full index 0, 1, 2, ... Cells with another index keep their index and
+    their own ds column. Without a ds column, no time axis is needed. """
+
+    index = df_with_cfact.index.values
+    full_index = np.array_equal(index, np.arange(len(index)))
+    shared_ds = full_index and "ds" in df_with_cfact.columns
+    time_axis_path = get_time_axis_path(fname)
+    if shared_ds and not time_axis_path.exists():
+        # atomically, as other tasks may do the same
+        tmp_path = time_axis_path.with_suffix(".npy." + str(os.getpid()))
+        with open(tmp_path, "wb") as f:
+            np.save(f, df_with_cfact["ds"].values.astype("datetime64[ns]"))
+        os.replace(tmp_path, time_axis_path)
+    elif shared_ds:
+        ntime = np.load(time_axis_path, mmap_mode="r").shape[0]
+        if ntime != len(index):
+            raise ValueError(
+                f"Cell {fname} has {len(index)} time steps, the time axis "
+                f"{time_axis_path} has {ntime}."
+            )
+
+    arrays = {}
+    for column in df_with_cfact.columns:
+        if column == "ds" and shared_ds:
+            continue
+        values = df_with_cfact[column].values
+        arrays[column] = values.astype(np.float32) if values.dtype.kind == "f" else values
+    if not full_index:
+        arrays["__index__"] = index
+    arrays["__columns__"] = np.array(df_with_cfact.columns, dtype=str)
+    np.savez_compressed(fname, **arrays)
+
+
+def read_npz(fname, columns=None):
+
+    """ Read a cell saved with save_npz as dataframe, or only the given
+    columns as a dict of arrays. The shared time axis is only read for
+    cells saved with a ds column, ValueError if it does not match the cell. """
+
+    with np.load(fname) as npz:
+        if columns is not None:
+            return {column: npz[column] for column in columns}
+        all_columns = [str(column) for column in npz["__columns__"]]
+        data = {column: npz[column] for column in all_columns if column in npz.files}
+        index = npz["__index__"] if "__index__" in npz.files else None
+
+    if "ds" in all_columns and "ds" not in data:
+        time_axis_path = get_time_axis_path(fname)
+        ds = np.load(time_axis_path)
+        ntime = len(next(iter(data.values()))) if len(data) > 0 else len(ds)
+        if len(ds) != ntime:
+            raise ValueError(
+                f"Cell {fname} has {ntime} time steps, the time axis "
+                f"{time_axis_path} has {len(ds)}."
+            )
+        data["ds"] = ds
+    return pd.DataFrame(data, index=index, columns=all_columns)
+
+
 def save_to_disk(df_with_cfact, fname, lat, lon, storage_format):
 
     # outdir_for_cell = make_cell_output_dir(
@@ -153,7 +561,9 @@ def save_to_disk(df_with_cfact, fname, lat, lon, storage_format):
         df_with_cfact.to_csv(fname)
     elif storage_format == ".h5":
         df_with_cfact.to_hdf(fname, "lat_" + str(lat) + "_lon_" + str(lon), mode="w")
+    elif storage_format == ".npz":
+        save_npz(df_with_cfact, fname)
     else:
-        raise NotImplementedError("choose storage format .h5 or csv.")
+        raise NotImplementedError("choose storage format .h5, .csv or .npz.")
 
     print("Saved timeseries to ", fname)
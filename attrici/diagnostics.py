@@ -0,0 +1,268 @@
+import numpy as np
+import netCDF4 as nc
+from datetime import datetime
+
+# Annual means, monthly means and linear trends of merged files, computed in
+# one pass over time slabs of whole fields. They replace the cdo yearmean,
+# monmean and trend calls and can be fed from the slabs while merging.
+
+
+def create_file(path, variables, lats, lons, attributes, fill_value, time=None):
+
+    """ Create a netCDF file with fields of variables, with an unlimited
+    time dimension if time is given as (units, calendar). """
+
+    ds = nc.Dataset(path, "w", format="NETCDF4")
+    dims = ("lat", "lon")
+    if time is not None:
+        ds.createDimension("time", None)
+        times = ds.createVariable("time", "f8", ("time",))
+        times.units, times.calendar = time
+        dims = ("time",) + dims
+    ds.createDimension("lat", len(lats))
+    ds.createDimension("lon", len(lons))
+    latitudes = ds.createVariable("lat", "f8", ("lat",))
+    longitudes = ds.createVariable("lon", "f8", ("lon",))
+    latitudes.units = "degree_north"
+    latitudes.standard_name = "latitude"
+    longitudes.units = "degree_east"
+    longitudes.standard_name = "longitude"
+    latitudes[:] = lats
+    longitudes[:] = lons
+    for var in variables:
+        ncvar = ds.createVariable(var, "f4", dims, zlib=True, fill_value=fill_value)
+        for key, att in attributes.get(var, {}).items():
+            if key != "_FillValue":
+                ncvar.setncattr(key, att)
+    return ds
+
+
+class PeriodMean(object):
+    """ Means over consecutive periods of time steps, like years or months.
+    A period is written to the file as soon as the next one starts, so only
+    the sums of one period are held. The time of a mean is the mean time of
+    its steps. """
+
+    def __init__(self, ds, variables, periods, time_values, fill_value):
+
+        self.ds = ds
+        self.variables = variables
+        # one label per time step, non-decreasing
+        self.periods = periods
+        self.time_values = time_values
+        self.fill_value = fill_value
+        self.current = None
+        self.index = 0
+
+    def add(self, t0, slab, valid):
+
+        periods = self.periods[t0:t0 + slab.shape[1]]
+        time_values = self.time_values[t0:t0 + slab.shape[1]]
+        for period in np.unique(periods):
+            in_period = periods == period
+            if period != self.current:
+                self.flush()
+                self.current = period
+                self.sum = np.zeros((slab.shape[0],) + slab.shape[2:])
+                self.count = np.zeros(self.sum.shape, dtype=np.int64)
+                self.times = []
+            self.sum += np.where(valid[:, in_period], slab[:, in_period], 0).sum(
+                axis=1, dtype=np.float64
+            )
+            self.count += valid[:, in_period].sum(axis=1)
+            self.times.extend(time_values[in_period])
+
+    def flush(self):
+
+        if self.current is None:
+            return
+        mean = np.full(self.sum.shape, self.fill_value, dtype=np.float32)
+        np.divide(self.sum, self.count, out=mean, where=self.count > 0, casting="unsafe")
+        self.ds.variables["time"][self.index] = np.mean(self.times)
+        for k, var in enumerate(self.variables):
+            self.ds.variables[var][self.index, :, :] = mean[k]
+        self.index += 1
+        self.current = None
+
+
+class LinearTrend(object):
+    """ Least squares fit of a + b * t per cell, with t the time values of
+    the file, from sums that are accumulated over time slabs. Like cdo trend,
+    only the valid time steps of a cell are used. """
+
+    def __init__(self, nvariables, shape, time_values):
+
+        self.time_values = time_values
+        # sums of time relative to the first step, for numerical accuracy
+        self.t_ref = time_values[0]
+        self.sums = {
+            key: np.zeros((nvariables,) + shape) for key in ["n", "t", "tt", "x", "xt"]
+        }
+
+    def add(self, t0, slab, valid):
+
+        t = (self.time_values[t0:t0 + slab.shape[1]] - self.t_ref)[None, :, None, None]
+        x = np.where(valid, slab, 0).astype(np.float64)
+        self.sums["n"] += valid.sum(axis=1)
+        self.sums["t"] += (valid * t).sum(axis=1)
+        self.sums["tt"] += (valid * t ** 2).sum(axis=1)
+        self.sums["x"] += x.sum(axis=1)
+        self.sums["xt"] += (x * t).sum(axis=1)
+
+    def result(self, fill_value):
+
+        """ Intercept at time value 0 and slope per time unit, fill_value
+        where less than two valid steps. """
+
+        n, t, tt, x, xt = [self.sums[key] for key in ["n", "t", "tt", "x", "xt"]]
+        denominator = n * tt - t ** 2
+        fitted = (n >= 2) & (denominator > 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            slope = (n * xt - t * x) / denominator
+            intercept = (x - slope * t) / n - slope * self.t_ref
+        return (
+            np.where(fitted, intercept, fill_value).astype(np.float32),
+            np.where(fitted, slope, fill_value).astype(np.float32),
+        )
+
+
+class Diagnostics(object):
+    """ Annual means, optionally monthly means, and linear trends of the
+    variables of a merged file, fed with time slabs in order of time.
+    Writes <basename>_yearmean.nc4 and <basename>_monmean.nc4 while fed,
+    and the intercepts and slopes to <basename>_trend_1.nc4 and
+    <basename>_trend_2.nc4 on close, named like the cdo output.
+    With difference = (factual, counterfactual), the trend files also hold
+    the trend of factual minus counterfactual as <factual>_minus_<counterfactual>.
+    """
+
+    def __init__(
+        self,
+        basename,
+        variables,
+        time_values,
+        time_units,
+        calendar,
+        lats,
+        lons,
+        attributes,
+        fill_value,
+        monthly=False,
+        difference=None,
+    ):
+
+        self.basename = basename
+        self.variables = variables
+        self.lats, self.lons = lats, lons
+        self.attributes = attributes
+        self.fill_value = fill_value
+        self.difference = difference
+        time_values = np.asarray(time_values, dtype=np.float64)
+        dates = nc.num2date(time_values, time_units, calendar)
+        years = np.array([date.year for date in dates])
+        months = np.array([date.month for date in dates])
+
+        self.means = []
+        kinds = [("yearmean", years)]
+        if monthly:
+            kinds.append(("monmean", years * 12 + months - 1))
+        for kind, periods in kinds:
+            ds = create_file(
+                basename + "_" + kind + ".nc4",
+                variables,
+                lats,
+                lons,
+                attributes,
+                fill_value,
+                time=(time_units, calendar),
+            )
+            self.means.append(PeriodMean(ds, variables, periods, time_values, fill_value))
+        self.trend = LinearTrend(len(variables), (len(lats), len(lons)), time_values)
+        self.time_units = time_units
+
+    def add(self, t0, slab):
+
+        """ Add a slab of shape (nvariables, time, nlat, nlon) that starts at
+        time step t0. Values that are not finite or fill_value are missing. """
+
+        valid = np.isfinite(slab) & (slab != self.fill_value)
+        for mean in self.means:
+            mean.add(t0, slab, valid)
+        self.trend.add(t0, slab, valid)
+
+    def close(self):
+
+        for mean in self.means:
+            mean.flush()
+            print("Wrote", mean.ds.filepath())
+            mean.ds.close()
+
+        intercept, slope = self.trend.result(self.fill_value)
+        variables = list(self.variables)
+        if self.difference is not None:
+            factual, counterfactual = [self.variables.index(var) for var in self.difference]
+            missing = (intercept[factual] == self.fill_value) | (
+                intercept[counterfactual] == self.fill_value
+            )
+            difference = [
+                np.where(missing, self.fill_value, values[factual] - values[counterfactual])
+                for values in (intercept, slope)
+            ]
+            intercept = np.concatenate([intercept, difference[0][None]])
+            slope = np.concatenate([slope, difference[1][None]])
+            variables.append(self.difference[0] + "_minus_" + self.difference[1])
+
+        for number, values, description in [
+            (1, intercept, "intercept of linear trend at time 0 of " + self.time_units),
+            (2, slope, "slope of linear trend per time unit of " + self.time_units),
+        ]:
+            ds = create_file(
+                self.basename + "_trend_" + str(number) + ".nc4",
+                variables,
+                self.lats,
+                self.lons,
+                self.attributes,
+                self.fill_value,
+            )
+            ds.setncattr("description", description)
+            for k, var in enumerate(variables):
+                ds.variables[var][:, :] = values[k]
+            print("Wrote", ds.filepath())
+            ds.close()
+
+
+def diagnose_file(ncfile, variables, basename, monthly=False, difference=None, slab_time=30):
+
+    """ Compute the diagnostics of a merged file in one pass over blocks of
+    slab_time time steps. """
+
+    TIME0 = datetime.now()
+    ds = nc.Dataset(ncfile, "r")
+    times = ds.variables["time"]
+    fill_value = ds.variables[variables[0]]._FillValue
+    diagnostics = Diagnostics(
+        basename,
+        variables,
+        times[:],
+        times.units,
+        getattr(times, "calendar", "standard"),
+        ds.variables["lat"][:],
+        ds.variables["lon"][:],
+        {var: ds.variables[var].__dict__ for var in variables},
+        fill_value,
+        monthly,
+        difference,
+    )
+    for t0 in range(0, len(times), slab_time):
+        slab = np.stack(
+            [
+                np.ma.filled(ds.variables[var][t0:t0 + slab_time, :, :], np.nan)
+                for var in variables
+            ]
+        )
+        diagnostics.add(t0, slab)
+    diagnostics.close()
+    ds.close()
+    print(
+        "Diagnostics took {0:.1f} minutes.".format((datetime.now() - TIME0).total_seconds() / 60)
+    )
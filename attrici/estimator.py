@@ -1,13 +1,20 @@
 import os
+import collections
 import numpy as np
 import pandas as pd
 import pymc3 as pm
 from datetime import datetime
+from scipy import optimize
+from pymc3.blocking import ArrayOrdering, DictToArrayBijection
+from pymc3.util import get_default_varnames
 
 import attrici.datahandler as dh
 import attrici.const as c
 import attrici.models as models
 import attrici.fourier as fourier
+import attrici.counterfactual as counterfactual
+import attrici.posterior as posterior
+import attrici.paramstore as paramstore
 import pickle
 
 model_for_var = {
@@ -24,6 +31,14 @@ model_for_var = {
 }
 
 
+def length_bucket(n_valid):
+
+    """ Group cells with a similar number of valid data points, so that
+    one compiled model serves all of them. """
+
+    return int(np.ceil(np.log2(max(n_valid, 1))))
+
+
 class estimator(object):
     def __init__(self, cfg):
 
@@ -41,11 +56,38 @@ class estimator(object):
         self.save_trace = cfg.save_trace
         self.report_variables = cfg.report_variables
         self.inference = cfg.inference
+        self.approximation_draws = cfg.approximation_draws
+        self.advi_method = cfg.advi_method
+        self.advi_batch_size = cfg.advi_batch_size
+        self.advi_max_iterations = cfg.advi_max_iterations
+        self.advi_tolerance = cfg.advi_tolerance
+        self.uncertainty_band = cfg.uncertainty_band
         self.startdate = cfg.startdate
+        self.engine = cfg.engine
+        self.warm_start = cfg.warm_start
+        self.warm_start_distance = cfg.warm_start_distance
+        self.warm_start_tune = cfg.warm_start_tune
+        # weights, and NUTS step size and mass matrix, of the cells fitted by
+        # this estimator, keyed by (lat, lon), see get_warm_start
+        self.fitted = {}
+        # keys of self.fitted and of the parameter store cache, bucketed by
+        # cells of warm_start_distance degrees, see index_fit
+        self.fit_index = collections.defaultdict(list)
+        self.store_indexed = False
+        # compiled models, reused across grid cells through pm.set_data
+        self.compiled_models = {}
+        if cfg.map_estimate and cfg.param_store:
+            self.param_store = paramstore.get_param_store(cfg)
+        else:
+            self.param_store = None
+        # MAP weights and logp for the parameter store, keyed by (lat, lon),
+        # see pop_weights
+        self.new_weights = {}
 
         try:
             #TODO remove modes from initialization
             self.statmodel = model_for_var[self.variable](self.modes)
+            self.logposterior = posterior.posterior_for_var[self.variable](self.modes)
 
         except KeyError as error:
             print(
@@ -53,32 +95,223 @@ class estimator(object):
             )
             raise error
 
-    def estimate_parameters(self, df, lat, lon, map_estimate):
-        x_fourier = fourier.get_fourier_valid(df, self.modes)
-        x_fourier_01 = (x_fourier + 1) / 2
-        x_fourier_01.columns = ["pos" + col for col in x_fourier_01.columns]
+    def prepare_dataframe(self, df):
+
+        if "mode_0_0" in df.columns:
+            # the Fourier series come with the dataframe, see dh.RunContext
+            dff = df
+        else:
+            x_fourier = fourier.get_fourier_valid(df, self.modes)
+            x_fourier_01 = (x_fourier + 1) / 2
+            x_fourier_01.columns = ["pos" + col for col in x_fourier_01.columns]
+            dff = pd.concat([df, x_fourier, x_fourier_01], axis=1)
 
-        dff = pd.concat([df, x_fourier, x_fourier_01], axis=1)
         df_subset = dh.get_subset(dff, self.subset, self.seed, self.startdate)
 
-        self.model = self.statmodel.setup(df_subset)
+        return dff, df_subset
+
+    def save_map_trace(self, trace, outdir_for_cell, lat, lon):
+
+        if self.param_store is not None:
+            self.keep_weights(
+                [lat], [lon], self.logposterior.from_dict(trace), [trace.get("logp", np.nan)]
+            )
+            return
+
+        with open(outdir_for_cell, 'wb') as handle:
+            free_params = {key: value for key, value in trace.items()
+                           if key.startswith('weights') or key=='logp'}
+            pickle.dump(free_params, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def keep_weights(self, lats, lons, theta, logp):
+
+        """ Keep weights for the parameter store until pop_weights. """
+
+        for lat, lon, theta_cell, logp_cell in zip(lats, lons, theta, logp):
+            self.new_weights[(lat, lon)] = (np.asarray(theta_cell), float(logp_cell))
+            if self.store_indexed:
+                self.index_fit(lat, lon)
+        self.param_store.remember(lats, lons, theta, logp)
+
+    def pop_weights(self, lat, lon):
+
+        """ The new weights and logp of a cell for the parameter store, None
+        if there are none. The caller writes them to the store. """
+
+        return self.new_weights.pop((lat, lon), None)
+
+    def get_trace_path(self, lat, lon):
+
+        """ The pickle or trace directory of a cell in traces,
+        None if the weights go to the parameter store. """
+
+        if self.param_store is not None:
+            return None
+        return dh.make_cell_output_dir(self.output_dir, "traces", lat, lon, self.variable)
+
+    def load_map_trace(self, outdir_for_cell, lat, lon):
+
+        """ Return the saved MAP weights of a cell. Raises if there are none. """
+
+        if self.param_store is not None:
+            stored = self.param_store.get(lat, lon)
+            if stored is None:
+                raise KeyError(f"No weights for lat {lat}, lon {lon} in parameter store")
+            return self.logposterior.to_dict(*stored)
+
+        with open(outdir_for_cell, 'rb') as handle:
+            return pickle.load(handle)
+
+    def has_map_trace(self, outdir_for_cell, lat, lon):
+
+        if self.param_store is not None:
+            return self.param_store.get(lat, lon) is not None
+        return outdir_for_cell.exists()
+
+    def index_fit(self, lat, lon):
 
-        outdir_for_cell = dh.make_cell_output_dir(
-            self.output_dir, "traces", lat, lon, self.variable
+        bucket = (lat // self.warm_start_distance, lon // self.warm_start_distance)
+        if (lat, lon) not in self.fit_index[bucket]:
+            self.fit_index[bucket].append((lat, lon))
+
+    def get_warm_start(self, lat, lon):
+
+        """ The fit of the nearest other cell within warm_start_distance
+        degrees, from the cells fitted by this estimator and the parameter
+        store. A dict with the weights theta and, after NUTS, step_size and
+        the diagonal of the mass matrix. None without warm_start or if there
+        is no such cell. Only the buckets of fit_index in reach are searched. """
+
+        if not self.warm_start:
+            return None
+        if self.param_store is not None and not self.store_indexed:
+            # loads the store on first use
+            self.param_store.get(lat, lon)
+            for key in self.param_store.cache:
+                self.index_fit(*key)
+            self.store_indexed = True
+
+        # longitudes are closer towards the poles
+        d = self.warm_start_distance
+        cos_lat = max(np.cos(np.deg2rad(min(abs(lat) + d, 90.0))), d / 360.0)
+        i, j = lat // d, lon // d
+        nlon = int(np.ceil(1.0 / cos_lat))
+        keys = [
+            key
+            for di in (-1, 0, 1)
+            for dj in range(-nlon, nlon + 1)
+            for key in self.fit_index.get((i + di, j + dj), [])
+            if key != (lat, lon)
+        ]
+        if len(keys) == 0:
+            return None
+
+        coords = np.array(keys)
+        distance = np.hypot(
+            coords[:, 0] - lat, (coords[:, 1] - lon) * np.cos(np.deg2rad(lat))
         )
-        if map_estimate:
+        nearest = distance.argmin()
+        if distance[nearest] > d:
+            return None
+        print("Warm start from the fit at", keys[nearest])
+        if keys[nearest] in self.fitted:
+            return self.fitted[keys[nearest]]
+        return {"theta": self.param_store.cache[keys[nearest]][0]}
+
+    def remember_fit(self, lat, lon, trace, **nuts_adaptation):
+
+        if self.warm_start:
+            theta = self.logposterior.from_dict(trace).mean(axis=0)
+            self.fitted[(lat, lon)] = dict(theta=theta, **nuts_adaptation)
+            self.index_fit(lat, lon)
+
+    def estimate_parameters_batch(self, dfs, lats, lons):
+
+        """ Find the MAP weights for many grid cells in one vectorized
+        optimization, see posterior.find_map_batch. Cells with a saved
+        trace are left out, as are cells that did not converge. For these,
+        None is returned and estimate_parameters handles them cell by cell. """
+
+        traces = [None] * len(dfs)
+        todo = [
+            k
+            for k, (lat, lon) in enumerate(zip(lats, lons))
+            if not self.has_map_trace(self.get_trace_path(lat, lon), lat, lon)
+        ]
+
+        if len(todo) == 0:
+            return traces
+
+        TIME0 = datetime.now()
+        post = self.logposterior
+        df_subsets = [self.prepare_dataframe(dfs[k])[1] for k in todo]
+        design = posterior.get_design(df_subsets[0])
+        y = np.column_stack([df_subset["y_scaled"].values for df_subset in df_subsets])
+
+        theta0 = None
+        if self.warm_start:
+            theta0 = np.zeros((len(todo), post.size))
+            for i, k in enumerate(todo):
+                warm_start = self.get_warm_start(lats[k], lons[k])
+                if warm_start is not None:
+                    theta0[i] = warm_start["theta"]
+        theta, _, converged = posterior.find_map_batch(post, design, y, theta0=theta0)
+        # reported as the logp Deterministic of the models
+        logp = post.prior_logp(theta)
+
+        for i, k in enumerate(todo):
+            if not converged[i]:
+                print("Batch MAP did not converge at", lats[k], lons[k], ". Fit cell alone.")
+                continue
+            traces[k] = post.to_dict(theta[i], logp[i])
+            self.remember_fit(lats[k], lons[k], traces[k])
+            if self.save_trace and self.param_store is None:
+                self.save_map_trace(
+                    traces[k], self.get_trace_path(lats[k], lons[k]), lats[k], lons[k]
+                )
+
+        if self.save_trace and self.param_store is not None:
+            done = [i for i in range(len(todo)) if converged[i]]
+            self.keep_weights(
+                [lats[todo[i]] for i in done],
+                [lons[todo[i]] for i in done],
+                theta[done],
+                logp[done],
+            )
+
+        print(
+            "Batch MAP for {0} cells took {1:.0f} seconds.".format(
+                len(todo), (datetime.now() - TIME0).total_seconds()
+            )
+        )
+        return traces
+
+    def estimate_parameters(self, df, lat, lon, map_estimate, trace=None):
+
+        dff, df_subset = self.prepare_dataframe(df)
+
+        outdir_for_cell = self.get_trace_path(lat, lon)
+        # the Laplace and ADVI approximations start from the MAP
+        gaussian = self.is_gaussian(map_estimate)
+        if map_estimate and trace is not None:
+            print("Use MAP estimate from batch estimation.")
+        elif map_estimate or gaussian:
             try:
-                with open(outdir_for_cell, 'rb') as handle:
-                    trace = pickle.load(handle)
+                trace = self.load_map_trace(outdir_for_cell, lat, lon)
             except Exception as e:
                 print("Problem with saved trace:", e, ". Redo parameter estimation.")
-                trace = pm.find_MAP(model=self.model)
+                warm_start = self.get_warm_start(lat, lon)
+                if self.engine == "numpy":
+                    trace = self.find_map_numpy(df_subset, warm_start)
+                else:
+                    trace = self.find_map(self.get_compiled_model(df_subset), warm_start)
+                self.remember_fit(lat, lon, trace)
                 if self.save_trace:
-                    with open(outdir_for_cell, 'wb') as handle:
-                        free_params = {key: value for key, value in trace.items()
-                                       if key.startswith('weights') or key=='logp'}
-                        pickle.dump(free_params, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                    self.save_map_trace(trace, outdir_for_cell, lat, lon)
+            if gaussian:
+                trace = self.fit_gaussian(trace, df_subset, self.get_cell_seed(lat, lon))
         else:
+            self.model = self.get_compiled_model(df_subset)["model"]
             # FIXME: Rework loading old traces
             # print("Search for trace in\n", outdir_for_cell)
             # As load_trace does not throw an error when no saved data exists, we here
@@ -98,18 +331,186 @@ class estimator(object):
                 print("Skip this for sampling.")
             except Exception as e:
                 print("Problem with saved trace:", e, ". Redo parameter estimation.")
-                trace = self.sample()
+                trace = self.sample(self.get_warm_start(lat, lon))
+                if self.inference == "NUTS":
+                    self.remember_fit(lat, lon, trace, **self.get_nuts_adaptation(trace))
                 # print(pm.summary(trace))  # takes too much memory
                 if self.save_trace:
                     pm.backends.save_trace(trace, outdir_for_cell, overwrite=True)
 
         return trace, dff
 
-    def sample(self):
+    def get_compiled_model(self, df_subset):
+
+        """ Build and compile the model only once per variable, modes and
+        bucket of valid data length. For all further grid cells, the cell's
+        data is swapped into the pm.Data containers and the compiled logp and
+        gradient functions are kept. """
+
+        n_valid = len(df_subset.dropna(axis=0, how="any"))
+        key = (self.variable, tuple(self.modes), length_bucket(n_valid))
+
+        if key in self.compiled_models:
+            compiled = self.compiled_models[key]
+            self.statmodel.set_data(compiled["model"], df_subset)
+            return compiled
+
+        print("Build and compile model for", key)
+        model = self.statmodel.setup(df_subset)
+        free_vars = model.cont_vars
+        bij = DictToArrayBijection(ArrayOrdering(free_vars), model.test_point)
+        output_vars = get_default_varnames(model.unobserved_RVs, include_transformed=False)
+        compiled = {
+            "model": model,
+            "bij": bij,
+            "logp": bij.mapf(model.fastlogp_nojac),
+            "dlogp": bij.mapf(model.fastdlogp_nojac(free_vars)),
+            "outputs": model.fastfn(output_vars),
+            "output_names": [var.name for var in output_vars],
+        }
+        self.compiled_models[key] = compiled
+        return compiled
+
+    def get_start_point(self, model, warm_start):
+
+        """ The model's test point, with the weights of warm_start if given. """
+
+        point = dict(model.test_point)
+        if warm_start is not None:
+            weights = self.logposterior.to_dict(warm_start["theta"])
+            point.update({name: value for name, value in weights.items() if name in point})
+        return point
+
+    def find_map(self, compiled, warm_start=None, maxeval=5000):
+
+        """ Equivalent to pm.find_MAP with L-BFGS-B, but uses the cached
+        compiled functions instead of compiling new ones for every cell.
+        Starts from the weights of warm_start if given. """
+
+        bij = compiled["bij"]
+        x0 = bij.map(self.get_start_point(compiled["model"], warm_start))
+
+        def cost(x):
+            return -compiled["logp"](x), -compiled["dlogp"](x)
+
+        opt_result = optimize.minimize(
+            cost, x0, method="L-BFGS-B", jac=True, options={"maxfun": maxeval}
+        )
+        if self.progressbar:
+            print("MAP took", opt_result["nit"], "iterations.")
+        point = bij.rmap(opt_result["x"])
+        return dict(zip(compiled["output_names"], compiled["outputs"](point)))
+
+    def find_map_numpy(self, df_subset, warm_start=None):
+
+        """ Find the MAP with the NumPy implementation of the posterior,
+        without Theano. Returns the weights and logp like find_map, with logp
+        as the Deterministic of the models, see posterior.Posterior.prior_logp. """
 
         TIME0 = datetime.now()
+        theta, _ = posterior.find_map(
+            self.logposterior,
+            posterior.get_design(df_subset),
+            df_subset["y_scaled"].values,
+            theta0=None if warm_start is None else warm_start["theta"],
+        )
+        print(
+            "NumPy MAP took {0:.1f} seconds.".format(
+                (datetime.now() - TIME0).total_seconds()
+            )
+        )
+        return self.logposterior.to_dict(theta, self.logposterior.prior_logp(theta)[0])
+
+    def is_gaussian(self, map_estimate):
+
+        """ True if the posterior is approximated by a Normal of the weights,
+        from the Laplace approximation or ADVI. """
+
+        return not map_estimate and self.inference in ["Laplace", "ADVI"]
+
+    def get_cell_seed(self, lat, lon):
 
-        if self.inference == "NUTS":
+        """ The seed of the random draws for a cell, see counterfactual.get_cell_seed. """
+
+        return counterfactual.get_cell_seed(self.seed, lat, lon)
+
+    def fit_gaussian(self, map_trace, df_subset, seed):
+
+        """ Normal approximation of the posterior of the weights, from the
+        Hessian of the NumPy posterior at the MAP, refined by ADVI if chosen.
+        Returns a dict with its mean and scale, see posterior.fit_advi, and
+        the seed of the cell for drawing from it. """
+
+        TIME0 = datetime.now()
+        design = posterior.get_design(df_subset)
+        y = df_subset["y_scaled"].values
+        theta = self.logposterior.from_dict(map_trace)[0]
+        scale = posterior.laplace_approximation(self.logposterior, theta, design, y)
+        if self.inference == "ADVI":
+            fullrank = self.advi_method == "fullrank"
+            if not fullrank:
+                scale = np.diag(np.sqrt((scale ** 2).sum(axis=1)))
+            theta, scale, _ = posterior.fit_advi(
+                self.logposterior,
+                design,
+                y,
+                theta,
+                scale,
+                fullrank=fullrank,
+                batch_size=self.advi_batch_size,
+                max_iterations=self.advi_max_iterations,
+                tolerance=self.advi_tolerance,
+                seed=seed,
+            )
+        print(
+            "{0} approximation took {1:.1f} seconds.".format(
+                self.inference, (datetime.now() - TIME0).total_seconds()
+            )
+        )
+        return {"mean": theta, "scale": scale, "seed": seed}
+
+    def get_nuts_adaptation(self, trace):
+
+        """ Step size and diagonal mass matrix that NUTS ended with, for the
+        warm start of neighbouring cells. The mass matrix is estimated from
+        the posterior variance of the samples, like the adaptation does. """
+
+        bij = DictToArrayBijection(ArrayOrdering(self.model.cont_vars), self.model.test_point)
+        variance = {var.name: trace[var.name].var(axis=0) for var in self.model.cont_vars}
+        return {
+            "step_size": float(np.mean(trace.get_sampler_stats("step_size"))),
+            "mass_diag": bij.map(variance),
+        }
+
+    def sample(self, warm_start=None):
+
+        TIME0 = datetime.now()
+
+        if self.inference == "NUTS" and warm_start is not None and "mass_diag" in warm_start:
+            # start from the neighbour's posterior, step size and mass matrix,
+            # which needs far less tuning than starting from scratch
+            with self.model:
+                start = self.get_start_point(self.model, warm_start)
+                bij = DictToArrayBijection(ArrayOrdering(self.model.cont_vars), start)
+                ndim = len(warm_start["mass_diag"])
+                potential = pm.step_methods.hmc.quadpotential.QuadPotentialDiagAdapt(
+                    ndim, bij.map(start), warm_start["mass_diag"], 10
+                )
+                step = pm.NUTS(
+                    potential=potential,
+                    step_scale=warm_start["step_size"] * ndim ** 0.25,
+                    target_accept=.95,
+                )
+                trace = pm.sample(
+                    draws=self.draws,
+                    step=step,
+                    start=start,
+                    cores=self.cores,
+                    chains=self.chains,
+                    tune=self.warm_start_tune,
+                    progressbar=self.progressbar,
+                )
+        elif self.inference == "NUTS":
             with self.model:
                 trace = pm.sample(
                     draws=self.draws,
@@ -120,14 +521,6 @@ class estimator(object):
                     target_accept=.95
                 )
             # could set target_accept=.95 to get smaller step size if warnings appear
-        elif self.inference == "ADVI":
-            with self.model:
-                mean_field = pm.fit(
-                    n=10000, method="fullrank_advi", progressbar=self.progressbar
-                )
-                # TODO: trace is just a workaround here so the rest of the code understands
-                # ADVI. We could communicate parameters from mean_fied directly.
-                trace = mean_field.sample(1000)
         else:
             raise NotImplementedError
 
@@ -140,18 +533,40 @@ class estimator(object):
 
         return trace
 
-    def estimate_timeseries(self, df, trace, datamin, scale, map_estimate, subtrace=1000):
+    def estimate_timeseries(
+        self, df, trace, datamin, scale, map_estimate, subtrace=1000, seed=None
+    ):
 
         # print(trace["mu"].shape, df.shape)
-        trace_obs, trace_cfact = self.statmodel.resample_missing(
-            trace, df, subtrace, self.model, self.progressbar, map_estimate
-        )
+        weights_only = map_estimate or self.is_gaussian(map_estimate)
+        if self.is_gaussian(map_estimate):
+            # the parameters of weights drawn from the Normal approximation
+            theta = posterior.gaussian_samples(
+                trace["mean"], trace["scale"], self.approximation_draws, trace["seed"]
+            )
+            trace_obs, trace_cfact = self.logposterior.resample_theta(theta, df)
+        elif weights_only:
+            # the parameters are deterministic given the weights,
+            # so no posterior predictive sampling is needed.
+            trace_obs, trace_cfact = self.logposterior.resample(trace, df)
+        else:
+            trace_obs, trace_cfact = self.statmodel.resample_missing(
+                trace, df, subtrace, self.model, self.progressbar
+            )
 
         df_params = dh.create_ref_df(
-            df, trace_obs, trace_cfact, self.statmodel.params
+            df,
+            trace_obs,
+            trace_cfact,
+            self.statmodel.params,
+            None if map_estimate else self.uncertainty_band,
         )
 
-        cfact_scaled = self.statmodel.quantile_mapping(df_params, df["y_scaled"])
+        if self.variable == "pr":
+            # dry days made wet are drawn from the seed of the cell, see get_cell_seed
+            cfact_scaled = self.statmodel.quantile_mapping(df_params, df["y_scaled"], [seed])
+        else:
+            cfact_scaled = self.statmodel.quantile_mapping(df_params, df["y_scaled"])
         print("Done with quantile mapping.")
 
         # fill cfact_scaled as is from quantile mapping
@@ -183,7 +598,7 @@ class estimator(object):
         for v in df_params.columns:
             df.loc[:, v] = df_params.loc[:, v].values
 
-        if map_estimate:
+        if weights_only:
             df.loc[:, "logp"] = trace_obs['logp'].mean(axis=0)
 
         if self.report_variables != "all":
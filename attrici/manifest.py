@@ -0,0 +1,135 @@
+import os
+import time
+import numpy as np
+
+# The run manifest records every finished cell of a variable: its status, the
+# file it was written to with the file size, the runtime and the logp of the
+# fit. Each task appends to its own file in output_dir/manifest/<variable>,
+# one line per cell in a single write, after the cell file is complete.
+# A line that was cut off by a crash is ignored on reading.
+
+FIELDS = [
+    "index_lat",
+    "index_lon",
+    "lat",
+    "lon",
+    "status",
+    "path",
+    "size",
+    "seconds",
+    "logp",
+    "finished",
+]
+
+
+def get_manifest_dir(settings):
+
+    return settings.output_dir / "manifest" / settings.variable
+
+
+def parse_record(line):
+
+    """ A record from a line of a manifest file, None for the header and
+    for incomplete lines. """
+
+    values = line.rstrip("\n").split(",")
+    if not line.endswith("\n") or len(values) != len(FIELDS) or values[0] == FIELDS[0]:
+        return None
+    record = dict(zip(FIELDS, values))
+    try:
+        for key in ["index_lat", "index_lon", "size"]:
+            record[key] = int(record[key])
+        for key in ["lat", "lon", "seconds", "logp", "finished"]:
+            record[key] = float(record[key])
+    except ValueError:
+        return None
+    return record
+
+
+def read_manifest(manifest_dir):
+
+    """ Read the manifest files of all tasks. Returns a dict of the last
+    record of each cell, keyed by (index_lat, index_lon). """
+
+    records = []
+    for manifest_file in sorted(manifest_dir.glob("*.csv")):
+        with open(manifest_file) as f:
+            records.extend(filter(None, (parse_record(line) for line in f)))
+    # a cell may have been run more than once, by different tasks
+    records.sort(key=lambda record: record["finished"])
+    return {(record["index_lat"], record["index_lon"]): record for record in records}
+
+
+class Manifest(object):
+    """ The manifest of a run, read once at start, and the manifest file
+    that this task appends to. Lookups do not touch the file system except
+    for one stat of the cell file. """
+
+    def __init__(self, manifest_dir, name):
+
+        manifest_dir.mkdir(parents=True, exist_ok=True)
+        self.manifest_file = manifest_dir / (name + ".csv")
+        self.cells = read_manifest(manifest_dir)
+        self.fd = None
+
+    def is_done(self, index_lat, index_lon, path=None):
+
+        """ True if the cell was estimated successfully and, if path is
+        given, its file still exists with the recorded size. """
+
+        record = self.cells.get((int(index_lat), int(index_lon)))
+        if record is None or record["status"] != "ok":
+            return False
+        if path is None:
+            return True
+        try:
+            return os.stat(path).st_size == record["size"]
+        except OSError:
+            return False
+
+    def record(self, sp, status, seconds, path=None, logp=np.nan):
+
+        """ Append the record of a finished cell. Call it after the cell
+        file is written completely. """
+
+        if self.fd is None:
+            self.fd = os.open(
+                str(self.manifest_file), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+            )
+            if os.fstat(self.fd).st_size == 0:
+                os.write(self.fd, (",".join(FIELDS) + "\n").encode())
+
+        record = {
+            "index_lat": int(sp["index_lat"]),
+            "index_lon": int(sp["index_lon"]),
+            "lat": float(sp["lat"]),
+            "lon": float(sp["lon"]),
+            "status": status,
+            "path": "" if path is None else str(path),
+            "size": 0 if path is None else os.stat(path).st_size,
+            "seconds": float(seconds),
+            "logp": float(logp),
+            "finished": time.time(),
+        }
+        line = (
+            "{index_lat},{index_lon},{lat!r},{lon!r},{status},{path},{size},"
+            "{seconds:.1f},{logp:.6g},{finished:.3f}\n"
+        ).format(**record)
+        # one write to a file opened for appending, so lines are never interleaved
+        os.write(self.fd, line.encode())
+        self.cells[(record["index_lat"], record["index_lon"])] = record
+
+    def close(self):
+
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def get_logp(df_with_cfact):
+
+    """ Summary of the logp of a fit, nan if it is not reported. """
+
+    if "logp" not in df_with_cfact.columns:
+        return np.nan
+    return float(np.nanmin(df_with_cfact["logp"].values))
@@ -3,6 +3,7 @@ import pymc3 as pm
 from scipy import stats
 import theano.tensor as tt
 import attrici.distributions
+import attrici.counterfactual as counterfactual
 
 
 class Pr(attrici.distributions.BernoulliGamma):
@@ -15,6 +16,21 @@ class Pr(attrici.distributions.BernoulliGamma):
         self.modes = modes
         self.test = False
 
+    def set_data(self, model, df_subset):
+
+        df_valid = df_subset.dropna(axis=0, how="any")
+        pm.set_data(
+            {
+                "gmt": df_subset["gmt_scaled"].values,
+                "xf0": df_subset.filter(regex="^mode_0_").values,
+                "gmtv": df_valid["gmt_scaled"].values,
+                "xf0v": df_valid.filter(regex="^mode_0_").values,
+                "y": df_valid["y_scaled"].values,
+                "is_dry_day": df_subset["is_dry_day"].astype(int).values,
+            },
+            model=model,
+        )
+
     def setup(self, df_subset):
         model = pm.Model()
 
@@ -27,6 +43,8 @@ class Pr(attrici.distributions.BernoulliGamma):
 
             gmtv = pm.Data("gmtv", df_valid["gmt_scaled"].values)
             xf0v = pm.Data("xf0v", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
+            is_dry_day = pm.Data("is_dry_day", df_subset["is_dry_day"].astype(int).values)
 
             covariates = pm.math.concatenate(
                 [
@@ -86,9 +104,9 @@ class Pr(attrici.distributions.BernoulliGamma):
 
             if not self.test:
                 pm.Bernoulli(
-                    "bernoulli", logit_p=logit_pbern, observed=df_subset["is_dry_day"].astype(int)
+                    "bernoulli", logit_p=logit_pbern, observed=is_dry_day
                 )
-                pm.Gamma("obs", mu=mu, sigma=sigma, observed=df_valid["y_scaled"])
+                pm.Gamma("obs", mu=mu, sigma=sigma, observed=y)
         return model
 
 
@@ -110,6 +128,7 @@ class Tas(attrici.distributions.Normal):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
             # mu
 
             weights_longterm_intercept = pm.Normal("weights_longterm_intercept", mu=0, sd=1)
@@ -144,7 +163,7 @@ class Tas(attrici.distributions.Normal):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Normal("obs", mu=mu, sigma=sigma, observed=df_valid["y_scaled"])
+                pm.Normal("obs", mu=mu, sigma=sigma, observed=y)
 
         return model
 
@@ -166,6 +185,7 @@ class Rlds(attrici.distributions.Normal):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
             # mu
 
             weights_longterm_intercept = pm.Normal("weights_longterm_intercept", mu=0, sd=1)
@@ -200,7 +220,7 @@ class Rlds(attrici.distributions.Normal):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Normal("obs", mu=mu, sigma=sigma, observed=df_valid["y_scaled"])
+                pm.Normal("obs", mu=mu, sigma=sigma, observed=y)
 
         return model
 
@@ -222,6 +242,7 @@ class Ps(attrici.distributions.Normal):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
             # mu
 
             weights_longterm_intercept = pm.Normal("weights_longterm_intercept", mu=0, sd=1)
@@ -256,7 +277,7 @@ class Ps(attrici.distributions.Normal):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Normal("obs", mu=mu, sigma=sigma, observed=df_valid["y_scaled"])
+                pm.Normal("obs", mu=mu, sigma=sigma, observed=y)
 
         return model
 
@@ -279,6 +300,7 @@ class Hurs(attrici.distributions.Beta):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
             covariates = pm.math.concatenate(
                 [
                     xf0,
@@ -322,7 +344,7 @@ class Hurs(attrici.distributions.Beta):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Beta("obs", alpha=alpha, beta=beta, observed=df_valid["y_scaled"])
+                pm.Beta("obs", alpha=alpha, beta=beta, observed=y)
 
         return model
 
@@ -338,17 +360,7 @@ class Tasskew(attrici.distributions.Normal):
         self.test = False
 
     def quantile_mapping(self, d, y_scaled):
-        """
-         nan values are not quantile-mapped. 100% humidity happens mainly at the poles.
-        """
-
-        quantile = stats.norm.cdf(y_scaled, loc=d["mu"], scale=d["sigma"])
-        x_mapped = stats.norm.ppf(quantile, loc=d["mu_ref"], scale=d["sigma_ref"])
-
-        x_mapped[x_mapped >= 1] = np.nan
-        x_mapped[x_mapped <= 0] = np.nan
-
-        return x_mapped
+        return counterfactual.normal_in_unit_interval(d, y_scaled)
 
     def setup(self, df_subset):
         model = pm.Model()
@@ -357,6 +369,7 @@ class Tasskew(attrici.distributions.Normal):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
             # mu
 
             weights_longterm_intercept = pm.Normal("weights_longterm_intercept", mu=0, sd=1)
@@ -391,7 +404,7 @@ class Tasskew(attrici.distributions.Normal):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Normal("obs", mu=mu, sigma=sigma, observed=df_valid["y_scaled"])
+                pm.Normal("obs", mu=mu, sigma=sigma, observed=y)
 
         return model
 
@@ -407,16 +420,7 @@ class Rsds(attrici.distributions.Normal):
         self.test = False
 
     def quantile_mapping(self, d, y_scaled):
-        """
-        nan values are not quantile-mapped. 0 rsds happens mainly in the polar night.
-        """
-
-        quantile = stats.norm.cdf(y_scaled, loc=d["mu"], scale=d["sigma"])
-        x_mapped = stats.norm.ppf(quantile, loc=d["mu_ref"], scale=d["sigma_ref"])
-
-        x_mapped[x_mapped <= 0] = np.nan
-
-        return x_mapped
+        return counterfactual.normal_positive(d, y_scaled)
 
     def setup(self, df_subset):
         model = pm.Model()
@@ -425,6 +429,7 @@ class Rsds(attrici.distributions.Normal):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
             # mu
 
             weights_longterm_intercept = pm.Normal("weights_longterm_intercept", mu=0, sd=1)
@@ -459,7 +464,7 @@ class Rsds(attrici.distributions.Normal):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Normal("obs", mu=mu, sigma=sigma, observed=df_valid["y_scaled"])
+                pm.Normal("obs", mu=mu, sigma=sigma, observed=y)
 
         return model
 
@@ -483,6 +488,7 @@ class RsdsWeibull(attrici.distributions.Weibull):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
 
             # beta
             weights_longterm_intercept = pm.Normal("weights_longterm_intercept", mu=0, sd=1)
@@ -517,7 +523,7 @@ class RsdsWeibull(attrici.distributions.Weibull):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Weibull("obs", alpha=alpha, beta=beta, observed=df_valid["y_scaled"])
+                pm.Weibull("obs", alpha=alpha, beta=beta, observed=y)
 
         return model
 
@@ -540,6 +546,7 @@ class Tasrange(attrici.distributions.Gamma):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
 
             covariates = pm.math.concatenate(
                 [
@@ -580,7 +587,7 @@ class Tasrange(attrici.distributions.Gamma):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Gamma("obs", mu=mu, sigma=sigma, observed=df_valid["y_scaled"])
+                pm.Gamma("obs", mu=mu, sigma=sigma, observed=y)
 
         return model
 
@@ -604,6 +611,7 @@ class Wind(attrici.distributions.Weibull):
             df_valid = df_subset.dropna(axis=0, how="any")
             gmtv = pm.Data("gmt", df_valid["gmt_scaled"].values)
             xf0 = pm.Data("xf0", df_valid.filter(regex="^mode_0_").values)
+            y = pm.Data("y", df_valid["y_scaled"].values)
 
             # beta
             weights_longterm_intercept = pm.Normal("weights_longterm_intercept", mu=0, sd=1)
@@ -638,6 +646,6 @@ class Wind(attrici.distributions.Weibull):
             logp_ = pm.Deterministic("logp", model.logpt)
 
             if not self.test:
-                pm.Weibull("obs", alpha=alpha, beta=beta, observed=df_valid["y_scaled"])
+                pm.Weibull("obs", alpha=alpha, beta=beta, observed=y)
 
         return model
@@ -0,0 +1,150 @@
+import os
+import fcntl
+from contextlib import contextmanager
+from pathlib import Path
+import numpy as np
+import netCDF4 as nc
+import attrici.posterior as posterior
+
+
+class ParamStore(object):
+    """ The MAP weights and logp of all grid cells of a variable in a single
+    netCDF file, with weights of shape (param, lat, lon). Cells that are not
+    fitted yet are NaN. Replaces one pickle per cell in traces/.
+    The workers of run_estimation.py only read the store. Their weights come
+    back with the results and the parent process writes them, so that killing
+    a worker can never interrupt a write.
+    All access goes through a lock file next to the store, exclusive for
+    writing and shared for reading, so that many processes of many tasks
+    can add cells. Readers load the full store at once.
+    The file system needs working file locks.
+    """
+
+    def __init__(self, store_file):
+
+        self.store_file = Path(store_file)
+        self.lock_file = self.store_file.with_suffix(".lock")
+        # bulk-loaded weights, see get
+        self.cache = None
+
+    @contextmanager
+    def locked(self, exclusive):
+
+        with open(self.lock_file, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def create(self, lats, lons, param_names, variable):
+
+        """ Create an empty store, if it does not exist yet. An existing store
+        needs to hold the same parameters. """
+
+        with self.locked(True):
+            if self.store_file.exists():
+                with nc.Dataset(self.store_file, "r") as ds:
+                    stored_names = list(ds.variables["param"][:])
+                if stored_names != list(param_names):
+                    raise ValueError(
+                        f"{self.store_file} holds other parameters than the model."
+                        " Were the modes changed?"
+                    )
+                return
+
+            # write to a temporary file first, so that no half-created store remains
+            tmp_file = self.store_file.with_suffix(".tmp")
+            with nc.Dataset(tmp_file, "w", format="NETCDF4") as ds:
+                ds.createDimension("param", len(param_names))
+                ds.createDimension("lat", len(lats))
+                ds.createDimension("lon", len(lons))
+                ds.variable = variable
+                param = ds.createVariable("param", str, ("param",))
+                for k, name in enumerate(param_names):
+                    param[k] = name
+                ds.createVariable("lat", "f8", ("lat",))[:] = lats
+                ds.createVariable("lon", "f8", ("lon",))[:] = lons
+                ds.createVariable(
+                    "weights",
+                    "f8",
+                    ("param", "lat", "lon"),
+                    chunksizes=(len(param_names), min(len(lats), 16), min(len(lons), 16)),
+                    fill_value=np.nan,
+                )
+                ds.createVariable(
+                    "logp",
+                    "f8",
+                    ("lat", "lon"),
+                    chunksizes=(min(len(lats), 16), min(len(lons), 16)),
+                    fill_value=np.nan,
+                )
+            os.replace(tmp_file, self.store_file)
+            print("Created parameter store", self.store_file)
+
+    def write(self, lats, lons, theta, logp):
+
+        """ Write the weights theta of shape (ncells, nparam) and the logp
+        of the cells at lats, lons. """
+
+        with self.locked(True), nc.Dataset(self.store_file, "a") as ds:
+            index_lat = {lat: i for i, lat in enumerate(ds.variables["lat"][:])}
+            index_lon = {lon: j for j, lon in enumerate(ds.variables["lon"][:])}
+            for lat, lon, theta_cell, logp_cell in zip(lats, lons, theta, logp):
+                i, j = index_lat[lat], index_lon[lon]
+                ds.variables["weights"][:, i, j] = theta_cell
+                ds.variables["logp"][i, j] = logp_cell
+        self.remember(lats, lons, theta, logp)
+
+    def remember(self, lats, lons, theta, logp):
+
+        """ Add cells to the loaded store without writing them, for the
+        processes that leave writing to another one. """
+
+        if self.cache is not None:
+            for lat, lon, theta_cell, logp_cell in zip(lats, lons, theta, logp):
+                self.cache[(lat, lon)] = (np.asarray(theta_cell), logp_cell)
+
+    def read(self):
+
+        """ Load the full store. Returns lats, lons, weights of shape
+        (param, lat, lon), logp of shape (lat, lon) and the parameter names. """
+
+        with self.locked(False), nc.Dataset(self.store_file, "r") as ds:
+            lats = ds.variables["lat"][:]
+            lons = ds.variables["lon"][:]
+            weights = np.ma.filled(ds.variables["weights"][:], np.nan)
+            logp = np.ma.filled(ds.variables["logp"][:], np.nan)
+            param_names = list(ds.variables["param"][:])
+        return lats, lons, weights, logp, param_names
+
+    def get(self, lat, lon):
+
+        """ Return the weights and logp of a cell, None if it is not fitted.
+        The store is read once on first use. Cells fitted since then by
+        other processes are not seen. """
+
+        if self.cache is None:
+            self.cache = {}
+            if self.store_file.exists():
+                lats, lons, weights, logp, _ = self.read()
+                for i, j in zip(*np.where(np.isfinite(weights).all(axis=0))):
+                    self.cache[(lats[i], lons[j])] = (weights[:, i, j], logp[i, j])
+                print("Loaded weights of", len(self.cache), "cells from", self.store_file)
+
+        return self.cache.get((lat, lon))
+
+
+def get_param_store(cfg):
+
+    return ParamStore(cfg.output_dir / ("params_" + cfg.variable + ".nc4"))
+
+
+def create_param_store(cfg, lats, lons):
+
+    """ Create the parameter store of a run for the grid lats, lons. """
+
+    param_names = posterior.posterior_for_var[cfg.variable](cfg.modes).param_names
+    store = get_param_store(cfg)
+    store.create(lats, lons, param_names, cfg.variable)
+    return store
@@ -0,0 +1,158 @@
+import heapq
+import numpy as np
+import pandas as pd
+import attrici.const as c
+
+
+def lpt_partition(costs, ntasks):
+
+    """ Distribute cells with the given costs to ntasks tasks by greedy
+    longest processing time first: the most expensive remaining cell
+    goes to the task with the smallest load so far.
+    Returns the task of each cell. """
+
+    order = np.argsort(-np.asarray(costs), kind="stable")
+    loads = [(0.0, task) for task in range(ntasks)]
+    tasks = np.empty(len(costs), dtype=int)
+    for i in order:
+        load, task = heapq.heappop(loads)
+        tasks[i] = task
+        heapq.heappush(loads, (load + costs[i], task))
+    return tasks
+
+
+def append_timing(timing_file, lat, lon, seconds, status):
+
+    """ Append the runtime of one cell to the timing log of a task. """
+
+    is_new = not timing_file.exists()
+    with open(timing_file, "a") as f:
+        if is_new:
+            f.write("lat,lon,seconds,status\n")
+        f.write(f"{lat},{lon},{seconds:.1f},{status}\n")
+
+
+def read_timing(timing_dir):
+
+    """ Read the timing logs of all tasks of a previous run.
+    Returns None if there are none. """
+
+    timing_files = sorted(timing_dir.glob("*.csv"))
+    if len(timing_files) == 0:
+        return None
+    timing = pd.concat([pd.read_csv(f) for f in timing_files], ignore_index=True)
+    # a cell may have been run more than once, use the last record
+    return timing.drop_duplicates(subset=["lat", "lon"], keep="last")
+
+
+def count_masked_days(obs_data, variable, df_specs, chunklen=1000):
+
+    """ Count the days per cell that are masked in the estimation, because
+    they are missing or beyond the thresholds in const.py. Reads the input
+    in blocks of time steps. """
+
+    data = obs_data.variables[variable]
+    lower, upper = (tuple(c.threshold[variable]) + (None,))[:2]
+    index_lat = df_specs["index_lat"].values
+    index_lon = df_specs["index_lon"].values
+
+    n_masked = np.zeros(len(df_specs))
+    for ti in range(0, data.shape[0], chunklen):
+        block = np.ma.filled(data[ti:ti + chunklen, :, :].astype(float), np.nan)
+        block = block[:, index_lat, index_lon]
+        masked = np.isnan(block) | (block <= lower)
+        if upper is not None:
+            masked |= block >= upper
+        n_masked += masked.sum(axis=0)
+        print("Counted masked days up to time step", ti + block.shape[0])
+
+    return n_masked
+
+
+def estimate_costs(df_specs, timing=None, timeout=None, n_masked=None, ntime=None):
+
+    """ Estimate the relative runtime of each cell.
+    Uses the runtimes of a previous run where available. Cells that failed
+    there count with the timeout. Other cells get the median runtime.
+    Without timing, the share of masked days is used as a heuristic,
+    as masked data makes the estimation harder. Without both, all cells
+    cost the same. """
+
+    if timing is not None:
+        timing = timing.copy()
+        if timeout is not None:
+            timing.loc[timing["status"] != "ok", "seconds"] = timeout
+        costs = df_specs.merge(timing, on=["lat", "lon"], how="left")["seconds"]
+        print(
+            "Use timing of a previous run for", costs.notna().sum(),
+            "of", len(df_specs), "cells.",
+        )
+        median = costs.median()
+        return costs.fillna(1.0 if np.isnan(median) else median).values
+
+    if n_masked is not None:
+        return 1.0 + n_masked / ntime
+
+    return np.ones(len(df_specs))
+
+
+def write_partition(partition_file, df_specs, costs, ntasks):
+
+    """ Assign cells to tasks and write the assignment to partition_file.
+    The run number is the row of the cell in df_specs. """
+
+    partition = df_specs.copy()
+    partition.index.name = "run_number"
+    partition["cost"] = costs
+    partition["task"] = lpt_partition(partition["cost"].values, ntasks)
+    partition.to_csv(partition_file)
+
+    loads = partition.groupby("task")["cost"].sum()
+    print(
+        "Wrote partition of", len(partition), "cells to", ntasks, "tasks to", partition_file
+    )
+    print(f"Estimated load per task: min {loads.min():.1f}, max {loads.max():.1f}.")
+    return partition
+
+
+def load_partition(partition_file, df_specs):
+
+    """ Read the partition file. It needs to be written for the cells of
+    df_specs, else it is stale, for example after a change of the landmask,
+    and a ValueError is raised. """
+
+    partition = pd.read_csv(partition_file, index_col="run_number")
+    columns = ["index_lat", "index_lon"]
+    if len(partition) != len(df_specs) or not np.array_equal(
+        partition[columns].values, df_specs[columns].values
+    ):
+        raise ValueError(
+            f"{partition_file} was written for other grid cells ({len(partition)} cells)"
+            f" than the current landmask ({len(df_specs)} cells). Rerun create_submit.py."
+        )
+    return partition
+
+
+def read_partition(partition_file, task_id, ntasks, df_specs):
+
+    """ Return the run numbers assigned to task_id, see load_partition. """
+
+    partition = load_partition(partition_file, df_specs)
+    if partition["task"].max() >= ntasks:
+        raise ValueError(
+            f"{partition_file} assigns cells to {partition['task'].max() + 1} tasks,"
+            f" but the job array has only {ntasks}. Rerun create_submit.py."
+        )
+    return partition.index[partition["task"] == task_id].values
+
+
+def spatial_order(df_specs, run_numbers):
+
+    """ Sort run numbers in serpentine order over the grid: by latitude,
+    and by longitude in alternating direction from one latitude to the next,
+    so that consecutive cells are neighbours. """
+
+    specs = df_specs.loc[run_numbers, ["index_lat", "index_lon"]]
+    reverse = specs["index_lat"] % 2 == 1
+    key = np.where(reverse, -specs["index_lon"], specs["index_lon"])
+    return np.asarray(run_numbers)[np.lexsort((key, specs["index_lat"].values))]
@@ -0,0 +1,404 @@
+import os
+import atexit
+import collections
+import multiprocessing as mp
+import multiprocessing.connection as mpc
+import shutil
+import signal
+import tempfile
+import time
+import traceback
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+
+# Theano (through pymc3) is only imported inside the worker processes. They are
+# forked from a parent that has not imported it, so each worker can set its own
+# Theano compiledir before the import.
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+
+def create_estimator(cfg):
+
+    import attrici.estimator as est
+
+    return est.estimator(cfg)
+
+
+def get_worker_compiledir(compiledir_base, index):
+    return compiledir_base / ("worker_" + str(index))
+
+
+def init_worker(cfg, index, compiledir_base):
+
+    """ Set up a worker process with its own Theano compiledir and seed. """
+
+    flags = os.environ.get("THEANO_FLAGS", "")
+    compiledir = "base_compiledir=" + str(get_worker_compiledir(compiledir_base, index))
+    os.environ["THEANO_FLAGS"] = flags + "," + compiledir if flags else compiledir
+    np.random.seed(cfg.seed + index)
+
+
+def process_group_rss(pgids):
+
+    """ Resident memory in bytes of all processes in each of the process
+    groups pgids, which includes the sampler processes started by a worker.
+    Returns a dict keyed by pgid, from one pass over /proc. """
+
+    rss = dict.fromkeys(pgids, 0)
+    for stat_file in Path("/proc").glob("[0-9]*/stat"):
+        try:
+            # fields after the command name, which may contain spaces
+            fields = stat_file.read_text().rsplit(")", 1)[1].split()
+        except (OSError, IndexError):
+            # the process ended meanwhile
+            continue
+        if int(fields[2]) in rss:
+            rss[int(fields[2])] += int(fields[21]) * PAGE_SIZE
+    return rss
+
+
+def estimate_batch(estimator, context, cells, map_estimate, batched):
+
+    """ Estimate parameters and time series of a batch of cells.
+    cells is a list of (n, sp, fname_cell, data), where data is the
+    time series of the cell. The dataframes are built from the run context.
+    Yields ("start", n) before each step, with n None for the batch MAP
+    estimation, and ("result", (n, sp, fname_cell, status, seconds, result,
+    weights)) after each cell, where result is the dataframe with the
+    counterfactual if status is "ok" and the error message if it is "failed".
+    weights are the new MAP weights and logp of the cell for the parameter
+    store, None if there are none. """
+
+    from pymc3.parallel_sampling import ParallelSamplingError
+
+    TIME_BATCH = datetime.now()
+    cells = [
+        (n, sp, fname_cell) + context.create_dataframe(data, estimator.variable)
+        for n, sp, fname_cell, data in cells
+    ]
+    traces = [None] * len(cells)
+    if batched and len(cells) > 0:
+        yield ("start", None)
+        try:
+            traces = estimator.estimate_parameters_batch(
+                [cell[3] for cell in cells],
+                [cell[1]["lat"] for cell in cells],
+                [cell[1]["lon"] for cell in cells],
+            )
+        except ValueError as error:
+            print("Batch MAP estimation failed, fit cell by cell.")
+            print(error)
+
+    # the batch estimation is shared by all cells of the batch
+    batch_seconds = (datetime.now() - TIME_BATCH).total_seconds() / max(len(cells), 1)
+
+    for (n, sp, fname_cell, df, datamin, scale), trace in zip(cells, traces):
+        yield ("start", n)
+        TIME_CELL = datetime.now()
+        try:
+            trace, dff = estimator.estimate_parameters(
+                df, sp["lat"], sp["lon"], map_estimate, trace
+            )
+        except (ParallelSamplingError, ValueError) as error:
+            if str(error) == "Modes larger 1 are not allowed for the censored model.":
+                raise error
+            seconds = batch_seconds + (datetime.now() - TIME_CELL).total_seconds()
+            estimator.pop_weights(sp["lat"], sp["lon"])
+            yield ("result", (n, sp, fname_cell, "failed", seconds, str(error), None))
+            continue
+
+        seed = estimator.get_cell_seed(sp["lat"], sp["lon"])
+        df_with_cfact = estimator.estimate_timeseries(
+            dff, trace, datamin, scale, map_estimate, seed=seed
+        )
+        seconds = batch_seconds + (datetime.now() - TIME_CELL).total_seconds()
+        weights = estimator.pop_weights(sp["lat"], sp["lon"])
+        yield ("result", (n, sp, fname_cell, "ok", seconds, df_with_cfact, weights))
+
+
+def worker_main(cfgs, index, compiledir_base, context, conn):
+
+    """ Loop of a worker process: estimate the batches sent by the supervisor
+    and send back progress and results. A batch is a list of
+    (variable, n, sp, fname_cell, data) and may hold cells of several
+    variables, cfgs holds the settings of each. The estimator of a variable
+    holds the cache of compiled models, so each worker keeps its own. """
+
+    # own process group, so that the supervisor can kill the sampler processes too
+    os.setpgrp()
+    cfg = next(iter(cfgs.values()))
+    init_worker(cfg, index, compiledir_base)
+    estimators = {}
+    while True:
+        task = conn.recv()
+        if task is None:
+            break
+        cells, batched = task
+        try:
+            for variable in dict.fromkeys(cell[0] for cell in cells):
+                if variable not in estimators:
+                    estimators[variable] = create_estimator(cfgs[variable])
+                group = [cell[1:] for cell in cells if cell[0] == variable]
+                for kind, content in estimate_batch(
+                    estimators[variable], context, group, cfgs[variable].map_estimate, batched
+                ):
+                    if kind == "start":
+                        content = None if content is None else (variable, content)
+                    else:
+                        content = (variable,) + content
+                    conn.send((kind, content))
+        except Exception:
+            conn.send(("raise", traceback.format_exc()))
+            break
+        conn.send(("done", None))
+    conn.close()
+
+
+class Worker(object):
+    """ The supervisor's view of one worker process. """
+
+    def __init__(self, index, process, conn):
+
+        self.index = index
+        self.process = process
+        self.conn = conn
+        # cells of the current batch that have no result yet, None if idle
+        self.cells = None
+        self.batched = False
+        # the cell being estimated, None before the first, between cells and
+        # during the batch MAP estimation, which in_batch_map tells apart
+        self.current = None
+        self.in_batch_map = False
+        self.started = None
+        self.deadline = None
+
+    @property
+    def idle(self):
+        return self.cells is None
+
+
+class Supervisor(object):
+    """ Runs the estimation of cells in persistent worker processes.
+    Each step, the estimation of one cell or of a batch with map_batch_size,
+    gets timeout seconds and the worker may use up to memory_limit bytes,
+    including its sampler processes. A worker that exceeds either is killed
+    with all its processes and replaced by a new one. The cell it worked on
+    counts as failed and the rest of its batch is queued again, with the
+    batch MAP estimation unless that is what the worker was killed in.
+    Unlike a timeout in a thread, this also stops Theano C code and pymc3
+    sampler processes. A worker that dies before it starts a cell, for
+    example while compiling the model, is restarted with the same cells at
+    most max_restarts times, then these cells count as failed.
+    Cells are given as (variable, n, sp, fname_cell, data) and results come
+    back as (variable, n, sp, fname_cell, status, seconds, result, weights),
+    see estimate_batch.
+    For a joint run of several variables, cfgs holds the settings of each.
+    heartbeat is called on every poll while cells are estimated, for example
+    to renew the claims in the work queue.
+    The Theano compiledirs of the workers are removed when a worker is
+    killed and on close.
+    """
+
+    def __init__(
+        self,
+        cfg,
+        context,
+        workers,
+        timeout,
+        memory_limit=None,
+        poll_interval=1.0,
+        cfgs=None,
+        heartbeat=None,
+        max_restarts=2,
+    ):
+
+        self.cfg = cfg
+        self.heartbeat = heartbeat
+        self.cfgs = {cfg.variable: cfg} if cfgs is None else cfgs
+        # inherited by the forked workers, not sent with each batch
+        self.context = context
+        self.timeout = timeout
+        self.memory_limit = memory_limit
+        self.poll_interval = poll_interval
+        self.max_restarts = max_restarts
+        # restarts of workers while they held a cell, keyed by cell[:2]
+        self.restarts = collections.Counter()
+        self.ctx = mp.get_context("fork")
+        self.compiledir_base = (
+            Path(tempfile.gettempdir()) / cfg.user / "theano" / ("pool_" + str(os.getpid()))
+        )
+        print("Start", workers, "worker processes with Theano compiledirs in", self.compiledir_base)
+        self.todo = collections.deque()
+        self.results = []
+        self.workers = [self.start_worker(index) for index in range(workers)]
+        atexit.register(self.close)
+
+    def start_worker(self, index):
+
+        conn, child_conn = self.ctx.Pipe()
+        # not a daemon, as pymc3 starts processes for the chains
+        process = self.ctx.Process(
+            target=worker_main,
+            args=(self.cfgs, index, self.compiledir_base, self.context, child_conn),
+        )
+        process.start()
+        child_conn.close()
+        return Worker(index, process, conn)
+
+    def submit(self, cells, batched):
+
+        """ Queue a batch of cells and wait until a worker takes it.
+        Returns the results that came in meanwhile. """
+
+        self.todo.append((cells, batched))
+        self.dispatch()
+        while len(self.todo) > 0:
+            self.poll()
+            self.dispatch()
+        return self.collect()
+
+    def join(self):
+
+        """ Wait for all queued batches. Returns the remaining results. """
+
+        self.dispatch()
+        while len(self.todo) > 0 or not all(worker.idle for worker in self.workers):
+            self.poll()
+            self.dispatch()
+        return self.collect()
+
+    def collect(self):
+
+        results, self.results = self.results, []
+        return results
+
+    def dispatch(self):
+
+        for worker in self.workers:
+            if len(self.todo) == 0:
+                return
+            if worker.idle:
+                cells, batched = self.todo.popleft()
+                worker.cells = list(cells)
+                worker.batched = batched
+                worker.current = None
+                worker.in_batch_map = False
+                worker.started = time.time()
+                worker.deadline = worker.started + self.timeout
+                worker.conn.send((cells, batched))
+
+    def poll(self):
+
+        """ Wait for messages of busy workers, at most poll_interval seconds,
+        and enforce the limits. """
+
+        busy = [worker for worker in self.workers if not worker.idle]
+        if len(busy) == 0:
+            return
+        if self.heartbeat is not None:
+            self.heartbeat()
+        now = time.time()
+        wait = min([worker.deadline - now for worker in busy] + [self.poll_interval])
+        ready = mpc.wait([worker.conn for worker in busy], timeout=max(wait, 0))
+        if self.memory_limit is not None:
+            rss = process_group_rss([worker.process.pid for worker in busy])
+
+        for worker in busy:
+            if worker.conn in ready:
+                try:
+                    self.receive(worker)
+                except EOFError:
+                    self.restart(worker, "Worker process died.")
+            elif time.time() > worker.deadline:
+                self.restart(worker, f"Timed out after {self.timeout} seconds.")
+            elif self.memory_limit is not None and rss[worker.process.pid] > self.memory_limit:
+                self.restart(
+                    worker, f"Exceeded memory limit of {self.memory_limit / 2**30:.1f} GB."
+                )
+
+    def receive(self, worker):
+
+        while worker.conn.poll():
+            kind, content = worker.conn.recv()
+            if kind == "start":
+                worker.current = content
+                worker.in_batch_map = content is None
+                worker.started = time.time()
+                worker.deadline = worker.started + self.timeout
+            elif kind == "result":
+                worker.cells = [cell for cell in worker.cells if cell[:2] != content[:2]]
+                worker.current = None
+                self.results.append(content)
+            elif kind == "done":
+                worker.cells = None
+                return
+            elif kind == "raise":
+                self.close()
+                raise RuntimeError("Estimation in worker process failed:\n" + content)
+
+    def kill(self, worker):
+
+        try:
+            os.killpg(worker.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        worker.process.join()
+        worker.conn.close()
+
+    def restart(self, worker, reason):
+
+        """ Kill a worker, fail its current cell and queue the rest of its batch.
+        Without a current cell, the batch is queued again, except for the
+        cells that were in max_restarts batches of killed workers before.
+        The batch keeps its batch MAP estimation, unless the worker was
+        killed in it. """
+
+        print("Kill worker", worker.index, ":", reason)
+        self.kill(worker)
+        # may hold locks and half written modules of the killed worker
+        compiledir = get_worker_compiledir(self.compiledir_base, worker.index)
+        shutil.rmtree(compiledir, ignore_errors=True)
+        seconds = time.time() - worker.started
+        remaining = worker.cells
+        if worker.current is not None:
+            cell = [cell for cell in worker.cells if cell[:2] == worker.current][0]
+            self.results.append(tuple(cell[:4]) + ("failed", seconds, reason, None))
+            remaining = [cell for cell in worker.cells if cell[:2] != worker.current]
+        else:
+            self.restarts.update(cell[:2] for cell in remaining)
+            exhausted = [cell for cell in remaining if self.restarts[cell[:2]] > self.max_restarts]
+            for cell in exhausted:
+                self.results.append(
+                    tuple(cell[:4])
+                    + (
+                        "failed",
+                        seconds,
+                        reason + f" Gave up after {self.max_restarts} restarts.",
+                        None,
+                    )
+                )
+            remaining = [cell for cell in remaining if self.restarts[cell[:2]] <= self.max_restarts]
+        if len(remaining) > 0:
+            # without the batch estimation if that is what got stuck
+            self.todo.appendleft((remaining, worker.batched and not worker.in_batch_map))
+        self.workers[self.workers.index(worker)] = self.start_worker(worker.index)
+
+    def close(self):
+
+        """ Stop all workers. Busy workers are killed. """
+
+        for worker in self.workers:
+            if not worker.process.is_alive():
+                continue
+            if worker.idle:
+                try:
+                    worker.conn.send(None)
+                    worker.process.join(timeout=10)
+                except (OSError, EOFError):
+                    pass
+            if worker.process.is_alive():
+                self.kill(worker)
+        self.workers = []
+        shutil.rmtree(self.compiledir_base, ignore_errors=True)
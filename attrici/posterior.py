@@ -0,0 +1,644 @@
+import numpy as np
+from scipy import optimize, special
+
+
+class Predictor(object):
+    """ A linear predictor eta = design @ weights with Normal priors on
+    the weights. The weights are named and have the prior widths as in models.py.
+    A trend predictor uses [1, gmt, xf0, gmt * xf0] as design,
+    a seasonal predictor uses [1, xf0].
+    """
+
+    def __init__(self, name, prefix, trend, harmonic_sd):
+        self.name = name
+        self.prefix = prefix
+        self.trend = trend
+        self.harmonic_sd = harmonic_sd
+
+    @property
+    def kind(self):
+        return "trend" if self.trend else "seasonal"
+
+    def blocks(self, n_fourier):
+
+        """ Return (name, shape, prior sd) of the weights in the order of
+        the design matrix columns. """
+
+        p = "weights_" + self.prefix
+        blocks = [(p + "longterm_intercept", (), 1.0)]
+        if self.trend:
+            blocks.append((p + "longterm_trend", (), 0.1))
+        for i in range(n_fourier // 2):
+            blocks.append((p + f"fc_intercept_{i}", (2,), self.harmonic_sd(i)))
+        if self.trend:
+            blocks.append((p + "fc_trend", (n_fourier,), 0.1))
+        return blocks
+
+
+def harmonic_sd(i):
+    return 1 / (2 * i + 1)
+
+
+def harmonic_sd_nu(i):
+    return 1 / (i + 1)
+
+
+def get_design(df, gmt=None):
+
+    """ Design matrices for trend and seasonal predictors from a dataframe
+    with gmt_scaled and fourier columns as passed to the models' setup.
+    gmt can be given to override gmt_scaled, for example with zeros for
+    the counterfactual. """
+
+    if gmt is None:
+        gmt = df["gmt_scaled"].values
+    xf0 = df.filter(regex="^mode_0_").values
+    ones = np.ones_like(gmt)
+    return {
+        "trend": np.column_stack([ones, gmt, xf0, gmt[:, None] * xf0]),
+        "seasonal": np.column_stack([ones, xf0]),
+    }
+
+
+class Posterior(object):
+    """ NumPy implementation of the log posterior of a model in models.py and
+    its gradient. All methods are vectorized over grid cells: weights are
+    passed as theta with shape (ncells, size), observations as y with shape
+    (ntime, ncells), where invalid (masked) observations are NaN.
+    """
+
+    predictors = []
+    # True if loglik_hessian is implemented
+    analytic_hessian = False
+
+    def __init__(self, modes):
+
+        self.n_fourier = 2 * modes[0]
+        self.blocks = []
+        self.slices = {}
+        prior_sd = []
+        start = 0
+        for predictor in self.predictors:
+            pstart = start
+            for name, shape, sd in predictor.blocks(self.n_fourier):
+                size = int(np.prod(shape))
+                self.blocks.append((name, shape, slice(start, start + size)))
+                prior_sd += [sd] * size
+                start += size
+            self.slices[predictor.name] = slice(pstart, start)
+        self.size = start
+        self.prior_sd = np.array(prior_sd)
+
+    @property
+    def param_names(self):
+
+        """ Name of each entry of theta, the block name and the index
+        within the block for blocks with more than one weight. """
+
+        names = []
+        for name, shape, sl in self.blocks:
+            if shape == ():
+                names.append(name)
+            else:
+                names += [name + "_" + str(k) for k in range(sl.stop - sl.start)]
+        return names
+
+    def loglik(self, eta, y, valid):
+        """ Return the pointwise log likelihood and its derivative
+        with respect to each linear predictor. """
+        raise NotImplementedError
+
+    def loglik_hessian(self, eta, y, valid):
+        """ Return the second derivatives of the pointwise log likelihood with
+        respect to pairs of linear predictors. Pairs not returned are zero. """
+        raise NotImplementedError
+
+    def transform(self, eta):
+        """ Return the distribution parameters from the linear predictors. """
+        raise NotImplementedError
+
+    def get_eta(self, theta, design):
+        return {
+            pr.name: design[pr.kind] @ theta[:, self.slices[pr.name]].T
+            for pr in self.predictors
+        }
+
+    def prior_logp(self, theta):
+
+        """ Log density of the Normal priors of the weights per cell, shape
+        (ncells,). This is what the logp Deterministic of the PyMC3 models
+        holds, as it is defined before the observed variables, and what is
+        reported as logp. """
+
+        theta = np.atleast_2d(theta)
+        return np.sum(
+            -0.5 * np.log(2 * np.pi)
+            - np.log(self.prior_sd)
+            - 0.5 * (theta / self.prior_sd) ** 2,
+            axis=1,
+        )
+
+    def logp_dlogp(self, theta, design, y, scale=1.0):
+
+        """ Log posterior per cell and its gradient, shapes (ncells,)
+        and (ncells, size), with all normalizing constants. Unlike the logp
+        Deterministic of the PyMC3 models, see prior_logp, it includes the
+        likelihood. The likelihood is multiplied with scale, for minibatches
+        of the time axis. """
+
+        theta = np.atleast_2d(theta)
+        valid = ~np.isnan(y)
+        # any value in the support, masked values do not contribute
+        y_filled = np.where(valid, y, 0.5)
+        ll, dll = self.loglik(self.get_eta(theta, design), y_filled, valid)
+
+        logp = scale * ll.sum(axis=0) + self.prior_logp(theta)
+        grad = -theta / self.prior_sd ** 2
+        for pr in self.predictors:
+            grad[:, self.slices[pr.name]] += scale * (design[pr.kind].T @ dll[pr.name]).T
+
+        return logp, grad
+
+    def hessian(self, theta, design, y):
+
+        """ Hessian of the log posterior per cell, shape (ncells, size, size). """
+
+        theta = np.atleast_2d(theta)
+        valid = ~np.isnan(y)
+        y_filled = np.where(valid, y, 0.5)
+        d2ll = self.loglik_hessian(self.get_eta(theta, design), y_filled, valid)
+        kinds = {pr.name: pr.kind for pr in self.predictors}
+
+        hess = np.zeros((theta.shape[0], self.size, self.size))
+        for (a, b), w in d2ll.items():
+            block = np.einsum(
+                "ti,tn,tj->nij", design[kinds[a]], w, design[kinds[b]], optimize=True
+            )
+            hess[:, self.slices[a], self.slices[b]] += block
+            if a != b:
+                hess[:, self.slices[b], self.slices[a]] += block.transpose(0, 2, 1)
+
+        diagonal = np.arange(self.size)
+        hess[:, diagonal, diagonal] -= 1 / self.prior_sd ** 2
+        return hess
+
+    def resample(self, trace, df):
+
+        """ Compute the distribution parameters on the full time axis of df,
+        once for the factual and once for the counterfactual with gmt = 0.
+        Replaces resample_missing for MAP estimates, as the parameters are
+        deterministic given the weights.
+        Returns dictionaries with the parameters of shape (nsamples, ntime)
+        and logp of shape (nsamples,) like pm.sample_posterior_predictive,
+        with logp as the Deterministic of the models, see prior_logp.
+        """
+
+        return self.resample_theta(self.from_dict(trace), df)
+
+    def resample_theta(self, theta, df):
+
+        """ Like resample, with the weights as theta of shape (nsamples, size). """
+
+        trace_obs, trace_cfact = self.resample_batch(theta, df)
+        return (
+            {p: ts.T for p, ts in trace_obs.items()},
+            {p: ts.T for p, ts in trace_cfact.items()},
+        )
+
+    def resample_batch(self, theta, df):
+
+        """ Like resample for many cells that share the time axis of df, with
+        weights theta of shape (ncells, size). Returns dictionaries with the
+        parameters of shape (ntime, ncells) and logp of shape (ncells,). """
+
+        traces = []
+        for gmt in [None, np.zeros(len(df))]:
+            trace = self.transform(self.get_eta(theta, get_design(df, gmt=gmt)))
+            trace["logp"] = self.prior_logp(theta)
+            traces.append(trace)
+        return traces[0], traces[1]
+
+    def to_dict(self, theta, logp=None):
+
+        """ Weights of a single cell as a dictionary like the one returned by
+        pm.find_MAP. Works with a leading sample dimension as well. """
+
+        theta = np.asarray(theta)
+        lead = theta.shape[:-1]
+        trace = {
+            name: theta[..., sl].reshape(lead + shape) for name, shape, sl in self.blocks
+        }
+        if logp is not None:
+            trace["logp"] = np.asarray(logp)
+        return trace
+
+    def from_dict(self, trace):
+
+        """ Inverse of to_dict, returns theta with shape (nsamples, size). """
+
+        lead = np.shape(trace[self.blocks[0][0]])
+        theta = np.empty(lead + (self.size,))
+        for name, shape, sl in self.blocks:
+            theta[..., sl] = np.reshape(trace[name], lead + (-1,))
+        return np.atleast_2d(theta)
+
+
+class Normal(Posterior):
+
+    predictors = [
+        Predictor("mu", "", True, harmonic_sd),
+        Predictor("sigma", "sigma_", False, harmonic_sd),
+    ]
+    analytic_hessian = True
+
+    def loglik(self, eta, y, valid):
+        sigma = np.exp(eta["sigma"])
+        r = (y - eta["mu"]) / sigma
+        ll = -0.5 * np.log(2 * np.pi) - eta["sigma"] - 0.5 * r ** 2
+        dll = {"mu": r / sigma, "sigma": r ** 2 - 1}
+        return ll * valid, {k: v * valid for k, v in dll.items()}
+
+    def loglik_hessian(self, eta, y, valid):
+        sigma = np.exp(eta["sigma"])
+        r = (y - eta["mu"]) / sigma
+        d2ll = {
+            ("mu", "mu"): -1 / sigma ** 2,
+            ("mu", "sigma"): -2 * r / sigma,
+            ("sigma", "sigma"): -2 * r ** 2,
+        }
+        return {k: v * valid for k, v in d2ll.items()}
+
+    def transform(self, eta):
+        return {"mu": eta["mu"], "sigma": np.exp(eta["sigma"])}
+
+
+class Beta(Posterior):
+
+    predictors = [
+        Predictor("mu", "", True, harmonic_sd),
+        Predictor("phi", "phi_", False, harmonic_sd),
+    ]
+
+    def loglik(self, eta, y, valid):
+        mu = special.expit(eta["mu"])
+        phi = np.exp(eta["phi"])
+        a = mu * phi
+        b = (1 - mu) * phi
+        ll = (
+            special.gammaln(phi)
+            - special.gammaln(a)
+            - special.gammaln(b)
+            + (a - 1) * np.log(y)
+            + (b - 1) * np.log1p(-y)
+        )
+        da = special.digamma(phi) - special.digamma(a) + np.log(y)
+        db = special.digamma(phi) - special.digamma(b) + np.log1p(-y)
+        dll = {"mu": phi * mu * (1 - mu) * (da - db), "phi": a * da + b * db}
+        return ll * valid, {k: v * valid for k, v in dll.items()}
+
+    def transform(self, eta):
+        mu = special.expit(eta["mu"])
+        phi = np.exp(eta["phi"])
+        return {"alpha": mu * phi, "beta": (1 - mu) * phi}
+
+
+class Weibull(Posterior):
+
+    predictors = [
+        Predictor("beta", "", True, harmonic_sd),
+        Predictor("alpha", "alpha_", False, harmonic_sd),
+    ]
+
+    def loglik(self, eta, y, valid):
+        alpha = np.exp(eta["alpha"])
+        log_y_beta = np.log(y) - eta["beta"]
+        z = np.exp(alpha * log_y_beta)
+        ll = eta["alpha"] - eta["beta"] + (alpha - 1) * log_y_beta - z
+        dll = {"beta": alpha * (z - 1), "alpha": 1 + alpha * log_y_beta * (1 - z)}
+        return ll * valid, {k: v * valid for k, v in dll.items()}
+
+    def transform(self, eta):
+        return {"beta": np.exp(eta["beta"]), "alpha": np.exp(eta["alpha"])}
+
+
+def gamma_loglik(eta_mu, eta_nu, y):
+
+    """ Gamma log likelihood parametrized by log mu and log nu,
+    with sigma = mu / nu as in models.py. """
+
+    # shape alpha = nu**2, rate beta = nu**2 / mu
+    alpha = np.exp(2 * eta_nu)
+    log_beta = 2 * eta_nu - eta_mu
+    y_mu = y * np.exp(-eta_mu)
+    ll = alpha * log_beta - special.gammaln(alpha) + (alpha - 1) * np.log(y) - alpha * y_mu
+    dmu = alpha * (y_mu - 1)
+    dnu = 2 * alpha * (log_beta + 1 - special.digamma(alpha) + np.log(y) - y_mu)
+    return ll, dmu, dnu
+
+
+class Gamma(Posterior):
+
+    predictors = [
+        Predictor("mu", "", True, harmonic_sd),
+        Predictor("nu", "nu_", False, harmonic_sd_nu),
+    ]
+
+    def loglik(self, eta, y, valid):
+        ll, dmu, dnu = gamma_loglik(eta["mu"], eta["nu"], y)
+        return ll * valid, {"mu": dmu * valid, "nu": dnu * valid}
+
+    def transform(self, eta):
+        mu = np.exp(eta["mu"])
+        return {"mu": mu, "sigma": mu / np.exp(eta["nu"])}
+
+
+class BernoulliGamma(Posterior):
+    """ Dry days are the invalid (NaN) days of y, they enter the Bernoulli
+    part of the likelihood. Wet days enter the Gamma part. """
+
+    predictors = [
+        Predictor("pbern", "pbern_", True, harmonic_sd),
+        Predictor("mu", "mu_", True, harmonic_sd),
+        Predictor("nu", "nu_", False, harmonic_sd_nu),
+    ]
+
+    def loglik(self, eta, y, valid):
+        dry_day = ~valid
+        ll_bern = dry_day * eta["pbern"] - np.logaddexp(0, eta["pbern"])
+        dpbern = dry_day - special.expit(eta["pbern"])
+        ll, dmu, dnu = gamma_loglik(eta["mu"], eta["nu"], y)
+        return (
+            ll_bern + ll * valid,
+            {"pbern": dpbern, "mu": dmu * valid, "nu": dnu * valid},
+        )
+
+    def transform(self, eta):
+        mu = np.exp(eta["mu"])
+        return {
+            "mu": mu,
+            "sigma": mu / np.exp(eta["nu"]),
+            "pbern": special.expit(eta["pbern"]),
+        }
+
+
+posterior_for_var = {
+    "tas": Normal,
+    "tasrange": Gamma,
+    "tasskew": Normal,
+    "pr": BernoulliGamma,
+    "hurs": Beta,
+    "wind": Weibull,
+    "sfcwind": Weibull,
+    "ps": Normal,
+    "rsds": Normal,
+    "rlds": Normal,
+}
+
+
+def find_map(posterior, design, y, maxiter=500, theta0=None):
+
+    """ Find the maximum a posteriori weights of a single grid cell.
+    Uses Newton steps with the analytic Hessian (trust-exact) where the
+    posterior provides one, L-BFGS-B otherwise. Starts from theta0,
+    for example the weights of a neighbouring cell, or from zero.
+    Returns theta (size,) and logp.
+    """
+
+    y = y[:, None]
+    x0 = np.zeros(posterior.size) if theta0 is None else np.asarray(theta0, dtype=float)
+
+    def cost(x):
+        logp, grad = posterior.logp_dlogp(x, design, y)
+        return -logp[0], -grad[0]
+
+    if posterior.analytic_hessian:
+        opt_result = optimize.minimize(
+            cost,
+            x0,
+            method="trust-exact",
+            jac=True,
+            hess=lambda x: -posterior.hessian(x, design, y)[0],
+            options={"maxiter": maxiter},
+        )
+    else:
+        opt_result = optimize.minimize(
+            cost,
+            x0,
+            method="L-BFGS-B",
+            jac=True,
+            options={"maxiter": maxiter},
+        )
+
+    return opt_result["x"], -opt_result["fun"]
+
+
+def find_map_batch(posterior, design, y, gtol=1e-4, maxiter=500, max_rounds=10, theta0=None):
+
+    """ Find the maximum a posteriori weights for many grid cells at once.
+    The cells are independent, so their summed negative log posterior is
+    minimized with one vectorized L-BFGS-B run. Convergence is checked per
+    cell after each round; converged cells are masked out and the remaining
+    ones are optimized further from where they are.
+
+    Returns theta (ncells, size), logp (ncells,) and the converged mask.
+    gtol applies to the gradient per valid data point of a cell.
+    The optimization starts from theta0 (ncells, size) if given, else from zero.
+    """
+
+    ncells = y.shape[1]
+    if theta0 is None:
+        theta = np.zeros((ncells, posterior.size))
+    else:
+        theta = np.array(theta0, dtype=float)
+    converged = np.zeros(ncells, dtype=bool)
+    n_obs = np.isfinite(y).sum(axis=0) + 1
+
+    for nround in range(max_rounds):
+        active = np.where(~converged)[0]
+        y_active = y[:, active]
+
+        def cost(x):
+            logp, grad = posterior.logp_dlogp(
+                x.reshape(len(active), posterior.size), design, y_active
+            )
+            return -logp.sum(), -grad.ravel()
+
+        # stop on the gradient of the cells, as the relative change of
+        # their summed logp gets tiny long before
+        opt_result = optimize.minimize(
+            cost,
+            theta[active].ravel(),
+            method="L-BFGS-B",
+            jac=True,
+            options={"maxiter": maxiter, "ftol": 0, "gtol": gtol * n_obs[active].min()},
+        )
+        theta[active] = opt_result["x"].reshape(len(active), posterior.size)
+        _, grad = posterior.logp_dlogp(theta[active], design, y_active)
+        converged[active] = np.abs(grad).max(axis=1) < gtol * n_obs[active]
+        print(
+            f"Batch MAP round {nround}: {converged.sum()} of {ncells} cells converged."
+        )
+        if converged.all():
+            break
+
+    logp, _ = posterior.logp_dlogp(theta, design, y)
+    return theta, logp, converged
+
+
+def numeric_hessian(posterior, theta, design, y, eps=1e-5):
+
+    """ Hessian of the log posterior of a single cell at theta, shape
+    (size, size), from central differences of the analytic gradient. For the
+    posteriors without analytic_hessian. """
+
+    theta = np.asarray(theta, dtype=float)
+    steps = eps * np.maximum(np.abs(theta), 1.0)
+    # all shifted weights are evaluated together, as if they were cells
+    shifted = np.concatenate([theta + np.diag(steps), theta - np.diag(steps)])
+    _, grad = posterior.logp_dlogp(shifted, design, np.repeat(y, 2 * posterior.size, axis=1))
+    hess = (grad[:posterior.size] - grad[posterior.size:]) / (2 * steps[:, None])
+    return (hess + hess.T) / 2
+
+
+def laplace_approximation(posterior, theta, design, y):
+
+    """ Laplace approximation of the posterior of a single cell: a Normal
+    around the MAP theta with the inverse of the negative Hessian at theta
+    as covariance. Directions in which the posterior is not curved downwards,
+    as after a MAP that did not converge, get the prior variance.
+    Returns the scale (size, size), the covariance is scale @ scale.T. """
+
+    y = np.asarray(y, dtype=float).reshape(-1, 1)
+    if posterior.analytic_hessian:
+        hess = posterior.hessian(theta, design, y)[0]
+    else:
+        hess = numeric_hessian(posterior, theta, design, y)
+
+    # the precision is positive definite at a proper maximum
+    eigval, eigvec = np.linalg.eigh(-hess)
+    eigval = np.maximum(eigval, 1 / posterior.prior_sd.max() ** 2)
+    return eigvec / np.sqrt(eigval)
+
+
+def fit_advi(
+    posterior,
+    design,
+    y,
+    theta,
+    scale,
+    fullrank=True,
+    batch_size=None,
+    max_iterations=10000,
+    tolerance=0.1,
+    learning_rate=0.05,
+    window=100,
+    draws=10,
+    seed=0,
+):
+
+    """ Fit a Normal approximation of the posterior of a single cell by
+    maximizing the ELBO with stochastic gradients (ADVI). The covariance is
+    full rank, or diagonal (mean field) if fullrank is False.
+    The fit starts from the Normal around theta with covariance
+    scale @ scale.T, as from the MAP and laplace_approximation, and works in
+    the coordinates in which that Normal is standard, so that one learning
+    rate suits all weights. scale needs to be diagonal for mean field.
+    Each iteration draws samples of the weights and evaluates the
+    likelihood on batch_size random time steps, all if None. The learning
+    rate decays with the number of windows, and the parameters are averaged
+    over windows of iterations, which averages out the gradient noise.
+    The fit stops when the averaged shift of the mean and log diagonal of
+    the scale of two windows differ by less than tolerance, in units of the
+    starting standard deviations.
+    Returns the mean (size,), the scale (size, size) with the covariance
+    scale @ scale.T, and whether the fit converged.
+    """
+
+    rng = np.random.RandomState(seed)
+    y = np.asarray(y, dtype=float)
+    ntime, size = len(y), posterior.size
+    if batch_size is None or batch_size >= ntime:
+        batch_size = ntime
+
+    # the whitened weights are shift + (diagonal + lower) @ eps, with the log
+    # of the diagonal as parameter and lower strictly lower triangular
+    params = {"shift": np.zeros(size), "log_diagonal": np.zeros(size)}
+    if fullrank:
+        params["lower"] = np.zeros((size, size))
+    # Adam moments and the sums of the parameters over the current window
+    moments = {key: (np.zeros_like(value), np.zeros_like(value)) for key, value in params.items()}
+    sums = {key: np.zeros_like(value) for key, value in params.items()}
+    beta1, beta2 = 0.9, 0.999
+
+    # the last window average, the current parameters before the first
+    result, previous, converged = params, None, False
+    for iteration in range(1, max_iterations + 1):
+        if batch_size < ntime:
+            rows = rng.choice(ntime, batch_size, replace=False)
+            design_batch = {kind: values[rows] for kind, values in design.items()}
+            y_batch = y[rows, None]
+        else:
+            design_batch, y_batch = design, y[:, None]
+
+        # the samples are evaluated together, as if they were cells
+        diagonal = np.exp(params["log_diagonal"])
+        eps = rng.standard_normal((draws, size))
+        whitened = params["shift"] + diagonal * eps
+        if fullrank:
+            whitened += eps @ params["lower"].T
+        _, grad = posterior.logp_dlogp(
+            theta + whitened @ scale.T,
+            design_batch,
+            np.repeat(y_batch, draws, axis=1),
+            ntime / batch_size,
+        )
+        grad = grad @ scale
+        # the entropy of the Normal adds the sum of the log diagonal
+        grads = {
+            "shift": grad.mean(axis=0),
+            "log_diagonal": (grad * eps).mean(axis=0) * diagonal + 1,
+        }
+        if fullrank:
+            grads["lower"] = np.tril(grad.T @ eps / draws, -1)
+
+        rate = learning_rate / np.sqrt(1 + iteration // window)
+        for key, g in grads.items():
+            m, v = moments[key]
+            m[...] = beta1 * m + (1 - beta1) * g
+            v[...] = beta2 * v + (1 - beta2) * g ** 2
+            m_hat = m / (1 - beta1 ** iteration)
+            v_hat = v / (1 - beta2 ** iteration)
+            params[key] += rate * m_hat / (np.sqrt(v_hat) + 1e-8)
+            sums[key] += params[key]
+
+        if iteration % window == 0:
+            result = {key: value / window for key, value in sums.items()}
+            sums = {key: np.zeros_like(value) for key, value in params.items()}
+            if previous is not None:
+                change = max(
+                    np.abs(result[key] - previous[key]).max() for key in ["shift", "log_diagonal"]
+                )
+                converged = change < tolerance
+            if converged:
+                break
+            previous = result
+
+    print(
+        "ADVI {0} after {1} iterations.".format(
+            "converged" if converged else "did not converge", iteration
+        )
+    )
+    factor = np.diag(np.exp(result["log_diagonal"]))
+    if fullrank:
+        factor += np.tril(result["lower"], -1)
+    return theta + scale @ result["shift"], scale @ factor, converged
+
+
+def gaussian_samples(mean, scale, nsamples, seed=0):
+
+    """ Draw weights of shape (nsamples, size) from the Normal with the given
+    mean and covariance scale @ scale.T, as from laplace_approximation or
+    fit_advi. """
+
+    z = np.random.RandomState(seed).standard_normal((nsamples, len(mean)))
+    return mean + z @ np.asarray(scale).T
@@ -1,9 +1,14 @@
+import os
+import collections
 import shutil
+import tempfile
+import zlib
+import multiprocessing as mp
 import numpy as np
 import pandas as pd
-import subprocess
-from datetime import datetime
 import netCDF4 as nc
+import attrici.datahandler as dh
+import attrici.manifest as manifest
 
 def read_from_disk(data_path):
 
@@ -11,12 +16,266 @@ def read_from_disk(data_path):
         df = pd.read_hdf(data_path)
     elif data_path.split(".")[-1] == "csv":
         df = pd.read_csv(data_path, index_col=0)
+    elif data_path.split(".")[-1] == "npz":
+        df = dh.read_npz(data_path)
     else:
-        raise NotImplementedError("choose storage format .h5 or csv.")
+        raise NotImplementedError("choose storage format .h5, .csv or .npz.")
 
     return df
 
 
+def find_cell_files(settings, lats, lons):
+
+    """ Grid indices i, j and paths of the cell files of a run, found by
+    searching the files and matching the coordinates in their names to
+    lats and lons. """
+
+    ts_dir = settings.output_dir / "timeseries" / settings.variable
+    print("Search cell files in", ts_dir)
+    paths = [str(path) for path in ts_dir.glob("**/*" + settings.storage_format)]
+    lat = np.array([float(path.split("lat")[-1].split("_")[0]) for path in paths])
+    lon = np.array([float(path.split("lon")[-1].split(settings.storage_format)[0]) for path in paths])
+
+    def nearest(values, grid):
+        unique, inverse = np.unique(values, return_inverse=True)
+        return np.abs(unique[:, None] - np.asarray(grid)[None, :]).argmin(axis=1)[inverse]
+
+    return pd.DataFrame({"i": nearest(lat, lats), "j": nearest(lon, lons), "path": paths})
+
+
+def backfill_manifest(settings, lats, lons, records):
+
+    """ Record the cell files that are on disk but not in the run manifest,
+    for example from tasks that ran before the manifest existed. They get
+    status "ok" without runtime and logp. Cells with any record, also
+    "failed", are known and left as they are. The backfill manifest file is
+    created even if no file is missing, as the marker that this was done.
+    Returns the number of cells added. """
+
+    found = find_cell_files(settings, lats, lons)
+    missing = [(i, j, path) for i, j, path in found.itertuples(index=False) if (i, j) not in records]
+    backfill = manifest.Manifest(manifest.get_manifest_dir(settings), "backfill")
+    for i, j, path in missing:
+        sp = {"index_lat": i, "index_lon": j, "lat": lats[i], "lon": lons[j]}
+        backfill.record(sp, "ok", np.nan, path)
+    backfill.close()
+    backfill.manifest_file.touch()
+    print("Added", len(missing), "cell files to the run manifest.")
+    return len(missing)
+
+
+def get_produced_cells(settings, lats, lons):
+
+    """ Grid indices i, j and paths of the cell files of a run, from the run
+    manifest. If it knows fewer cells than the landmask, for example as the
+    run started before the manifest existed, the cell files on disk are
+    searched once and the missing ones are added, see backfill_manifest. """
+
+    manifest_dir = manifest.get_manifest_dir(settings)
+    records = manifest.read_manifest(manifest_dir)
+    nc_lsmask = nc.Dataset(settings.input_dir / settings.landsea_file, "r")
+    n_land = int((nc_lsmask.variables["LSM"][0, :] == 1).sum())
+    nc_lsmask.close()
+    if len(records) < n_land:
+        print(
+            "Warning: the run manifest knows {0} of {1} land cells.".format(len(records), n_land)
+        )
+        if not (manifest_dir / "backfill.csv").exists():
+            if backfill_manifest(settings, lats, lons, records) > 0:
+                records = manifest.read_manifest(manifest_dir)
+
+    return pd.DataFrame(
+        [
+            (record["index_lat"], record["index_lon"], record["path"])
+            for record in records.values()
+            if record["status"] == "ok" and record["path"].endswith(settings.storage_format)
+        ],
+        columns=["i", "j", "path"],
+    )
+
+
+def read_cell_columns(args):
+
+    """ Read the given columns of a cell file as a float32 array of shape
+    (ncolumns, ntime). Takes a single (path, columns) tuple for Pool.imap. """
+
+    data_path, columns = args
+    if data_path.endswith(".npz"):
+        # only the needed columns are decompressed
+        values = dh.read_npz(data_path, columns)
+        return np.stack([values[column] for column in columns]).astype(np.float32)
+    df = read_from_disk(data_path)
+    return np.stack([df[column].values for column in columns]).astype(np.float32)
+
+
+def read_bands_from_files(cells, columns, shape, band_rows, workers, fill_value):
+
+    """ Read cell files into lat bands of band_rows rows, in order.
+    cells is a dataframe with columns i, j (grid indices) and path.
+    Yields (band_start, band) with band of shape (ncolumns, ntime, rows, nlon),
+    where cells without a file are fill_value. The files are read by a pool of
+    workers, which read the next band while the current one is processed. """
+
+    ntime, nlat, nlon = shape
+    bands = [
+        (band_start, cells[(cells["i"] >= band_start) & (cells["i"] < band_start + band_rows)])
+        for band_start in range(0, nlat, band_rows)
+    ]
+    bands = [(band_start, band_cells) for band_start, band_cells in bands if len(band_cells) > 0]
+
+    with mp.get_context("fork").Pool(workers) as pool:
+
+        def start(band_start, band_cells):
+            results = pool.imap(
+                read_cell_columns,
+                [(path, columns) for path in band_cells["path"]],
+                chunksize=8,
+            )
+            return band_start, band_cells, results
+
+        previous = None
+        for band in bands + [None]:
+            current = start(*band) if band is not None else None
+            if previous is not None:
+                band_start, band_cells, results = previous
+                rows = min(band_rows, nlat - band_start)
+                block = np.full((len(columns), ntime, rows, nlon), fill_value, dtype=np.float32)
+                for i, j, values in zip(band_cells["i"], band_cells["j"], results):
+                    block[:, :, i - band_start, j] = values
+                yield band_start, block
+            previous = current
+
+
+def read_bands_from_store(store, variables, band_rows, fill_value):
+
+    """ Like read_bands_from_files for the output store of storage_format ".cells".
+    The cells of a band are contiguous rows in the store. """
+
+    ntime = len(store.time)
+    nlat, nlon = len(store.lats), len(store.lons)
+    index_lat = store.cells["index_lat"].values
+    index_lon = store.cells["index_lon"].values
+    written = store.written[:].astype(bool)
+
+    for band_start in range(0, nlat, band_rows):
+        in_band = (index_lat >= band_start) & (index_lat < band_start + band_rows) & written
+        if not in_band.any():
+            continue
+        rows = min(band_rows, nlat - band_start)
+        block = np.full((len(variables), ntime, rows, nlon), fill_value, dtype=np.float32)
+        first, last = np.flatnonzero(in_band)[[0, -1]]
+        for k, var in enumerate(variables):
+            values = store.arrays[var][first:last + 1][in_band[first:last + 1]]
+            block[k, :, index_lat[in_band] - band_start, index_lon[in_band]] = values
+        yield band_start, block
+
+
+class SpatialChunkBuffer(object):
+    """ Transposes lat bands of whole time series into time slabs of whole
+    lat/lon fields, as needed to write map-chunked netCDF files.
+    The data is held as (slab, variable, lat, time in slab, lon), so that
+    storing a band and loading a slab are both a few large contiguous copies.
+    As many slabs as fit into max_bytes are kept in memory. The band blocks
+    of the other slabs are compressed like the chunks of the output, with
+    shuffle and deflate, and spilled to a file in spill_dir that is removed
+    by close. Loading such a slab reads back only its own blocks.
+    """
+
+    def __init__(
+        self, nvariables, shape, slab_time, fill_value, max_bytes, spill_dir, complevel=1
+    ):
+
+        self.ntime, self.nlat, self.nlon = shape
+        self.nvariables = nvariables
+        self.slab_time = slab_time
+        self.fill_value = fill_value
+        self.complevel = complevel
+        nslabs = -(-self.ntime // slab_time)
+        bytes_per_slab = nvariables * self.nlat * slab_time * self.nlon * 4
+        self.nmemory = int(min(nslabs, max_bytes // bytes_per_slab))
+        self.buffer = np.empty(
+            (self.nmemory, nvariables, self.nlat, slab_time, self.nlon), dtype=np.float32
+        )
+        self.spill_file = None
+        # offset and length in the spill file of each spilled block, by slab
+        self.blocks = collections.defaultdict(list)
+        self.bytes_raw, self.bytes_written, self.bytes_read = 0, 0, 0
+        if self.nmemory < nslabs:
+            fd, self.spill_file = tempfile.mkstemp(suffix=".spill", dir=spill_dir)
+            self.spill = os.fdopen(fd, "w+b")
+            print(
+                "Keep {0} of {1} time slabs in memory, spill the others compressed to {2}".format(
+                    self.nmemory, nslabs, self.spill_file
+                )
+            )
+        # lats without any band are fill_value
+        self.rows_written = np.zeros(self.nlat, dtype=bool)
+
+    def slab_ranges(self):
+
+        for k, t0 in enumerate(range(0, self.ntime, self.slab_time)):
+            yield k, t0, min(t0 + self.slab_time, self.ntime)
+
+    def write_band(self, band_start, block):
+
+        """ Store a band of shape (nvariables, ntime, rows, nlon). """
+
+        band_end = band_start + block.shape[2]
+        for k, t0, t1 in self.slab_ranges():
+            part = block[:, t0:t1].transpose(0, 2, 1, 3)
+            if k < self.nmemory:
+                self.buffer[k, :, band_start:band_end, : t1 - t0, :] = part
+                continue
+            # byte shuffle, as the netCDF shuffle filter, before deflate
+            values = np.ascontiguousarray(part, dtype=np.float32)
+            shuffled = values.view(np.uint8).reshape(-1, 4).T.tobytes()
+            compressed = zlib.compress(shuffled, self.complevel)
+            self.spill.seek(0, os.SEEK_END)
+            self.blocks[k].append((band_start, block.shape[2], self.spill.tell(), len(compressed)))
+            self.spill.write(compressed)
+            self.bytes_raw += values.nbytes
+            self.bytes_written += len(compressed)
+        self.rows_written[band_start:band_end] = True
+
+    def slabs(self):
+
+        """ Yield (t0, slab) with slab of shape (nvariables, time, nlat, nlon),
+        in order of time. """
+
+        for k, t0, t1 in self.slab_ranges():
+            if k < self.nmemory:
+                slab = np.ascontiguousarray(
+                    self.buffer[k, :, :, : t1 - t0, :].transpose(0, 2, 1, 3)
+                )
+                slab[:, :, ~self.rows_written, :] = self.fill_value
+                yield t0, slab
+                continue
+            fields = np.full(
+                (self.nvariables, self.nlat, t1 - t0, self.nlon), self.fill_value, dtype=np.float32
+            )
+            for band_start, rows, offset, length in self.blocks.pop(k, []):
+                self.spill.seek(offset)
+                shuffled = np.frombuffer(zlib.decompress(self.spill.read(length)), dtype=np.uint8)
+                values = shuffled.reshape(4, -1).T.copy().view(np.float32)
+                fields[:, band_start:band_start + rows] = values.reshape(
+                    self.nvariables, rows, t1 - t0, self.nlon
+                )
+                self.bytes_read += length
+            yield t0, np.ascontiguousarray(fields.transpose(0, 2, 1, 3))
+
+    def close(self):
+
+        del self.buffer
+        if self.spill_file is not None:
+            print(
+                "Spilled {0:.2f} GB as {1:.2f} GB compressed, read back {2:.2f} GB.".format(
+                    self.bytes_raw / 2 ** 30, self.bytes_written / 2 ** 30, self.bytes_read / 2 ** 30
+                )
+            )
+            self.spill.close()
+            os.remove(self.spill_file)
+
+
 def form_global_nc(ds, time, lat, lon, vnames, torigin):
 
     # FIXME: can be deleted once merge_cfact is fully replaced by write_netcdf
@@ -48,37 +307,79 @@ def form_global_nc(ds, time, lat, lon, vnames, torigin):
     longitudes[:] = lon
     times[:] = time
 
-def rechunk_netcdf(ncfile, ncfile_rechunked):
+# This threshold for logp is to ensure that the model fits the data at all.
+# It is mainly to catch values for logp like -7000
+LOGP_THRESHOLD = -300
+
+
+def find_invalid(values, logp):
+
+    """ Mask of the values to replace by the original data: inf, nan and
+    values of cells with too small logp. logp may be None. Also returns the
+    counts of each kind and of the affected cells, for arrays of shape
+    (time, lat, lon). """
+
+    isinf = np.isinf(values)
+    isnan = np.isnan(values)
+    if logp is None:
+        small_logp = np.zeros(values.shape, dtype=bool)
+    else:
+        small_logp = np.ma.filled(logp < LOGP_THRESHOLD, False)
+    invalid = np.ma.filled(isinf | isnan, False) | small_logp
+    counts = {
+        "inf": int(isinf.sum()),
+        "nan": int(isnan.sum()),
+        "small_logp": int(small_logp.sum()),
+        "cells": int(invalid.any(axis=0).sum()),
+    }
+    return invalid, counts
 
 
-    TIME0 = datetime.now()
+def report_invalid(where, counts):
 
-    try:
-        cmd = (
-            "ncks -4 -O --deflate 5 "
-            + "--cnk_plc=g3d --cnk_dmn=lat,360 --cnk_dmn=lon,720 "
-            + str(ncfile)
-            + " "
-            + ncfile_rechunked
+    print(
+        "{0}: replace {1} inf values, {2} nan values and {3} values with too small "
+        "logp (<{4}) in {5} cells.".format(
+            where, counts["inf"], counts["nan"], counts["small_logp"], LOGP_THRESHOLD, counts["cells"]
         )
-        print(cmd)
-        subprocess.check_call(cmd, shell=True)
-    except subprocess.CalledProcessError:
-        cmd = "module load nco & module load intel/2018.1 && " + cmd
-        print(cmd)
-        subprocess.check_call(cmd, shell=True)
+    )
 
-    print("Rechunking took {0:.1f} minutes.".format((datetime.now() - TIME0).total_seconds() / 60))
 
-    return ncfile_rechunked
+def replace_invalid_in_band(block, variables, variable, source_var, band_start):
+
+    """ Replace invalid values of variable in a band of shape
+    (nvariables, ntime, rows, nlon) in place, see find_invalid.
+    Only the affected cells are patched. The original values are taken from
+    the band if it holds variable_orig, else they are read from source_var.
+    Returns the counts of find_invalid. """
+
+    values = block[variables.index(variable)]
+    logp = block[variables.index("logp")] if "logp" in variables else None
+    invalid, counts = find_invalid(values, logp)
+    if counts["cells"] == 0:
+        return counts
+
+    cells = invalid.any(axis=0)
+    if variable + "_orig" in variables:
+        orig = block[variables.index(variable + "_orig")][:, cells]
+    else:
+        rows = block.shape[2]
+        orig = np.ma.filled(source_var[:, band_start:band_start + rows, :], np.nan)[:, cells]
+    values[:, cells] = np.where(invalid[:, cells], orig, values[:, cells])
+    return counts
 
 
 def replace_nan_inf_with_orig(variable, source_file, ncfile_rechunked):
 
+    """ Replace invalid values in a merged file with the original values,
+    see find_invalid. Works on a _valid.nc4 copy of the file, only time
+    blocks with invalid values are written. To replace them without the
+    copy, use replace_invalid "merge" in write_netcdf. """
+
     ncfile_valid = ncfile_rechunked.rstrip(".nc4") + "_valid.nc4"
     shutil.copy(ncfile_rechunked, ncfile_valid)
 
-    print(f"Replace invalid values in {ncfile_rechunked} with original values from {source_file}")
+    print(f"Replace invalid values in {ncfile_valid} with original values from {source_file}")
 
     ncs = nc.Dataset(source_file, "r")
     ncf = nc.Dataset(ncfile_valid, "a")
@@ -87,20 +388,26 @@ def replace_nan_inf_with_orig(variable, source_file, ncfile_rechunked):
     var = ncf.variables[variable]
 
     chunklen = 1000
+    total = {"inf": 0, "nan": 0, "small_logp": 0}
     for ti in range(0,var.shape[0],chunklen):
         v = var[ti:ti+chunklen,:,:]
-        v_orig = var_orig[ti:ti+chunklen,:,:]
         logp = ncf['logp'][ti:ti+chunklen, :, :]
-        # This threshold for logp is to ensure that the model fits the data at all. It is mainly to catch values
-        # for logp like -7000
-        small_logp = logp < -300
-        isinf = np.isinf(v)
-        isnan = np.isnan(v)
-        print(f"{ti}: replace {isinf.sum()} inf values, {isnan.sum()} nan values and {small_logp.sum()} values with too small logp (<-300).")
-
-        v[isinf | isnan | small_logp] = v_orig[isinf | isnan | small_logp]
+        invalid, counts = find_invalid(v, logp)
+        if counts["cells"] == 0:
+            continue
+        report_invalid(ti, counts)
+        for kind in total:
+            total[kind] += counts[kind]
+
+        v_orig = var_orig[ti:ti+chunklen,:,:]
+        v[invalid] = v_orig[invalid]
         var[ti:ti+v.shape[0],:,:] = v
 
+    print(
+        "Replaced {0} inf values, {1} nan values and {2} values with too small logp.".format(
+            total["inf"], total["nan"], total["small_logp"]
+        )
+    )
     ncs.close()
     ncf.close()
     return ncfile_valid
@@ -0,0 +1,121 @@
+import os
+import socket
+import sqlite3
+import time
+
+
+class WorkQueue(object):
+    """ A queue of grid cells in a SQLite file on the shared file system.
+    Tasks claim cells until none are left, so fast tasks take over the work
+    of slow ones. A claim expires after lease seconds without renewal, so
+    cells of a task that died or hit its wall time are claimed again by
+    others. A live task renews its claims while it works on them, see renew.
+    Within a run, cells that are done or failed stay so. A new run, told
+    apart by its run id, continues where the last one stopped, or starts over
+    for failed or all cells, see fill.
+    """
+
+    def __init__(self, queue_file, lease):
+
+        self.lease = lease
+        self.renewed_at = 0.0
+        self.worker = socket.gethostname() + "_" + str(os.getpid())
+        # autocommit mode, transactions are opened explicitly
+        self.conn = sqlite3.connect(str(queue_file), timeout=600, isolation_level=None)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS cells ("
+            "run_number INTEGER PRIMARY KEY, cost REAL, status TEXT, "
+            "worker TEXT, claimed_at REAL, finished_at REAL)"
+        )
+        self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+
+    def fill(self, run_numbers, costs, run_id=None, redo_done=False, retry_failed=False):
+
+        """ Add cells to the queue. Cells already in the queue are kept
+        as they are, so every task can call this at start. The first task
+        of a run with a new run_id sets failed cells with retry_failed, and
+        done cells with redo_done, to todo again. The other tasks of the run
+        find run_id stored and leave them, so that each cell is run once. """
+
+        self.conn.execute("BEGIN IMMEDIATE")
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'run_id'").fetchone()
+        if run_id is not None and (row is None or row[0] != str(run_id)):
+            statuses = ["failed"] * retry_failed + ["done"] * redo_done
+            self.conn.executemany(
+                "UPDATE cells SET status = 'todo', worker = NULL, claimed_at = NULL, "
+                "finished_at = NULL WHERE status = ?",
+                [(status,) for status in statuses],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('run_id', ?)", (str(run_id),)
+            )
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO cells (run_number, cost, status) VALUES (?, ?, 'todo')",
+            [(int(n), float(cost)) for n, cost in zip(run_numbers, costs)],
+        )
+        self.conn.execute("COMMIT")
+
+    def claim(self, n):
+
+        """ Atomically claim up to n cells, the most expensive first.
+        Returns their run numbers, an empty list if the queue is empty. """
+
+        now = time.time()
+        self.conn.execute("BEGIN IMMEDIATE")
+        rows = self.conn.execute(
+            "SELECT run_number FROM cells WHERE status = 'todo' "
+            "OR (status = 'claimed' AND claimed_at < ?) "
+            "ORDER BY cost DESC, run_number LIMIT ?",
+            (now - self.lease, n),
+        ).fetchall()
+        run_numbers = [row[0] for row in rows]
+        self.conn.executemany(
+            "UPDATE cells SET status = 'claimed', worker = ?, claimed_at = ? "
+            "WHERE run_number = ?",
+            [(self.worker, now, run_number) for run_number in run_numbers],
+        )
+        self.conn.execute("COMMIT")
+        self.renewed_at = now
+        return run_numbers
+
+    def renew(self):
+
+        """ Extend the lease of all cells claimed by this task, so that a batch
+        that takes longer than lease is not claimed by another task. Writes
+        at most every quarter of the lease. """
+
+        now = time.time()
+        if now - self.renewed_at < self.lease / 4:
+            return
+        self.conn.execute(
+            "UPDATE cells SET claimed_at = ? WHERE worker = ? AND status = 'claimed'",
+            (now, self.worker),
+        )
+        self.renewed_at = now
+
+    def batches(self, n):
+
+        """ Yield claimed batches of up to n cells until the queue is empty. """
+
+        while True:
+            run_numbers = self.claim(n)
+            if len(run_numbers) == 0:
+                return
+            yield run_numbers
+
+    def finish(self, run_number, status="done"):
+
+        """ Mark a cell as done or failed. """
+
+        self.conn.execute(
+            "UPDATE cells SET status = ?, finished_at = ? WHERE run_number = ?",
+            (status, time.time(), int(run_number)),
+        )
+
+    def summary(self):
+        return dict(
+            self.conn.execute("SELECT status, COUNT(*) FROM cells GROUP BY status").fetchall()
+        )
+
+    def close(self):
+        self.conn.close()
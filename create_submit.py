@@ -1,7 +1,10 @@
 import os
 import jinja2
+import netCDF4 as nc
 import settings
 import pathlib
+import attrici.datahandler as dh
+import attrici.partition as partition
 
 jobname = pathlib.Path.cwd().name
 template_file = "submit.sh.jinja2"
@@ -28,7 +31,42 @@ def write_submit(settings, jobname, template_file):
     return fname
 
 
+def write_partition(settings):
+
+    """ Balance the grid cells over the job array by their estimated cost.
+    run_estimation.py reads the assignment from the partition file. """
+
+    input_file = settings.input_dir / settings.dataset / settings.source_file.lower()
+    landsea_mask_file = settings.input_dir / settings.landsea_file
+
+    obs_data = nc.Dataset(input_file, "r")
+    nc_lsmask = nc.Dataset(landsea_mask_file, "r")
+    df_specs = dh.get_cell_specs(
+        obs_data.variables["lat"][:],
+        obs_data.variables["lon"][:],
+        nc_lsmask.variables["LSM"][0, :],
+    )
+    nc_lsmask.close()
+
+    timing = partition.read_timing(settings.output_dir / "timing" / settings.variable)
+    n_masked = None
+    if timing is None and settings.cost_from_masked_days:
+        n_masked = partition.count_masked_days(obs_data, settings.variable, df_specs)
+    ntime = len(obs_data.variables["time"])
+    obs_data.close()
+
+    costs = partition.estimate_costs(
+        df_specs, timing=timing, timeout=settings.timeout, n_masked=n_masked, ntime=ntime
+    )
+    settings.output_dir.mkdir(parents=True, exist_ok=True)
+    partition.write_partition(
+        settings.output_dir / "partition.csv", df_specs, costs, settings.njobarray
+    )
+
+
 if __name__ == "__main__":
 
     write_submit(settings, jobname, template_file)
+    if settings.load_balance:
+        write_partition(settings)
     write_submit(settings, jobname, merge_template_file)
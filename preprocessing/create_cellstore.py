@@ -0,0 +1,59 @@
+import shutil
+import netCDF4 as nc
+import numpy as np
+from datetime import datetime
+from pathlib import Path
+import attrici.datahandler as dh
+
+# Rewrite input files to a cell store: the land cells only, each cell's
+# full time series contiguous on disk. run_estimation.py and
+# run_single_cell.py read it with input_format = "cellstore" in settings.py.
+
+variable_list = ["tas", "tasrange", "tasskew", "pr", "ps", "sfcwind", "rsds", "rlds", "hurs"]
+# out of "GSWP3", "GSWP3+ERA5" etc. see source_base for more datasets.
+dataset = "GSWP3-W5E5"
+sub = 1
+
+input_base = Path("/p/tmp/mengel/isimip/attrici/input/")
+landsea_file = input_base / ("ISIMIP2b_landseamask_generic_sub" + str(sub) + ".nc4")
+# number of time steps to read at once
+chunklen = 1000
+
+nc_lsmask = nc.Dataset(landsea_file, "r")
+ls_mask = nc_lsmask.variables["LSM"][0, :]
+nc_lsmask.close()
+
+for variable in variable_list:
+
+    TIME0 = datetime.now()
+    input_file = input_base / dataset / (variable + "_" + dataset.lower() + "_sub" + str(sub) + ".nc4")
+    store_dir = dh.get_cellstore_path(input_file)
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+
+    obs_data = nc.Dataset(input_file, "r")
+    nct = obs_data.variables["time"]
+    lats = obs_data.variables["lat"][:]
+    lons = obs_data.variables["lon"][:]
+    cells = dh.get_cell_specs(lats, lons, ls_mask)
+
+    store = dh.CellStore.create(
+        store_dir, variable, cells, nct[:], nct.units, lats, lons
+    )
+    index_lat = cells["index_lat"].values
+    index_lon = cells["index_lon"].values
+
+    data = obs_data.variables[variable]
+    for ti in range(0, data.shape[0], chunklen):
+        block = np.ma.filled(data[ti:ti + chunklen, :, :].astype(np.float32), np.nan)
+        store.data[:, ti:ti + block.shape[0]] = block[:, index_lat, index_lon].T
+        print(variable, "wrote time steps", ti, "to", ti + block.shape[0])
+
+    store.written[:] = 1
+    store.data.flush()
+    store.written.flush()
+    obs_data.close()
+    print(
+        "Wrote", len(cells), "cells to", store_dir,
+        "in {0:.1f} minutes.".format((datetime.now() - TIME0).total_seconds() / 60),
+    )
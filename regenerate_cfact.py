@@ -0,0 +1,144 @@
+import os
+import argparse
+import numpy as np
+import netCDF4 as nc
+from datetime import datetime
+import attrici
+import attrici.datahandler as dh
+import attrici.counterfactual as counterfactual
+import attrici.manifest as manifest
+import attrici.paramstore as paramstore
+import attrici.posterior as posterior
+import settings as s
+
+# Compute the counterfactual time series again from the weights in the parameter
+# store, for example after changing report_variables or the quantile mapping.
+# No model is built and nothing is estimated: parameters and quantile mapping
+# are computed for blocks of cells at once, without pymc3 and Theano.
+# Writes the same files as run_estimation.py.
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--block-cells",
+    type=int,
+    default=256,
+    help="number of cells that are read and computed together",
+)
+args = parser.parse_args()
+
+print("Version", attrici.__version__)
+
+try:
+    task_id = int(os.environ["SLURM_ARRAY_TASK_ID"])
+    njobarray = int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+except KeyError:
+    njobarray = 1
+    task_id = 0
+
+gmt_file = s.input_dir / s.dataset / s.gmt_file
+ncg = nc.Dataset(gmt_file, "r")
+gmt = np.squeeze(ncg.variables["tas"][:])
+ncg.close()
+
+input_file = s.input_dir / s.dataset / s.source_file.lower()
+if s.input_format == "cellstore":
+    store = dh.CellStore(dh.get_cellstore_path(input_file))
+    time_values, time_units = store.time, store.time_units
+    lats, lons = store.lats, store.lons
+else:
+    obs_data = nc.Dataset(input_file, "r")
+    nct = obs_data.variables["time"]
+    time_values, time_units = nct[:], nct.units
+    lats = obs_data.variables["lat"][:]
+    lons = obs_data.variables["lon"][:]
+
+param_store = paramstore.get_param_store(s)
+store_lats, store_lons, weights, logp, param_names = param_store.read()
+logposterior = posterior.posterior_for_var[s.variable](s.modes)
+if param_names != logposterior.param_names:
+    raise ValueError(f"{param_store.store_file} holds other parameters than the model.")
+
+# the cells with weights, in the order of the input grid
+df_specs = dh.get_cell_specs(lats, lons, np.isfinite(weights).all(axis=0).astype(int))
+task_cells = np.array_split(np.arange(len(df_specs)), njobarray)[task_id]
+df_specs = df_specs.iloc[task_cells]
+print("Regenerate", len(df_specs), "cells with weights in", param_store.store_file)
+
+if s.storage_format == ".cells":
+    # the store holds all land cells, not only those with weights
+    nc_lsmask = nc.Dataset(s.input_dir / s.landsea_file, "r")
+    land_cells = dh.get_cell_specs(lats, lons, nc_lsmask.variables["LSM"][0, :])
+    nc_lsmask.close()
+    output_store = dh.open_output_store(s, land_cells, time_values, time_units, lats, lons)
+
+context = dh.RunContext(time_values, time_units, gmt, s.modes)
+run_manifest = manifest.Manifest(manifest.get_manifest_dir(s), "regenerate_" + str(task_id))
+
+TIME0 = datetime.now()
+for block_start in range(0, len(df_specs), args.block_cells):
+
+    TIME_BLOCK = datetime.now()
+    block = df_specs.iloc[block_start:block_start + args.block_cells]
+    if s.input_format == "cellstore":
+        data = [
+            store.get(i, j) for i, j in zip(block["index_lat"], block["index_lon"])
+        ]
+    else:
+        data = dh.read_cells(
+            obs_data.variables[s.variable],
+            block["index_lat"].values,
+            block["index_lon"].values,
+        )
+
+    dfs, datamin, scale = [], [], []
+    for data_cell in data:
+        df, datamin_cell, scale_cell = context.create_dataframe(
+            np.ma.masked_invalid(data_cell), s.variable
+        )
+        dfs.append(df)
+        datamin.append(datamin_cell)
+        scale.append(scale_cell)
+
+    theta = weights[:, block["index_lat"].values, block["index_lon"].values].T
+    seeds = [
+        counterfactual.get_cell_seed(s.seed, lat, lon)
+        for lat, lon in zip(block["lat"], block["lon"])
+    ]
+    dfs_with_cfact = counterfactual.estimate_timeseries_batch(
+        s.variable, logposterior, dfs, theta, datamin, scale, s.report_variables, seeds
+    )
+    seconds = (datetime.now() - TIME_BLOCK).total_seconds() / len(block)
+
+    for (_, sp), df_with_cfact in zip(block.iterrows(), dfs_with_cfact):
+        logp_cell = manifest.get_logp(df_with_cfact)
+        if s.storage_format == ".cells":
+            dh.save_to_store(
+                output_store, df_with_cfact, sp["index_lat"], sp["index_lon"], s.report_to_netcdf
+            )
+            run_manifest.record(sp, "ok", seconds, logp=logp_cell)
+            continue
+        outdir_for_cell = dh.make_cell_output_dir(
+            s.output_dir, "timeseries", sp["lat"], sp["lon"], s.variable
+        )
+        fname_cell = dh.get_cell_filename(outdir_for_cell, sp["lat"], sp["lon"], s)
+        dh.save_to_disk(df_with_cfact, fname_cell, sp["lat"], sp["lon"], s.storage_format)
+        run_manifest.record(sp, "ok", seconds, fname_cell, logp_cell)
+
+    print(
+        "Regenerated cells {0} to {1} in {2:.1f} seconds.".format(
+            block_start,
+            block_start + len(block) - 1,
+            (datetime.now() - TIME_BLOCK).total_seconds(),
+        )
+    )
+
+run_manifest.close()
+if s.storage_format == ".cells":
+    output_store.close()
+if s.input_format != "cellstore":
+    obs_data.close()
+print(
+    "Regeneration completed for all cells. It took {0:.1f} minutes.".format(
+        (datetime.now() - TIME0).total_seconds() / 60
+    )
+)
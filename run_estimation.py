@@ -1,17 +1,29 @@
 import os
+import argparse
 import numpy as np
 import netCDF4 as nc
 from datetime import datetime
 from pathlib import Path
 import pandas as pd
-from func_timeout import func_timeout, FunctionTimedOut
 import attrici
-import attrici.estimator as est
 import attrici.datahandler as dh
+import attrici.manifest as manifest
+import attrici.paramstore as paramstore
+import attrici.partition as partition
+import attrici.pool as pool
+import attrici.workqueue as workqueue
 import settings as s
-from pymc3.parallel_sampling import ParallelSamplingError
 import logging
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help="number of worker processes that estimate cells in parallel",
+)
+args = parser.parse_args()
+
 s.output_dir.mkdir(parents=True,exist_ok=True)
 logging.basicConfig(
     filename=s.output_dir / "failing_cells.log",
@@ -37,6 +49,16 @@ except KeyError:
     task_id = 0
     s.progressbar = True
 
+if args.workers > 1:
+    # parallelism comes from the workers, not from chains
+    s.ncores_per_job = 1
+    s.progressbar = False
+
+variables = [s.variable] if s.joint_variables is None else list(s.joint_variables)
+cfgs = {variable: dh.settings_for_variable(s, variable) for variable in variables}
+if len(variables) > 1:
+    print("Joint run of", ", ".join(variables))
+
 dh.create_output_dirs(s.output_dir)
 
 gmt_file = s.input_dir / s.dataset / s.gmt_file
@@ -44,104 +66,315 @@ ncg = nc.Dataset(gmt_file, "r")
 gmt = np.squeeze(ncg.variables["tas"][:])
 ncg.close()
 
-input_file = s.input_dir / s.dataset / s.source_file.lower()
 landsea_mask_file = s.input_dir / s.landsea_file
 
-obs_data = nc.Dataset(input_file, "r")
-nc_lsmask = nc.Dataset(landsea_mask_file, "r")
-nct = obs_data.variables["time"]
-lats = obs_data.variables["lat"][:]
-lons = obs_data.variables["lon"][:]
-longrid, latgrid = np.meshgrid(lons, lats)
-jgrid, igrid = np.meshgrid(np.arange(len(lons)), np.arange(len(lats)))
+# the cell store or the netCDF dataset of each variable
+inputs = {}
+for variable, cfg in cfgs.items():
+    input_file = s.input_dir / s.dataset / cfg.source_file.lower()
+    if s.input_format == "cellstore":
+        inputs[variable] = dh.CellStore(dh.get_cellstore_path(input_file))
+    else:
+        inputs[variable] = nc.Dataset(input_file, "r")
 
+if s.input_format == "cellstore":
+    store = inputs[variables[0]]
+    time_values, time_units = store.time, store.time_units
+    lats, lons = store.lats, store.lons
+    time_axes = [(inputs[variable].time, inputs[variable].time_units) for variable in variables]
+else:
+    obs_data = inputs[variables[0]]
+    nct = obs_data.variables["time"]
+    time_values, time_units = nct[:], nct.units
+    lats = obs_data.variables["lat"][:]
+    lons = obs_data.variables["lon"][:]
+    time_axes = [
+        (inputs[variable].variables["time"][:], inputs[variable].variables["time"].units)
+        for variable in variables
+    ]
+# the time axis and Fourier series are shared
+for variable, (values, units) in zip(variables, time_axes):
+    if units != time_units or not np.array_equal(values, time_values):
+        raise ValueError(
+            f"The time axis of {variable} differs from that of {variables[0]}."
+        )
+nc_lsmask = nc.Dataset(landsea_mask_file, "r")
 ls_mask = nc_lsmask.variables["LSM"][0, :]
-df_specs = pd.DataFrame()
-df_specs["lat"] = latgrid[ls_mask == 1]
-df_specs["lon"] = longrid[ls_mask == 1]
-df_specs["index_lat"] = igrid[ls_mask == 1]
-df_specs["index_lon"] = jgrid[ls_mask == 1]
+df_specs = dh.get_cell_specs(lats, lons, ls_mask)
 
 print("A total of", len(df_specs), "grid cells to estimate.")
 
-if len(df_specs) % (njobarray) == 0:
-    print("Grid cells can be equally distributed to Slurm tasks")
-    calls_per_arrayjob = np.ones(njobarray) * len(df_specs) // (njobarray)
-else:
-    print("Slurm tasks not a divisor of number of grid cells, discard some cores.")
-    calls_per_arrayjob = np.ones(njobarray) * len(df_specs) // (njobarray) + 1
-    discarded_jobs = np.where(np.cumsum(calls_per_arrayjob) > len(df_specs))
-    calls_per_arrayjob[discarded_jobs] = 0
-    calls_per_arrayjob[discarded_jobs[0][0]] = len(df_specs) - calls_per_arrayjob.sum()
-
-assert calls_per_arrayjob.sum() == len(df_specs)
-# print(calls_per_arrayjob)
-
-# Calculate the starting and ending values for this task based
-# on the SLURM task and the number of runs per task.
-cum_calls_per_arrayjob = calls_per_arrayjob.cumsum(dtype=int)
-start_num = 0 if task_id == 0 else cum_calls_per_arrayjob[task_id-1]
-end_num = cum_calls_per_arrayjob[task_id] - 1
-run_numbers = np.arange(start_num, end_num + 1, 1, dtype=np.int)
-if len(run_numbers) == 0:
-    print ("No runs assigned for this SLURM task.")
+if s.storage_format == ".cells":
+    output_stores = {
+        variable: dh.open_output_store(cfg, df_specs, time_values, time_units, lats, lons)
+        for variable, cfg in cfgs.items()
+    }
+
+partition_file = s.output_dir / "partition.csv"
+if s.work_queue:
+    queue = workqueue.WorkQueue(
+        s.output_dir / ("queue_" + "_".join(variables) + ".sqlite"), s.lease
+    )
+    # costs only order the queue, expensive cells are done first
+    if partition_file.exists():
+        costs = partition.load_partition(partition_file, df_specs)["cost"]
+    else:
+        costs = pd.Series(1.0, index=df_specs.index)
+    # all tasks of an array job share its id, a local run is a run of its own
+    run_id = os.environ.get("SLURM_ARRAY_JOB_ID", "local_" + datetime.now().isoformat())
+    queue.fill(
+        costs.index.values,
+        costs.values,
+        run_id=run_id,
+        redo_done=not s.skip_if_data_exists,
+        retry_failed=s.retry_failed,
+    )
+    print("This is SLURM task", task_id, "which will take runs from the work queue.")
+elif s.load_balance and submitted and not partition_file.exists():
+    raise FileNotFoundError(
+        f"load_balance is set, but there is no {partition_file}. Submit with create_submit.py."
+    )
+elif s.load_balance and submitted:
+    run_numbers = partition.read_partition(partition_file, task_id, njobarray, df_specs)
+    print(
+        "This is SLURM task", task_id, "which will do", len(run_numbers),
+        "runs as assigned in", partition_file,
+    )
 else:
-    print("This is SLURM task", task_id, "which will do runs", start_num, "to", end_num)
+    if s.load_balance:
+        print("Warning: load_balance is only used for submitted runs, run all cells in order.")
+    if len(df_specs) % (njobarray) == 0:
+        print("Grid cells can be equally distributed to Slurm tasks")
+        calls_per_arrayjob = np.ones(njobarray) * len(df_specs) // (njobarray)
+    else:
+        print("Slurm tasks not a divisor of number of grid cells, discard some cores.")
+        calls_per_arrayjob = np.ones(njobarray) * len(df_specs) // (njobarray) + 1
+        discarded_jobs = np.where(np.cumsum(calls_per_arrayjob) > len(df_specs))
+        calls_per_arrayjob[discarded_jobs] = 0
+        calls_per_arrayjob[discarded_jobs[0][0]] = len(df_specs) - calls_per_arrayjob.sum()
 
-estimator = est.estimator(s)
+    assert calls_per_arrayjob.sum() == len(df_specs)
+    # print(calls_per_arrayjob)
 
-TIME0 = datetime.now()
+    # Calculate the starting and ending values for this task based
+    # on the SLURM task and the number of runs per task.
+    cum_calls_per_arrayjob = calls_per_arrayjob.cumsum(dtype=int)
+    start_num = 0 if task_id == 0 else cum_calls_per_arrayjob[task_id-1]
+    end_num = cum_calls_per_arrayjob[task_id] - 1
+    run_numbers = np.arange(start_num, end_num + 1, 1, dtype=np.int)
+    if len(run_numbers) == 0:
+        print ("No runs assigned for this SLURM task.")
+    else:
+        print("This is SLURM task", task_id, "which will do runs", start_num, "to", end_num)
 
-for n in run_numbers[:]:
-    sp = df_specs.loc[n, :]
+if s.warm_start and not s.work_queue:
+    # neighbours follow each other, so that each cell can start from the last
+    run_numbers = partition.spatial_order(df_specs, run_numbers)
 
-    # if lat >20: continue
-    print(
-        "This is SLURM task", task_id, "run number", n, "lat,lon", sp["lat"], sp["lon"]
+timing_files = {}
+run_manifests = {}
+param_stores = {}
+for variable, cfg in cfgs.items():
+    timing_dir = s.output_dir / "timing" / variable
+    timing_dir.mkdir(parents=True, exist_ok=True)
+    timing_files[variable] = timing_dir / ("task_" + str(task_id) + ".csv")
+    run_manifests[variable] = manifest.Manifest(
+        manifest.get_manifest_dir(cfg), "task_" + str(task_id)
     )
-    outdir_for_cell = dh.make_cell_output_dir(
-        s.output_dir, "timeseries", sp["lat"], sp["lon"], s.variable
+    print(len(run_manifests[variable].cells), "cells in the run manifest of", variable)
+    if s.map_estimate and s.param_store:
+        # written only by this process, with the weights the workers return
+        param_stores[variable] = paramstore.create_param_store(cfg, lats, lons)
+
+memory_limit = None if s.memory_limit is None else s.memory_limit * 2**30
+context = dh.RunContext(time_values, time_units, gmt, s.modes)
+supervisor = pool.Supervisor(
+    s,
+    context,
+    args.workers,
+    s.timeout,
+    memory_limit,
+    cfgs=cfgs,
+    heartbeat=queue.renew if s.work_queue else None,
+)
+
+TIME0 = datetime.now()
+
+batch_size = s.map_batch_size if s.map_estimate else 1
+
+if s.work_queue:
+    batches = queue.batches(batch_size)
+else:
+    batches = (
+        run_numbers[batch_start:batch_start + batch_size]
+        for batch_start in range(0, len(run_numbers), batch_size)
     )
-    fname_cell = dh.get_cell_filename(outdir_for_cell, sp["lat"], sp["lon"], s)
-
-    if s.skip_if_data_exists:
-        try:
-            dh.test_if_data_valid_exists(fname_cell)
-            print(f"Existing valid data in {fname_cell} . Skip calculation.")
-            continue
-        except Exception as e:
-            print(e)
-            print("No valid data found. Run calculation.")
-
-    data = obs_data.variables[s.variable][:, sp["index_lat"], sp["index_lon"]]
-    df, datamin, scale = dh.create_dataframe(nct[:], nct.units, data, gmt, s.variable)
-
-    try:
-        trace, dff = func_timeout(
-            s.timeout, estimator.estimate_parameters, args=(df, sp["lat"], sp["lon"], s.map_estimate)
+
+
+# variables of a run number that are not finished yet, and run numbers
+# with a failed variable
+pending = {}
+failed = set()
+
+
+def finish(n, variable, status):
+    """ A run number is finished in the work queue when all variables are. """
+    if not s.work_queue:
+        return
+    pending[n].discard(variable)
+    if status != "done":
+        failed.add(n)
+    if len(pending[n]) == 0:
+        del pending[n]
+        queue.finish(n, "failed" if n in failed else "done")
+        failed.discard(n)
+
+
+def read_block(variable, run_numbers):
+    """ Read the time series of the given cells in one pass over the input. """
+    return dict(
+        zip(
+            [(variable, n) for n in run_numbers],
+            dh.read_cells(
+                inputs[variable].variables[variable],
+                df_specs.loc[run_numbers, "index_lat"].values,
+                df_specs.loc[run_numbers, "index_lon"].values,
+            ),
         )
-    except (FunctionTimedOut, ParallelSamplingError, ValueError) as error:
-        if str(error) == "Modes larger 1 are not allowed for the censored model.":
-            raise error
+    )
+
+
+def write_results(results):
+    """ Write the results of a batch to disk as they come in. The weights go
+    to the parameter store first, in one write per variable, so that a cell
+    in the manifest always has its weights. """
+    for variable, param_store in param_stores.items():
+        new_weights = [
+            (result[2]["lat"], result[2]["lon"]) + result[7]
+            for result in results
+            if result[0] == variable and result[7] is not None
+        ]
+        if len(new_weights) > 0:
+            lats_new, lons_new, theta, logp = zip(*new_weights)
+            param_store.write(lats_new, lons_new, np.array(theta), logp)
+
+    for variable, n, sp, fname_cell, status, seconds, result, weights in results:
+        run_manifest = run_manifests[variable]
+        if status == "ok" and s.storage_format == ".cells":
+            dh.save_to_store(
+                output_stores[variable],
+                result,
+                sp["index_lat"],
+                sp["index_lon"],
+                cfgs[variable].report_to_netcdf,
+            )
+            run_manifest.record(sp, status, seconds, logp=manifest.get_logp(result))
+        elif status == "ok":
+            dh.save_to_disk(result, fname_cell, sp["lat"], sp["lon"], s.storage_format)
+            run_manifest.record(sp, status, seconds, fname_cell, manifest.get_logp(result))
         else:
-            print("Sampling at", sp["lat"], sp["lon"], " timed out or failed.")
-            print(error)
+            run_manifest.record(sp, status, seconds)
+            print("Sampling of", variable, "at", sp["lat"], sp["lon"], " timed out or failed.")
+            print(result)
             logger.error(
-                str(
-                    "lat,lon: "
-                    + str(sp["lat"])
-                    + " "
-                    + str(sp["lon"])
-                    + " : "
-                    + str(error)
-                )
+                variable + " lat,lon: " + str(sp["lat"]) + " " + str(sp["lon"]) + " : " + result
+            )
+        partition.append_timing(timing_files[variable], sp["lat"], sp["lon"], seconds, status)
+        finish(n, variable, "done" if status == "ok" else "failed")
+
+
+# the cell store is read cell by cell, each cell is contiguous there
+block_read = s.block_read and s.input_format != "cellstore"
+cell_data = {}
+if block_read and not s.work_queue and len(run_numbers) > 0:
+    # all cells of this task are known, so read them before estimation starts
+    for variable in variables:
+        cell_data.update(read_block(variable, run_numbers))
+
+for batch in batches:
+
+    cells = []
+    for n in batch:
+        sp = df_specs.loc[n, :]
+        pending[n] = set(variables)
+
+        # if lat >20: continue
+        print(
+            "This is SLURM task", task_id, "run number", n, "lat,lon", sp["lat"], sp["lon"]
+        )
+        for variable, cfg in cfgs.items():
+            if s.storage_format == ".cells":
+                fname_cell = None
+                if s.skip_if_data_exists and output_stores[variable].is_written(
+                    sp["index_lat"], sp["index_lon"]
+                ):
+                    print("Existing data of", variable, "in output store. Skip calculation.")
+                    finish(n, variable, "done")
+                    continue
+                cells.append((variable, n, sp, fname_cell))
+                continue
+
+            outdir_for_cell = dh.make_cell_output_dir(
+                s.output_dir, "timeseries", sp["lat"], sp["lon"], variable
             )
+            fname_cell = dh.get_cell_filename(outdir_for_cell, sp["lat"], sp["lon"], cfg)
+
+            if s.skip_if_data_exists and run_manifests[variable].is_done(
+                sp["index_lat"], sp["index_lon"], fname_cell
+            ):
+                print(f"Existing valid data in {fname_cell} . Skip calculation.")
+                finish(n, variable, "done")
+                continue
+            if s.skip_if_data_exists and fname_cell.exists():
+                # written before the run had a manifest
+                try:
+                    dh.test_if_data_valid_exists(fname_cell)
+                    print(f"Existing valid data in {fname_cell} . Skip calculation.")
+                    run_manifests[variable].record(sp, "ok", np.nan, fname_cell)
+                    finish(n, variable, "done")
+                    continue
+                except Exception as e:
+                    print(e)
+                    print("No valid data found. Run calculation.")
+
+            cells.append((variable, n, sp, fname_cell))
+
+    for variable in variables:
+        to_read = [
+            cell[1] for cell in cells if cell[0] == variable and cell[:2] not in cell_data
+        ]
+        if block_read and len(to_read) > 0:
+            cell_data.update(read_block(variable, to_read))
+
+    for k, (variable, n, sp, fname_cell) in enumerate(cells):
+        if s.input_format == "cellstore":
+            data = np.ma.masked_invalid(inputs[variable].get(sp["index_lat"], sp["index_lon"]))
+        elif block_read:
+            data = np.ma.masked_invalid(cell_data.pop((variable, n)))
+        else:
+            data = inputs[variable].variables[variable][:, sp["index_lat"], sp["index_lon"]]
+        cells[k] = (variable, n, sp, fname_cell, data)
+
+    if len(cells) == 0:
         continue
 
-    df_with_cfact = estimator.estimate_timeseries(dff, trace, datamin, scale, s.map_estimate)
-    dh.save_to_disk(df_with_cfact, fname_cell, sp["lat"], sp["lon"], s.storage_format)
+    write_results(supervisor.submit(cells, batch_size > 1))
+
+write_results(supervisor.join())
+supervisor.close()
+for run_manifest in run_manifests.values():
+    run_manifest.close()
+
+if s.work_queue:
+    print("Work queue is empty:", queue.summary())
+    queue.close()
 
-obs_data.close()
+if s.storage_format == ".cells":
+    for output_store in output_stores.values():
+        output_store.close()
+if s.input_format != "cellstore":
+    for obs_data in inputs.values():
+        obs_data.close()
 nc_lsmask.close()
 print(
     "Estimation completed for all cells. It took {0:.1f} minutes.".format(
@@ -4,10 +4,11 @@ import netCDF4 as nc
 from datetime import datetime
 from pathlib import Path
 import pandas as pd
-from func_timeout import func_timeout, FunctionTimedOut
 import attrici
-import attrici.estimator as est
 import attrici.datahandler as dh
+import attrici.manifest as manifest
+import attrici.paramstore as paramstore
+import attrici.pool as pool
 import settings as s
 
 print("Version", attrici.__version__)
@@ -30,11 +31,17 @@ ncg.close()
 input_file = s.input_dir / s.dataset / s.source_file.lower()
 # landsea_mask_file = s.input_dir / s.landsea_file
 
-obs_data = nc.Dataset(input_file, "r")
+if s.input_format == "cellstore":
+    store = dh.CellStore(dh.get_cellstore_path(input_file))
+    time_values, time_units = store.time, store.time_units
+    lats, lons = store.lats, store.lons
+else:
+    obs_data = nc.Dataset(input_file, "r")
+    nct = obs_data.variables["time"]
+    time_values, time_units = nct[:], nct.units
+    lats = obs_data.variables["lat"][:]
+    lons = obs_data.variables["lon"][:]
 # nc_lsmask = nc.Dataset(landsea_mask_file, "r")
-nct = obs_data.variables["time"]
-lats = obs_data.variables["lat"][:]
-lons = obs_data.variables["lon"][:]
 
 sp = {}
 sp["lat"] = lat
@@ -46,34 +53,49 @@ except IndexError:
     print("lat or lon not present in data, adjust!")
     raise
 
-estimator = est.estimator(s)
+memory_limit = None if s.memory_limit is None else s.memory_limit * 2**30
+param_store = None
+if s.map_estimate and s.param_store:
+    param_store = paramstore.create_param_store(s, lats, lons)
+context = dh.RunContext(time_values, time_units, gmt, s.modes)
+supervisor = pool.Supervisor(s, context, 1, s.timeout, memory_limit)
 
 TIME0 = datetime.now()
 
 # print( sp["index_lat"], sp["index_lon"])
-data = obs_data.variables[s.variable][:, sp["index_lat"], sp["index_lon"]]
-df, datamin, scale = dh.create_dataframe(nct[:], nct.units, data, gmt, s.variable)
+if s.input_format == "cellstore":
+    data = np.ma.masked_invalid(store.get(sp["index_lat"], sp["index_lon"]))
+else:
+    data = obs_data.variables[s.variable][:, sp["index_lat"], sp["index_lon"]]
 
-try:
-    trace, dff = func_timeout(
-        s.timeout, estimator.estimate_parameters, args=(df, sp["lat"], sp["lon"], s.map_estimate)
-    )
-except (FunctionTimedOut, ValueError) as error:
-    if str(error) == "Modes larger 1 are not allowed for the censored model.":
-        raise error
-    else:
-        print("Sampling at", sp["lat"], sp["lon"], " timed out or failed.")
-        print(error)
-    # continue
-
-df_with_cfact = estimator.estimate_timeseries(dff, trace, datamin, scale, s.map_estimate)
 outdir_for_cell = dh.make_cell_output_dir(
     s.output_dir, "timeseries", sp["lat"], sp["lon"], s.variable
 )
 fname_cell = dh.get_cell_filename(outdir_for_cell, sp["lat"], sp["lon"], s)
-dh.save_to_disk(df_with_cfact, fname_cell, sp["lat"], sp["lon"], s.storage_format)
+supervisor.submit([(s.variable, 0, sp, fname_cell, data)], False)
+variable, n, sp, fname_cell, status, seconds, result, weights = supervisor.join()[0]
+supervisor.close()
+if param_store is not None and weights is not None:
+    param_store.write([sp["lat"]], [sp["lon"]], [weights[0]], [weights[1]])
+
+run_manifest = manifest.Manifest(manifest.get_manifest_dir(s), "single_cell")
+if status == "ok" and s.storage_format == ".cells":
+    # the store of a run with run_estimation.py, which holds all land cells
+    output_store = dh.CellStore(dh.get_output_store_path(s))
+    dh.save_to_store(output_store, result, sp["index_lat"], sp["index_lon"], s.report_to_netcdf)
+    output_store.close()
+    run_manifest.record(sp, status, seconds, logp=manifest.get_logp(result))
+elif status == "ok":
+    dh.save_to_disk(result, fname_cell, sp["lat"], sp["lon"], s.storage_format)
+    run_manifest.record(sp, status, seconds, fname_cell, manifest.get_logp(result))
+else:
+    run_manifest.record(sp, status, seconds)
+    print("Sampling at", sp["lat"], sp["lon"], " timed out or failed.")
+    print(result)
 
-obs_data.close()
+run_manifest.close()
+if s.input_format != "cellstore":
+    obs_data.close()
 # nc_lsmask.close()
 print(
     "Estimation completed for all cells. It took {0:.1f} minutes.".format(
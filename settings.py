@@ -22,9 +22,19 @@ input_dir = Path(data_dir) / "input"
 output_dir = Path(data_dir) / "output" / Path.cwd().name
 
 # max time in sec for sampler for a single grid cell.
+# The worker process of a cell that takes longer is killed.
 timeout = 60 * 60
+# max resident memory in GB for a single grid cell, including sampler
+# processes, None for no limit. The worker process is killed if exceeded.
+memory_limit = None
 # tas, tasrange pr, prsn, prsnratio, ps, rlds, wind, hurs
 variable = "tas"  # select variable to detrend
+# estimate several variables in one run of run_estimation.py, for example
+# ["tas", "tasrange", "tasskew", "pr"]. Each cell is done for all of them in one go,
+# sharing the cell list, GMT, time axis and Fourier series. The file names below
+# and report_to_netcdf are taken for each with variable replaced.
+# None runs only variable.
+joint_variables = None
 
 # number of modes for fourier series of model
 # TODO: change to one number only, as only the first element of list is used.
@@ -32,8 +42,40 @@ modes = [4, 4, 4, 4]
 # NUTS or ADVI
 # Compute maximum approximate posterior # todo is this equivalent to maximum likelihood?
 map_estimate = True
+# number of grid cells to fit together in one vectorized MAP optimization.
+# 1 fits cell by cell. Only used with map_estimate.
+map_batch_size = 1
+# "pymc3" or "numpy". The numpy engine finds the MAP without Theano, using
+# Newton steps with analytic Hessian for the Normal models (tas, ps, rlds, tasskew, rsds)
+# and L-BFGS-B otherwise. Only used with map_estimate.
+engine = "pymc3"
 # bayesian inference will only be called if map_estimate=False
+# NUTS, ADVI or Laplace. Laplace approximates the posterior of the weights by
+# a Normal around the MAP with the inverse negative Hessian as covariance, at a
+# small multiple of the cost of the MAP. ADVI refines that Normal by maximizing
+# the ELBO, see posterior.fit_advi. Both use approximation_draws weights.
 inference = "NUTS"
+approximation_draws = 1000
+# "fullrank" or "meanfield" covariance of ADVI
+advi_method = "fullrank"
+# days per minibatch of ADVI, None for all days
+advi_batch_size = 1000
+advi_max_iterations = 10000
+# stop when the averaged parameters change by less than this many standard
+# deviations from one window of 100 iterations to the next
+advi_tolerance = 0.1
+# quantiles of the parameters over the posterior samples to report, for
+# example (0.05, 0.95) adds columns like mu_q05 and mu_q95. None for none.
+# Not used with map_estimate.
+uncertainty_band = None
+# start the fit of a cell from the nearest already fitted cell within
+# warm_start_distance degrees: the MAP from its weights, NUTS from its
+# posterior mean, step size and mass matrix with only warm_start_tune tuning
+# steps. Without work_queue, the cells of a task are run in serpentine order
+# over the grid so that neighbours follow each other.
+warm_start = False
+warm_start_distance = 2.0
+warm_start_tune = 100
 
 seed = 0  # for deterministic randomisation
 subset = 1  # only use every subset datapoint for bayes estimation for speedup
@@ -49,7 +91,17 @@ landsea_file = "ISIMIP2b_landseamask_generic_sub" + str(lateral_sub) + ".nc4"
 # source_file = variable + "_" + dataset + "_sub.nc4"
 source_file = variable + "_" + dataset + "_sub" + str(lateral_sub) + ".nc4"
 cfact_file = variable + "_" + dataset + "_cfactual.nc4"
-# .h5 or .csv
+# "netcdf" reads the input file, "cellstore" reads the cell-major copy of it
+# written by preprocessing/create_cellstore.py
+input_format = "netcdf"
+# read the input time series of many cells in a few large reads over time
+# chunks and lat bands instead of one read per cell. Reads all cells of a
+# task at start, or each claimed batch with work_queue.
+block_read = True
+# .h5 or .csv for one file per cell, .npz for one compressed file per cell
+# with float32 columns and the time axis stored once, see dh.save_npz,
+# or .cells to write all cells of the report_to_netcdf variables into one
+# preallocated store in output_dir/cfact, see dh.CellStore.
 storage_format = ".h5"
 # "all" or list like ["y","y_scaled","mu","sigma"]
 # for productions runs, use ["cfact"]
@@ -61,6 +113,10 @@ report_to_netcdf = [variable, variable + "_orig", "logp"]
 
 # if map_estimate used, save_trace only writes small data amounts, so advised to have True.
 save_trace = True
+# with map_estimate, save the weights of all cells to one netCDF file
+# output_dir/params_<variable>.nc4 instead of one pickle per cell in traces.
+# The file system needs working file locks.
+param_store = True
 skip_if_data_exists = True
 
 # model run settings
@@ -77,3 +133,24 @@ progressbar = True  # print progress in output (.err file for mpi)
 # number of parallel jobs through jobarray
 # needs to be divisor of number of grid cells
 njobarray = 64
+# balance grid cells over the job array by their estimated runtime.
+# create_submit.py writes the assignment to output_dir/partition.csv.
+# Runtimes are taken from the timing logs of a previous run if present.
+# This opens the input and the landmask on submit. run_estimation.py rejects a
+# partition that was written for other grid cells.
+load_balance = False
+# without timing logs, estimate runtime from the number of masked days.
+# This reads the full input once.
+cost_from_masked_days = False
+# let tasks claim grid cells from a shared queue (a SQLite file in output_dir)
+# until it is empty, instead of working on a fixed set of cells.
+# The file system needs working file locks.
+work_queue = False
+# seconds after which claimed cells (a batch with map_batch_size) are given to another task,
+# if the claiming task did not finish it (died or hit the wall time). A running task
+# renews the lease of its cells while it works on them, so it need not cover a batch.
+lease = 2 * timeout
+# the queue file stays in output_dir, so a new run continues with the cells left todo.
+# Its first task sets failed cells to todo again with retry_failed, and done cells
+# too if skip_if_data_exists is False. A run is a SLURM array job or a local run.
+retry_failed = True
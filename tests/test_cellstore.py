@@ -0,0 +1,32 @@
+import numpy as np
+import attrici.datahandler as dh
+
+
+def test_cellstore_round_trip(tmp_path):
+
+    lats, lons = np.array([10.25, 10.75]), np.array([0.25, 0.75, 1.25])
+    cells = dh.get_cell_specs(lats, lons, np.array([[1, 0, 1], [1, 1, 0]]))
+    time_values = np.arange(20.0)
+    store = dh.CellStore.create(
+        tmp_path / "store",
+        "tas",
+        cells,
+        time_values,
+        "days since 2000-01-01",
+        lats,
+        lons,
+        variables=["tas", "tas_orig"],
+    )
+    values = {"tas": np.arange(20.0), "tas_orig": -np.arange(20.0)}
+    store.write(1, 1, values)
+    store.close()
+
+    store = dh.CellStore(tmp_path / "store")
+    assert store.variables == ["tas", "tas_orig"]
+    assert store.time_units == "days since 2000-01-01"
+    np.testing.assert_array_equal(store.time, time_values)
+    np.testing.assert_array_equal(store.get(1, 1), values["tas"])
+    np.testing.assert_array_equal(store.get(1, 1, "tas_orig"), values["tas_orig"])
+    assert store.is_written(1, 1)
+    assert not store.is_written(0, 0)
+    assert store.written.sum() == 1
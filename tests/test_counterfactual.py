@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import attrici.counterfactual as counterfactual
+import attrici.posterior as posterior
+
+MODES = [2]
+
+
+def make_dfs(ncells, ntime=730, seed=0):
+
+    """ Dataframes of pr cells on a shared time axis, a third of the days dry. """
+
+    rng = np.random.RandomState(seed)
+    t = np.arange(ntime) / 365.25
+    dfs = []
+    for _ in range(ncells):
+        df = pd.DataFrame({"gmt_scaled": np.linspace(0, 1, ntime)})
+        for k in range(MODES[0]):
+            df[f"mode_0_{2 * k}"] = np.sin(2 * np.pi * (k + 1) * t)
+            df[f"mode_0_{2 * k + 1}"] = np.cos(2 * np.pi * (k + 1) * t)
+        y_scaled = rng.gamma(4.0, 0.1, ntime)
+        y_scaled[rng.rand(ntime) < 0.3] = np.nan
+        df["y_scaled"] = y_scaled
+        df["y"] = np.nan_to_num(y_scaled)
+        dfs.append(df)
+    return dfs
+
+
+def test_batch_matches_single_cells_with_seeds():
+
+    post = posterior.BernoulliGamma(MODES)
+    theta = np.random.RandomState(1).normal(0, 0.5, (3, post.size))
+    seeds = [counterfactual.get_cell_seed(0, 10.25, lon) for lon in [0.25, 0.75, 1.25]]
+    dfs = counterfactual.estimate_timeseries_batch(
+        "pr", post, make_dfs(3), theta, [0.0] * 3, [1.0] * 3, "all", seeds
+    )
+    for k, df in enumerate(make_dfs(3)):
+        trace_obs, trace_cfact = post.resample(post.to_dict(theta[k]), df)
+        d = pd.DataFrame({p: trace_obs[p][0] for p in ["mu", "sigma", "pbern"]})
+        for p in ["mu", "sigma", "pbern"]:
+            d[f"{p}_ref"] = trace_cfact[p][0]
+        expected = counterfactual.bernoulli_gamma(d, df["y_scaled"], [seeds[k]])
+        np.testing.assert_allclose(dfs[k]["cfact_scaled"], expected)
+        np.testing.assert_allclose(dfs[k]["pbern_ref"], d["pbern_ref"])
+
+
+def test_bernoulli_gamma_depends_on_seed_only():
+
+    post = posterior.BernoulliGamma(MODES)
+    theta = np.random.RandomState(1).normal(0, 0.5, (1, post.size))
+    cfacts = [
+        counterfactual.estimate_timeseries_batch(
+            "pr", post, make_dfs(1), theta, [0.0], [1.0], "all", [seed]
+        )[0]["cfact_scaled"].values
+        for seed in [[0, 1, 2], [0, 1, 2], [0, 1, 3]]
+    ]
+    np.testing.assert_array_equal(cfacts[0], cfacts[1])
+    assert not np.array_equal(cfacts[0], cfacts[2])
@@ -0,0 +1,102 @@
+import numpy as np
+import netCDF4 as nc
+import attrici.diagnostics as diag
+
+FILL_VALUE = 1e20
+UNITS = "days since 2000-01-01 00:00:00"
+
+
+def run_diagnostics(tmp_path, data, slab_time=50, monthly=False, difference=None):
+
+    nvariables, ntime, nlat, nlon = data.shape
+    variables = ["tas", "tas_orig"][:nvariables]
+    diagnostics = diag.Diagnostics(
+        str(tmp_path / "cfact"),
+        variables,
+        np.arange(ntime, dtype=float),
+        UNITS,
+        "standard",
+        np.arange(nlat, dtype=float),
+        np.arange(nlon, dtype=float),
+        {},
+        FILL_VALUE,
+        monthly=monthly,
+        difference=difference,
+    )
+    for t0 in range(0, ntime, slab_time):
+        diagnostics.add(t0, data[:, t0:t0 + slab_time])
+    diagnostics.close()
+    return variables
+
+
+def make_data(ntime=731, nlat=2, nlon=3):
+
+    """ Linear trends in time with a seasonal cycle, and some missing values. """
+
+    t = np.arange(ntime, dtype=float)[None, :, None, None]
+    intercept = np.arange(nlat * nlon, dtype=float).reshape(1, 1, nlat, nlon)
+    slope = np.array([0.01, -0.02]).reshape(2, 1, 1, 1)
+    data = intercept + slope * t + np.sin(2 * np.pi * t / 365.0)
+    data = np.broadcast_to(data, (2, ntime, nlat, nlon)).astype(np.float32).copy()
+    data[0, ::7, 0, 0] = FILL_VALUE
+    data[1, 100:200, 1, 2] = np.nan
+    # a cell without data
+    data[:, :, 1, 0] = FILL_VALUE
+    return data
+
+
+def test_yearmean(tmp_path):
+
+    data = make_data()
+    variables = run_diagnostics(tmp_path, data)
+    dates = nc.num2date(np.arange(data.shape[1]), UNITS, "standard")
+    years = np.array([date.year for date in dates])
+    with nc.Dataset(tmp_path / "cfact_yearmean.nc4") as ds:
+        assert len(ds.variables["time"]) == 2
+        for k, var in enumerate(variables):
+            means = np.ma.filled(ds.variables[var][:], np.nan)
+            for n, year in enumerate(np.unique(years)):
+                values = data[k, years == year]
+                values = np.where(values == FILL_VALUE, np.nan, values).astype(float)
+                count = np.isfinite(values).sum(axis=0)
+                expected = np.where(
+                    count > 0, np.nansum(values, axis=0) / np.maximum(count, 1), np.nan
+                )
+                np.testing.assert_allclose(means[n], expected, rtol=1e-5, atol=1e-5)
+
+
+def test_monmean_periods(tmp_path):
+
+    data = make_data(ntime=90)
+    run_diagnostics(tmp_path, data, slab_time=17, monthly=True)
+    with nc.Dataset(tmp_path / "cfact_monmean.nc4") as ds:
+        times = ds.variables["time"][:]
+        np.testing.assert_allclose(times, [15.0, 45.0, 74.5])
+        np.testing.assert_allclose(
+            ds.variables["tas"][0, 0, 1], data[0, :31, 0, 1].mean(), rtol=1e-6
+        )
+
+
+def test_trend_matches_least_squares(tmp_path):
+
+    data = make_data()
+    variables = run_diagnostics(tmp_path, data, difference=("tas_orig", "tas"))
+    t = np.arange(data.shape[1], dtype=float)
+    with nc.Dataset(tmp_path / "cfact_trend_1.nc4") as ds1, nc.Dataset(
+        tmp_path / "cfact_trend_2.nc4"
+    ) as ds2:
+        for k, var in enumerate(variables):
+            for i, j in [(0, 0), (0, 1), (1, 2)]:
+                values = data[k, :, i, j]
+                valid = np.isfinite(values) & (values != FILL_VALUE)
+                slope, intercept = np.polyfit(t[valid], values[valid], 1)
+                np.testing.assert_allclose(ds1.variables[var][i, j], intercept, rtol=1e-4)
+                np.testing.assert_allclose(ds2.variables[var][i, j], slope, rtol=1e-4)
+            assert np.ma.is_masked(ds2.variables[var][1, 0])
+
+        difference = ds2.variables["tas_orig_minus_tas"][:]
+        np.testing.assert_allclose(
+            difference[0, 1], ds2.variables["tas_orig"][0, 1] - ds2.variables["tas"][0, 1]
+        )
+        np.testing.assert_allclose(difference[0, 1], -0.03, rtol=1e-3)
+        assert np.ma.is_masked(difference[1, 0])
@@ -0,0 +1,40 @@
+import attrici.manifest as manifest
+
+
+def test_manifest_round_trip(tmp_path):
+
+    cell_file = tmp_path / "cell.h5"
+    cell_file.write_bytes(b"12345")
+    sp = {"index_lat": 3, "index_lon": 4, "lat": 10.25, "lon": 0.75}
+
+    task = manifest.Manifest(tmp_path / "manifest", "task_0")
+    task.record(sp, "ok", 12.3, cell_file, logp=-5.5)
+    task.record(dict(sp, index_lon=5), "failed", 1.0)
+    task.close()
+    # a line cut off by a crash is ignored
+    with open(tmp_path / "manifest" / "task_1.csv", "w") as f:
+        f.write(",".join(manifest.FIELDS) + "\n3,6,10.25,1.25,ok,")
+
+    records = manifest.read_manifest(tmp_path / "manifest")
+    assert sorted(records) == [(3, 4), (3, 5)]
+    assert records[(3, 4)]["size"] == 5
+    assert records[(3, 4)]["logp"] == -5.5
+    assert records[(3, 5)]["status"] == "failed"
+
+    reopened = manifest.Manifest(tmp_path / "manifest", "task_2")
+    assert reopened.is_done(3, 4, cell_file)
+    assert not reopened.is_done(3, 5)
+    cell_file.write_bytes(b"123")
+    assert not reopened.is_done(3, 4, cell_file)
+
+
+def test_manifest_keeps_last_record_of_a_cell(tmp_path):
+
+    sp = {"index_lat": 0, "index_lon": 0, "lat": 0.25, "lon": 0.25}
+    first = manifest.Manifest(tmp_path, "task_0")
+    first.record(sp, "failed", 1.0)
+    first.close()
+    second = manifest.Manifest(tmp_path, "task_1")
+    second.record(sp, "ok", 1.0)
+    second.close()
+    assert manifest.read_manifest(tmp_path)[(0, 0)]["status"] == "ok"
@@ -0,0 +1,68 @@
+import numpy as np
+import pandas as pd
+import pytest
+import attrici.datahandler as dh
+
+
+def test_npz_round_trip(tmp_path):
+
+    cell_dir = tmp_path / "tas" / "lat_1.25"
+    cell_dir.mkdir(parents=True)
+    df = pd.DataFrame(
+        {
+            "ds": pd.date_range("2000-01-01", periods=10),
+            "y": np.arange(10.0),
+            "cfact": np.arange(10.0) + 0.5,
+            "is_dry_day": np.arange(10) % 2 == 0,
+        }
+    )
+    dh.save_npz(df, cell_dir / "full.npz")
+    assert (tmp_path / "tas" / "ds.npy").exists()
+    read = dh.read_npz(cell_dir / "full.npz")
+    assert list(read.columns) == list(df.columns)
+    np.testing.assert_array_equal(read["ds"].values, df["ds"].values)
+    np.testing.assert_array_equal(read["cfact"].values, df["cfact"].values)
+    assert read["cfact"].dtype == np.float32
+    assert read["is_dry_day"].dtype == bool
+    np.testing.assert_array_equal(dh.read_npz(cell_dir / "full.npz", ["y"])["y"], df["y"])
+
+    # a subset keeps its index and its own dates
+    subset = df.iloc[[1, 4, 7]]
+    dh.save_npz(subset, cell_dir / "subset.npz")
+    read = dh.read_npz(cell_dir / "subset.npz")
+    np.testing.assert_array_equal(read.index.values, [1, 4, 7])
+    np.testing.assert_array_equal(read["ds"].values, subset["ds"].values)
+
+
+def test_npz_time_axis_is_checked(tmp_path):
+
+    cell_dir = tmp_path / "tas" / "lat_1.25"
+    cell_dir.mkdir(parents=True)
+    # the first cell is a subset, it does not define the time axis
+    df = pd.DataFrame({"ds": pd.date_range("2000-01-01", periods=10), "y": np.arange(10.0)})
+    dh.save_npz(df.iloc[2:], cell_dir / "subset.npz")
+    assert not (tmp_path / "tas" / "ds.npy").exists()
+
+    dh.save_npz(df, cell_dir / "full.npz")
+    with pytest.raises(ValueError):
+        dh.save_npz(df.iloc[:5], cell_dir / "short.npz")
+    np.save(tmp_path / "tas" / "ds.npy", df["ds"].values[:8])
+    with pytest.raises(ValueError):
+        dh.read_npz(cell_dir / "full.npz")
+
+
+def test_npz_without_ds(tmp_path):
+
+    cell_dir = tmp_path / "tas" / "lat_1.25"
+    cell_dir.mkdir(parents=True)
+    df = pd.DataFrame({"cfact": np.arange(10.0)})
+    dh.save_npz(df, cell_dir / "cfact_only.npz")
+    assert not (tmp_path / "tas" / "ds.npy").exists()
+    read = dh.read_npz(cell_dir / "cfact_only.npz")
+    assert list(read.columns) == ["cfact"]
+    np.testing.assert_array_equal(read["cfact"].values, df["cfact"].values)
+
+    # a time axis of another length does not matter for cells without ds
+    np.save(tmp_path / "tas" / "ds.npy", np.arange(3).astype("datetime64[D]"))
+    dh.save_npz(df, cell_dir / "cfact_only.npz")
+    assert len(dh.read_npz(cell_dir / "cfact_only.npz")) == 10
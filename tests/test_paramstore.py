@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+import attrici.paramstore as paramstore
+
+
+def test_paramstore_round_trip(tmp_path):
+
+    lats, lons = np.array([10.25, 10.75]), np.array([0.25, 0.75, 1.25])
+    store = paramstore.ParamStore(tmp_path / "params_tas.nc4")
+    store.create(lats, lons, ["a", "b", "c"], "tas")
+    # creating again with the same parameters keeps the store
+    store.create(lats, lons, ["a", "b", "c"], "tas")
+    with pytest.raises(ValueError):
+        store.create(lats, lons, ["a", "b"], "tas")
+
+    theta = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.0]])
+    store.write([lats[0], lats[1]], [lons[2], lons[0]], theta, [-10.0, -20.0])
+
+    reader = paramstore.ParamStore(tmp_path / "params_tas.nc4")
+    weights, logp = reader.get(lats[1], lons[0])
+    np.testing.assert_array_equal(weights, theta[1])
+    assert logp == -20.0
+    assert reader.get(lats[0], lons[0]) is None
+    _, _, weights, logp, names = reader.read()
+    assert names == ["a", "b", "c"]
+    assert np.isfinite(logp).sum() == 2
+
+    # remembered cells are seen by get, but not written
+    reader.remember([lats[0]], [lons[0]], [np.zeros(3)], [0.0])
+    assert reader.get(lats[0], lons[0]) is not None
+    assert paramstore.ParamStore(tmp_path / "params_tas.nc4").get(lats[0], lons[0]) is None
@@ -0,0 +1,251 @@
+import numpy as np
+import pandas as pd
+import pytest
+from scipy import stats
+import attrici.posterior as posterior
+
+MODES = [2]
+
+
+def make_df(ntime=730, modes=MODES):
+
+    """ A dataframe with the columns that get_design needs. """
+
+    t = np.arange(ntime) / 365.25
+    df = pd.DataFrame({"gmt_scaled": np.linspace(0, 1, ntime)})
+    for k in range(modes[0]):
+        df[f"mode_0_{2 * k}"] = np.sin(2 * np.pi * (k + 1) * t)
+        df[f"mode_0_{2 * k + 1}"] = np.cos(2 * np.pi * (k + 1) * t)
+    return df
+
+
+def make_y(variable, ntime, ncells, seed=0):
+
+    """ Scaled observations in the support of the posterior of variable. """
+
+    rng = np.random.RandomState(seed)
+    family = posterior.posterior_for_var[variable]
+    if family is posterior.Normal:
+        return rng.normal(0.5, 0.1, (ntime, ncells))
+    if family is posterior.Beta:
+        return rng.beta(5, 3, (ntime, ncells))
+    y = rng.gamma(4.0, 0.1, (ntime, ncells))
+    if family is posterior.BernoulliGamma:
+        y[rng.rand(ntime, ncells) < 0.4] = np.nan
+    return y
+
+
+FAMILIES = {
+    "tas": posterior.Normal,
+    "tasrange": posterior.Gamma,
+    "pr": posterior.BernoulliGamma,
+    "hurs": posterior.Beta,
+    "wind": posterior.Weibull,
+}
+
+
+@pytest.fixture(params=sorted(FAMILIES))
+def case(request):
+
+    variable = request.param
+    post = posterior.posterior_for_var[variable](MODES)
+    design = posterior.get_design(make_df())
+    y = make_y(variable, len(make_df()), 1)
+    theta = np.random.RandomState(1).normal(0, 0.1, post.size)
+    return post, design, y, theta
+
+
+def test_posterior_for_var_families():
+
+    for variable, family in FAMILIES.items():
+        assert posterior.posterior_for_var[variable] is family
+
+
+def test_gradient_matches_finite_differences(case):
+
+    post, design, y, theta = case
+    _, grad = post.logp_dlogp(theta, design, y)
+    eps = 1e-6
+    numeric = np.empty(post.size)
+    for k in range(post.size):
+        step = np.zeros(post.size)
+        step[k] = eps
+        numeric[k] = (
+            post.logp_dlogp(theta + step, design, y)[0][0]
+            - post.logp_dlogp(theta - step, design, y)[0][0]
+        ) / (2 * eps)
+    np.testing.assert_allclose(grad[0], numeric, rtol=1e-4, atol=1e-4)
+
+
+def test_analytic_hessian_matches_gradient_differences():
+
+    post = posterior.Normal(MODES)
+    design = posterior.get_design(make_df())
+    y = make_y("tas", len(make_df()), 1)
+    theta = np.random.RandomState(1).normal(0, 0.1, post.size)
+    hess = post.hessian(theta, design, y)[0]
+    eps = 1e-6
+    for k in range(post.size):
+        step = np.zeros(post.size)
+        step[k] = eps
+        numeric = (
+            post.logp_dlogp(theta + step, design, y)[1][0]
+            - post.logp_dlogp(theta - step, design, y)[1][0]
+        ) / (2 * eps)
+        np.testing.assert_allclose(hess[k], numeric, rtol=1e-4, atol=1e-3)
+
+
+def test_logp_is_additive_over_cells(case):
+
+    post, design, y, theta = case
+    thetas = np.stack([theta, 0.5 * theta])
+    logp, grad = post.logp_dlogp(thetas, design, np.repeat(y, 2, axis=1))
+    for k in range(2):
+        logp_k, grad_k = post.logp_dlogp(thetas[k], design, y)
+        np.testing.assert_allclose(logp[k], logp_k[0])
+        np.testing.assert_allclose(grad[k], grad_k[0])
+
+
+def test_to_dict_from_dict_round_trip():
+
+    post = posterior.BernoulliGamma(MODES)
+    theta = np.random.RandomState(0).normal(size=(3, post.size))
+    np.testing.assert_array_equal(post.from_dict(post.to_dict(theta)), theta)
+    assert len(post.param_names) == post.size
+
+
+def test_resample_reports_the_prior_logp(case):
+
+    # as the logp Deterministic of the models, which is defined before the
+    # observed variables
+    post, design, y, theta = case
+    expected = stats.norm.logpdf(theta, scale=post.prior_sd).sum()
+    trace_obs, trace_cfact = post.resample(post.to_dict(theta), make_df())
+    np.testing.assert_allclose(trace_obs["logp"], [expected])
+    np.testing.assert_allclose(trace_cfact["logp"], [expected])
+    for values in trace_obs.values():
+        assert values.shape[0] == 1
+
+
+@pytest.mark.parametrize("variable", ["tas", "wind"])
+def test_find_map_batch_matches_find_map(variable):
+
+    post = posterior.posterior_for_var[variable](MODES)
+    design = posterior.get_design(make_df())
+    y = make_y(variable, len(make_df()), 3)
+    theta, logp, converged = posterior.find_map_batch(post, design, y)
+    assert converged.all()
+    for k in range(3):
+        theta_k, logp_k = posterior.find_map(post, design, y[:, k])
+        np.testing.assert_allclose(logp[k], logp_k, rtol=1e-6)
+        np.testing.assert_allclose(theta[k], theta_k, atol=1e-3)
+
+
+def test_find_map_batch_handles_masked_values():
+
+    post = posterior.Normal(MODES)
+    design = posterior.get_design(make_df())
+    y = make_y("tas", len(make_df()), 2)
+    y[::3, 1] = np.nan
+    theta, logp, converged = posterior.find_map_batch(post, design, y)
+    assert converged.all()
+    assert np.isfinite(logp).all()
+
+
+def test_numeric_hessian_matches_second_differences(case):
+
+    post, design, y, theta = case
+    hess = posterior.numeric_hessian(post, theta, design, y)
+    np.testing.assert_allclose(hess, hess.T)
+    rng = np.random.RandomState(2)
+    h = 1e-4
+    for _ in range(3):
+        v = rng.normal(size=post.size)
+        logp = [post.logp_dlogp(theta + s * h * v, design, y)[0][0] for s in (-1, 0, 1)]
+        second = (logp[0] - 2 * logp[1] + logp[2]) / h ** 2
+        np.testing.assert_allclose(v @ hess @ v, second, rtol=1e-3)
+
+
+def test_numeric_hessian_matches_analytic_hessian():
+
+    post = posterior.Normal(MODES)
+    design = posterior.get_design(make_df())
+    y = make_y("tas", len(make_df()), 1)
+    theta = np.random.RandomState(1).normal(0, 0.1, post.size)
+    np.testing.assert_allclose(
+        posterior.numeric_hessian(post, theta, design, y),
+        post.hessian(theta, design, y)[0],
+        rtol=1e-5,
+        atol=1e-3,
+    )
+
+
+def test_laplace_approximation_inverts_the_hessian():
+
+    post = posterior.Normal(MODES)
+    design = posterior.get_design(make_df())
+    y = make_y("tas", len(make_df()), 1)[:, 0]
+    theta, _ = posterior.find_map(post, design, y)
+    scale = posterior.laplace_approximation(post, theta, design, y)
+    hess = post.hessian(theta, design, y[:, None])[0]
+    np.testing.assert_allclose(scale @ scale.T @ -hess, np.eye(post.size), atol=1e-6)
+
+
+def test_laplace_approximation_without_analytic_hessian():
+
+    post = posterior.Gamma(MODES)
+    design = posterior.get_design(make_df())
+    y = make_y("tasrange", len(make_df()), 1)[:, 0]
+    theta, _ = posterior.find_map(post, design, y)
+    scale = posterior.laplace_approximation(post, theta, design, y)
+    cov = scale @ scale.T
+    np.testing.assert_allclose(cov, cov.T, atol=1e-12)
+    assert (np.linalg.eigvalsh(cov) > 0).all()
+
+
+@pytest.mark.parametrize("fullrank", [True, False])
+def test_fit_advi_stays_close_to_laplace(fullrank):
+
+    # for a Normal likelihood with many data, the posterior is nearly Gaussian
+    post = posterior.Normal(MODES)
+    design = posterior.get_design(make_df())
+    y = make_y("tas", len(make_df()), 1)[:, 0]
+    theta, _ = posterior.find_map(post, design, y)
+    scale = posterior.laplace_approximation(post, theta, design, y)
+    sd = np.sqrt((scale ** 2).sum(axis=1))
+    if not fullrank:
+        scale = np.diag(sd)
+        # mean field fits the conditional, not the marginal variances
+        sd = 1 / np.sqrt(np.diag(-post.hessian(theta, design, y[:, None])[0]))
+    mean, advi_scale, converged = posterior.fit_advi(
+        post, design, y, theta, scale, fullrank=fullrank, max_iterations=3000, seed=0
+    )
+    assert converged
+    assert (np.abs(mean - theta) < 0.5 * np.sqrt((scale ** 2).sum(axis=1))).all()
+    advi_sd = np.sqrt((advi_scale ** 2).sum(axis=1))
+    np.testing.assert_allclose(advi_sd, sd, rtol=0.3)
+
+
+def test_fit_advi_depends_on_seed_only():
+
+    post = posterior.Normal(MODES)
+    design = posterior.get_design(make_df())
+    y = make_y("tas", len(make_df()), 1)[:, 0]
+    theta, _ = posterior.find_map(post, design, y)
+    scale = posterior.laplace_approximation(post, theta, design, y)
+    fits = [
+        posterior.fit_advi(post, design, y, theta, scale, max_iterations=200, seed=seed)[0]
+        for seed in [[0, 1, 2], [0, 1, 2], [0, 1, 3]]
+    ]
+    np.testing.assert_array_equal(fits[0], fits[1])
+    assert not np.array_equal(fits[0], fits[2])
+
+
+def test_gaussian_samples_covariance():
+
+    rng = np.random.RandomState(0)
+    scale = np.tril(rng.normal(size=(3, 3))) + 3 * np.eye(3)
+    mean = np.array([1.0, -2.0, 0.5])
+    samples = posterior.gaussian_samples(mean, scale, 20000, seed=1)
+    np.testing.assert_allclose(samples.mean(axis=0), mean, atol=0.1)
+    np.testing.assert_allclose(np.cov(samples.T), scale @ scale.T, rtol=0.1, atol=0.2)
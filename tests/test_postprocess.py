@@ -0,0 +1,72 @@
+import types
+import numpy as np
+import netCDF4 as nc
+import attrici.manifest as manifest
+import attrici.postprocess as pp
+
+
+def make_run(tmp_path):
+
+    """ Settings of a run on a 2 x 3 grid with 4 land cells and a cell file
+    for each of them. """
+
+    settings = types.SimpleNamespace(
+        output_dir=tmp_path / "output",
+        variable="tas",
+        storage_format=".h5",
+        input_dir=tmp_path,
+        landsea_file="landmask.nc4",
+    )
+    lats, lons = np.array([10.25, 10.75]), np.array([0.25, 0.75, 1.25])
+    with nc.Dataset(tmp_path / "landmask.nc4", "w") as ds:
+        ds.createDimension("time", 1)
+        ds.createDimension("lat", 2)
+        ds.createDimension("lon", 3)
+        ds.createVariable("LSM", "f4", ("time", "lat", "lon"))[:] = [[[1, 1, 0], [1, 0, 1]]]
+    paths = {}
+    for i, j in [(0, 0), (0, 1), (1, 0), (1, 2)]:
+        lat_dir = settings.output_dir / "timeseries" / "tas" / f"lat_{lats[i]}"
+        lat_dir.mkdir(parents=True, exist_ok=True)
+        paths[(i, j)] = lat_dir / f"ts_lat{lats[i]}_lon{lons[j]}.h5"
+        paths[(i, j)].write_bytes(b"x")
+    return settings, lats, lons, paths
+
+
+def cell(lats, lons, i, j):
+
+    return {"index_lat": i, "index_lon": j, "lat": lats[i], "lon": lons[j]}
+
+
+def test_get_produced_cells_backfills_once(tmp_path, monkeypatch):
+
+    settings, lats, lons, paths = make_run(tmp_path)
+    task = manifest.Manifest(manifest.get_manifest_dir(settings), "task_0")
+    task.record(cell(lats, lons, 0, 0), "ok", 1.0, paths[(0, 0)])
+    task.record(cell(lats, lons, 1, 0), "failed", 1.0)
+    task.close()
+
+    cells = pp.get_produced_cells(settings, lats, lons)
+    # the failed cell is known, its old file is not added
+    assert sorted(zip(cells["i"], cells["j"])) == [(0, 0), (0, 1), (1, 2)]
+
+    def no_search(*args):
+        raise AssertionError("searched the cell files again")
+
+    monkeypatch.setattr(pp, "find_cell_files", no_search)
+    cells = pp.get_produced_cells(settings, lats, lons)
+    assert len(cells) == 3
+
+
+def test_get_produced_cells_marks_an_empty_backfill(tmp_path, monkeypatch):
+
+    settings, lats, lons, paths = make_run(tmp_path)
+    task = manifest.Manifest(manifest.get_manifest_dir(settings), "task_0")
+    task.record(cell(lats, lons, 0, 0), "ok", 1.0, paths[(0, 0)])
+    task.record(cell(lats, lons, 0, 1), "failed", 1.0)
+    task.close()
+    for key in [(0, 1), (1, 0), (1, 2)]:
+        paths[key].unlink()
+
+    assert len(pp.get_produced_cells(settings, lats, lons)) == 1
+    monkeypatch.setattr(pp, "find_cell_files", None)
+    assert len(pp.get_produced_cells(settings, lats, lons)) == 1
@@ -0,0 +1,66 @@
+import time
+import attrici.workqueue as workqueue
+
+
+def test_workqueue_claims_each_cell_once(tmp_path):
+
+    queue_file = tmp_path / "queue.sqlite"
+    first = workqueue.WorkQueue(queue_file, lease=3600)
+    second = workqueue.WorkQueue(queue_file, lease=3600)
+    second.worker = "other"
+    first.fill(range(5), [1.0, 5.0, 3.0, 2.0, 4.0])
+    second.fill(range(5), [1.0, 1.0, 1.0, 1.0, 1.0])
+
+    # the most expensive first, costs of the first fill are kept
+    assert first.claim(2) == [1, 4]
+    assert second.claim(2) == [2, 3]
+    first.finish(1)
+    first.finish(4, "failed")
+    assert [batch for batch in second.batches(2)] == [[0]]
+    assert first.summary() == {"claimed": 3, "done": 1, "failed": 1}
+    first.close()
+    second.close()
+
+
+def test_workqueue_expired_claims_are_renewed_or_taken_over(tmp_path):
+
+    queue_file = tmp_path / "queue.sqlite"
+    first = workqueue.WorkQueue(queue_file, lease=1.0)
+    second = workqueue.WorkQueue(queue_file, lease=1.0)
+    second.worker = "other"
+    first.fill([0, 1], [2.0, 1.0])
+    assert first.claim(2) == [0, 1]
+    first.finish(1)
+    time.sleep(0.6)
+    first.renew()
+    time.sleep(0.6)
+    # renewed before the lease expired
+    assert second.claim(2) == []
+    time.sleep(1.1)
+    assert second.claim(2) == [0]
+    first.close()
+    second.close()
+
+
+def test_workqueue_new_run_requeues_once(tmp_path):
+
+    queue_file = tmp_path / "queue.sqlite"
+    queue = workqueue.WorkQueue(queue_file, lease=3600)
+    queue.fill(range(3), [1.0, 1.0, 1.0], run_id="1")
+    assert queue.claim(3) == [0, 1, 2]
+    queue.finish(0)
+    queue.finish(1, "failed")
+
+    # the same run, another task
+    queue.fill(range(3), [1.0, 1.0, 1.0], run_id="1", retry_failed=True)
+    assert queue.summary() == {"claimed": 1, "done": 1, "failed": 1}
+    # a new run retries failed cells, once
+    queue.fill(range(3), [1.0, 1.0, 1.0], run_id="2", retry_failed=True)
+    assert queue.claim(3) == [1]
+    queue.finish(1, "failed")
+    queue.fill(range(3), [1.0, 1.0, 1.0], run_id="2", retry_failed=True)
+    assert queue.summary() == {"claimed": 1, "done": 1, "failed": 1}
+    # and redoes all finished cells with redo_done
+    queue.fill(range(3), [1.0, 1.0, 1.0], run_id="3", redo_done=True, retry_failed=True)
+    assert queue.summary() == {"claimed": 1, "todo": 2}
+    queue.close()
@@ -2,28 +2,62 @@
 
 # coding: utf-8
 
-import glob
-import itertools
+import os
+import argparse
 from pathlib import Path
 
 import netCDF4 as nc
 import xarray as xr
 
 import numpy as np
-
-# import pandas as pd
+import pandas as pd
 from datetime import datetime
-import subprocess
 import attrici
+import attrici.datahandler as dh
+import attrici.diagnostics as diag
 import attrici.postprocess as pp
 import settings as s
 
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=len(os.sched_getaffinity(0)),
+    help="number of processes that read cell files",
+)
+parser.add_argument(
+    "--band-rows",
+    type=int,
+    default=1,
+    help="number of latitudes that are assembled from the cell files at once",
+)
+parser.add_argument(
+    "--buffer-gb",
+    type=float,
+    default=8,
+    help="memory for transposing to map chunks, larger data is spilled to disk",
+)
+args = parser.parse_args()
+
 ### options for postprocess
 write_netcdf = True
-rechunk = True
-replace_invalid=True
-# cdo_processing needs rechunk
-cdo_processing = True
+# replace inf, nan and values of cells with too small logp by the original values.
+# "merge" replaces them while merging and writes the _valid.nc4 file directly,
+# "copy" replaces them in a _valid.nc4 copy of the merged file, None keeps them.
+replace_invalid = "merge"
+# annual means and linear trends of all reported variables, computed from the
+# merged data. The trend of the factual minus the counterfactual is added.
+diagnostics = True
+monthly_means = False
+
+# chunking and compression of the merged file: whole lat/lon fields of few
+# time steps, as with ncks --cnk_dmn=lat,360 --cnk_dmn=lon,720 --deflate 5
+chunk_time = 1
+chunk_lat = 360
+chunk_lon = 720
+deflate = 5
+# bytes per time slab of the transpose from time series to fields
+slab_bytes = 64 * 2 ** 20
 
 # append later with more variables if needed
 vardict = {s.variable: "cfact", s.variable + "_orig": "y",
@@ -32,68 +66,58 @@ vardict = {s.variable: "cfact", s.variable + "_orig": "y",
         # "pbern": "pbern",
         "logp": "logp"}
 
-cdo_ops = {
-    # "monmean": "monmean ",
-    "yearmean": "yearmean ",
-    #    "monmean_valid": "monmean -setrtomiss,-1e20,1.1574e-06 -selvar,cfact,y",
-       # "yearmean_valid": "yearmean -setrtomiss,-1e20,1.1574e-06 -selvar,cfact,y",
-    "trend": "trend ",
-    # "mse": "timmean -expr,'squared_error=sqr(mu-y_scaled)'"
-       # "trend_valid": "trend -setrtomiss,-1e20,1.1574e-06 -selvar,cfact,y",
-}
-
-
 TIME0 = datetime.now()
 
 source_file = Path(s.input_dir) / s.dataset / s.source_file.lower()
-ts_dir = s.output_dir / "timeseries" / s.variable
 cfact_dir = s.output_dir / "cfact" / s.variable
 cfact_file = cfact_dir / s.cfact_file
+# the merged file is written with its final chunking, the name is kept for
+# the scripts that use it
 cfact_rechunked = str(cfact_file).rstrip(".nc4") + "_rechunked.nc4"
+cfact_valid = cfact_rechunked.rstrip(".nc4") + "_valid.nc4"
+cfact_merged = cfact_valid if replace_invalid == "merge" else cfact_rechunked
+diagnostics_basename = str(cfact_file).rstrip(".nc4")
+if s.variable + "_orig" in s.report_to_netcdf and s.variable in s.report_to_netcdf:
+    difference = (s.variable + "_orig", s.variable)
+else:
+    difference = None
 
 if write_netcdf:
 
-    data_gen = ts_dir.glob("**/*" + s.storage_format)
     cfact_dir.mkdir(parents=True, exist_ok=True)
-
-    ### check which data is available
-    data_list = []
-    lat_indices = []
-    lon_indices = []
-    for i in data_gen:
-        data_list.append(str(i))
-        lat_float = float(str(i).split("lat")[-1].split("_")[0])
-        lon_float = float(str(i).split("lon")[-1].split(s.storage_format)[0])
-        lat_indices.append(int(180 - 2 * lat_float - 0.5))
-        lon_indices.append(int(2 * lon_float - 0.5 + 360))
-
-    # adjust indices if datasets are subsets (lat/lon-shapes are smaller than 360/720)
-    # TODO: make this more robust
-    lat_indices = np.array(np.array(lat_indices) / s.lateral_sub, dtype=int)
-    lon_indices = np.array(np.array(lon_indices) / s.lateral_sub, dtype=int)
-
-    #  get headers and form empty netCDF file with all meatdata
-    print(data_list[0])
-
     # write empty outfile to netcdf with all orignal attributes
     source_data = xr.open_dataset(source_file)
     attributes = source_data[s.variable].attrs
     coords = source_data[s.variable].coords
 
+    if s.storage_format == ".cells":
+        store = dh.CellStore(dh.get_output_store_path(s))
+        print(store.written.sum(), "of", len(store.cells), "cells written to", store.store_dir)
+    else:
+        cells = pp.get_produced_cells(s, coords["lat"].values, coords["lon"].values)
+        print(len(cells), "cell files, for example", cells["path"].iloc[0])
+
     outfile = source_data.drop_vars(s.variable)
 
-    outfile.to_netcdf(cfact_file)
+    outfile.to_netcdf(cfact_merged)
 
     # open with netCDF4 for memory efficient writing
-    outfile = nc.Dataset(cfact_file, "a")
+    outfile = nc.Dataset(cfact_merged, "a")
 
+    fill_value = 9.9692e36
+    shape = (len(coords["time"]), len(coords["lat"]), len(coords["lon"]))
     for var in s.report_to_netcdf:
         ncvar = outfile.createVariable(
             var,
             "f4",
             ("time", "lat", "lon"),
-            chunksizes=(len(coords["time"]), 1, 1),
-            fill_value=9.9692e36,
+            chunksizes=(
+                min(chunk_time, shape[0]), min(chunk_lat, shape[1]), min(chunk_lon, shape[2])
+            ),
+            zlib=True,
+            complevel=deflate,
+            shuffle=True,
+            fill_value=fill_value,
         )
         if var in [s.variable, s.variable + "_orig"]:
             for key, att in attributes.items():
@@ -103,44 +127,114 @@ if write_netcdf:
     outfile.setncattr("cfact_version", attrici.__version__)
     outfile.setncattr("runid", Path.cwd().name)
 
-    for (i, j, dfpath) in itertools.zip_longest(lat_indices, lon_indices, data_list):
+    if s.storage_format == ".cells":
+        bands = pp.read_bands_from_store(store, s.report_to_netcdf, args.band_rows, fill_value)
+        ncells = int(store.written.sum())
+    else:
+        bands = pp.read_bands_from_files(
+            cells.sort_values(["i", "j"]),
+            [vardict[var] for var in s.report_to_netcdf],
+            shape,
+            args.band_rows,
+            args.workers,
+            fill_value,
+        )
+        ncells = len(cells)
+
+    # whole multiples of chunk_time, so that each slab fills whole chunks
+    nvariables = len(s.report_to_netcdf)
+    field_bytes = nvariables * 4 * shape[1] * shape[2]
+    slab_time = chunk_time * max(1, slab_bytes // (field_bytes * chunk_time))
+    buffer = pp.SpatialChunkBuffer(
+        nvariables, shape, min(slab_time, shape[0]), fill_value, args.buffer_gb * 2 ** 30, cfact_dir
+    )
+
+    if replace_invalid == "merge" and s.variable + "_orig" not in s.report_to_netcdf:
+        source_nc = nc.Dataset(source_file, "r")
+        source_var = source_nc.variables[s.variable]
+    else:
+        source_nc, source_var = None, None
+    replaced = {"inf": 0, "nan": 0, "small_logp": 0, "cells": 0}
+
+    TIME_READ = datetime.now()
+    nbytes = 0
+    for band_start, block in bands:
+        if replace_invalid == "merge":
+            counts = pp.replace_invalid_in_band(
+                block, s.report_to_netcdf, s.variable, source_var, band_start
+            )
+            if counts["cells"] > 0:
+                pp.report_invalid("lat band " + str(band_start), counts)
+            for kind in replaced:
+                replaced[kind] += counts[kind]
+        buffer.write_band(band_start, block)
+        nbytes += block.nbytes
+        seconds = (datetime.now() - TIME_READ).total_seconds()
+        print(
+            "Read lat band {0} to {1}, {2:.0f} MB/s.".format(
+                band_start, band_start + block.shape[2] - 1, nbytes / 2 ** 20 / seconds
+            )
+        )
+
+    seconds = (datetime.now() - TIME_READ).total_seconds()
+    print(
+        "Read {0} cells, {1:.1f} GB in {2:.1f} minutes: {3:.1f} cells/s, {4:.0f} MB/s.".format(
+            ncells, nbytes / 2 ** 30, seconds / 60, ncells / seconds, nbytes / 2 ** 20 / seconds
+        )
+    )
+    if replace_invalid == "merge":
+        pp.report_invalid("all cells", replaced)
+        if source_nc is not None:
+            source_nc.close()
+
+    # with replace_invalid "copy", the diagnostics are computed from the copy
+    if diagnostics and replace_invalid != "copy":
+        times = outfile.variables["time"]
+        merge_diagnostics = diag.Diagnostics(
+            diagnostics_basename,
+            s.report_to_netcdf,
+            times[:],
+            times.units,
+            getattr(times, "calendar", "standard"),
+            coords["lat"].values,
+            coords["lon"].values,
+            {s.variable: attributes, s.variable + "_orig": attributes},
+            fill_value,
+            monthly_means,
+            difference,
+        )
 
-        df = pp.read_from_disk(dfpath)
-        for var in s.report_to_netcdf:
-            ts = df[vardict[var]]
-            outfile.variables[var][:, i, j] = np.array(ts)
-        print("wrote data from", dfpath, "to", i, j)
+    TIME_WRITE = datetime.now()
+    for t0, slab in buffer.slabs():
+        for k, var in enumerate(s.report_to_netcdf):
+            outfile.variables[var][t0:t0 + slab.shape[1], :, :] = slab[k]
+        if diagnostics and replace_invalid != "copy":
+            merge_diagnostics.add(t0, slab)
+        print("Wrote time steps {0} to {1}.".format(t0, t0 + slab.shape[1] - 1))
+    buffer.close()
+    if diagnostics and replace_invalid != "copy":
+        merge_diagnostics.close()
+
+    seconds = (datetime.now() - TIME_WRITE).total_seconds()
+    print(
+        "Wrote {0:.1f} GB with map chunks in {1:.1f} minutes: {2:.0f} MB/s.".format(
+            nbytes / 2 ** 30, seconds / 60, nbytes / 2 ** 20 / seconds
+        )
+    )
 
     outfile.close()
 
-    print("Successfully wrote", cfact_file, "file. Took")
+    print("Successfully wrote", cfact_merged, "file. Took")
     print(
         "Writing took {0:.1f} minutes.".format(
             (datetime.now() - TIME0).total_seconds() / 60
         )
 )
 
-if rechunk:
-    cfact_rechunked = pp.rechunk_netcdf(cfact_file, cfact_rechunked)
-
-if replace_invalid:
-    cfact_rechunked = pp.replace_nan_inf_with_orig(s.variable, source_file, cfact_rechunked)
-
+if replace_invalid == "copy":
+    cfact_merged = pp.replace_nan_inf_with_orig(s.variable, source_file, cfact_rechunked)
 
-if cdo_processing:
-
-    for cdo_op in cdo_ops:
-
-        outfile = str(cfact_file).rstrip(".nc4") + "_" + cdo_op + ".nc4"
-        if "trend" in cdo_op:
-            outfile = (
-                outfile.rstrip(".nc4") + "_1.nc4 " + outfile.rstrip(".nc4") + "_2.nc4"
-            )
-        try:
-            cmd = "cdo " + cdo_ops[cdo_op] + " " + cfact_rechunked + " " + outfile
-            print(cmd)
-            subprocess.check_call(cmd, shell=True)
-        except subprocess.CalledProcessError:
-            cmd = "module load cdo && " + cmd
-            print(cmd)
-            subprocess.check_call(cmd, shell=True)
+if diagnostics and (replace_invalid == "copy" or not write_netcdf):
+    diag.diagnose_file(
+        cfact_merged, s.report_to_netcdf, diagnostics_basename, monthly_means, difference
+    )